@@ -0,0 +1 @@
+"""Offline, deterministic benchmarks of the comic graph (see run_graph.py)."""
@@ -0,0 +1,235 @@
+"""
+In-process stand-ins for the external services used by the comic graph.
+
+- ``ScriptedChat`` replaces ``ChatOpenAI`` / ``ChatGoogleGenerativeAI``: it
+  recognises which node is calling from the prompt and returns canned JSON
+  shaped like a real answer, after a configurable latency.
+- ``SyntheticImageAdapter`` replaces the image providers: it renders a small
+  PNG and stores it through the regular ``_upload_to_s3`` path.
+- ``FakeEmbeddings`` / ``InMemoryVectorStore`` replace OpenAI embeddings and
+  Chroma.
+
+Latencies get a jitter derived from the prompt text (not from a random
+generator), so the same workload always produces the same timings shape
+regardless of thread scheduling.
+"""
+import io
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+from langchain_core.messages import AIMessage
+from PIL import Image, ImageDraw
+
+from core.adapters import ImageModelAdapter
+
+from .workloads import Workload
+
+
+def _jitter(text: str, base: float) -> float:
+    """Deterministic latency in [0.5, 1.5) x base, derived from the prompt."""
+    if base <= 0:
+        return 0.0
+    return base * (0.5 + (zlib.crc32(text.encode("utf-8", "ignore")) % 1000) / 1000.0)
+
+
+def _message_text(messages) -> str:
+    """Plain text of a prompt given as a string, a message or a list of messages / content parts."""
+    if isinstance(messages, str):
+        return messages
+    if isinstance(messages, dict):
+        return messages.get("text", "")
+    if isinstance(messages, (list, tuple)):
+        return "\n".join(_message_text(m) for m in messages)
+    content = getattr(messages, "content", "")
+    return _message_text(content) if content is not None else ""
+
+
+class CallLog:
+    """Thread-safe count of fake calls per kind (reported next to the timings)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, kind):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+class ScriptedChat:
+    """Scripted chat model: answers each node's prompt with plausible JSON."""
+
+    workload: Workload = None
+    calls: CallLog = None
+
+    def __init__(self, model=None, temperature=0, **kwargs):
+        self.model = model
+
+    def invoke(self, messages, config=None, **kwargs):
+        text = _message_text(messages)
+        kind, content = self._answer(text)
+        self.calls.add(kind)
+        time.sleep(_jitter(text, self.workload.llm_latency))
+        return AIMessage(content=content)
+
+    # -- scripted answers ----------------------------------------------------
+
+    def _answer(self, text):
+        w = self.workload
+        if '"page_summaries"' in text:
+            pages = sorted({int(n) for n in re.findall(r"\[\[page (\d+)\]\]", text)}) or [1]
+            return "story", json.dumps({
+                "page_summaries": {str(p): f"Resumen de la pagina {p}: tension creciente." for p in pages},
+                "panel_purposes": {
+                    f"page_{p}_panel_{m}": "Proposito subyacente: mostrar la amenaza." for p in pages for m in (1, 2, 3)
+                },
+            })
+        if '"style_tokens"' in text:
+            return "style", json.dumps({"style_tokens": ["thick ink lines", "muted palette", "noir lighting"]})
+        if '"traits"' in text:
+            return "traits", json.dumps({"traits": ["cabello negro corto", "abrigo largo gris", "cicatriz en la ceja"]})
+        if "identifica a los personajes principales" in text:
+            return "world_model", json.dumps({
+                "characters": [{"name": n, "description": f"{n}, protagonista sombrio."} for n in w.character_names],
+                "sceneries": [{"name": n, "description": f"{n}: callejon humedo de noche."} for n in w.scenery_names],
+            })
+        if "FORMATO JSON OBLIGATORIO" in text:
+            return "planner", json.dumps({"panels": self._plan(text)})
+        if "estado de continuidad" in text:
+            return "continuity", json.dumps({
+                "characters": {n: {"ropa": "abrigo gris", "heridas": "", "objetos": "linterna"} for n in w.character_names[:2]},
+                "environment": {"zona": "callejon", "iluminacion": "farola", "objetos_movidos": "", "detalles_persistentes": "charcos"},
+            })
+        if '"balloons"' in text:
+            ids = re.findall(r'"id":\s*"([^"]+)"', text)
+            return "balloons", json.dumps({"panels": [
+                {"id": pid, "balloons": [
+                    {"type": "dialogue", "character": (w.character_names or ["Narrador"])[0],
+                     "text": "No podemos volver atras.", "position_hint": "top-left"},
+                ]}
+                for pid in ids if pid != "..."
+            ]})
+        if "maqueta" in text:
+            return "merge_vision", "Fundir los fondos con una bruma azul continua entre paneles."
+        return "prompt_builder", "Cinematic comic panel, dramatic low angle, noir lighting, rain."
+
+    def _plan(self, text):
+        w = self.workload
+        match = re.search(r"Genera aproximadamente (\d+) paneles repartidos entre las \S+ (\d+) a (\d+)", text)
+        if match:
+            count, first, last = (int(g) for g in match.groups())
+        else:
+            count, first, last = w.panels, 1, w.pages
+        pages = list(range(first, max(first, last) + 1))
+        names = w.character_names or ["Narrador"]
+        places = w.scenery_names or ["Ciudad"]
+        panels = []
+        for i in range(max(1, count)):
+            panels.append({
+                "page_number": pages[i * len(pages) // max(1, count)],
+                "order_in_page": 0,
+                "scene_description": f"Panel {i + 1}: {names[i % len(names)]} avanza por {places[i % len(places)]}.",
+                "script": f"VINETA {i + 1}. {names[i % len(names)]} mira hacia la calle.",
+                "characters": [names[i % len(names)]] + ([names[(i + 1) % len(names)]] if i % 3 == 0 and len(names) > 1 else []),
+                "scenery": places[i % len(places)],
+                "style": "noir",
+            })
+        return panels
+
+
+class SyntheticImageAdapter(ImageModelAdapter):
+    """Image provider that renders a flat PNG (after `image_latency`) and uploads it as usual."""
+
+    workload: Workload = None
+    calls: CallLog = None
+    size = (512, 512)
+
+    def generate_image(self, prompt, style_prompt="", aspect_ratio="1:1", init_image_path=None, context_images=None, **kwargs):
+        self.calls.add("render_edit" if init_image_path else "render")
+        time.sleep(_jitter(prompt, self.workload.image_latency))
+        seed = zlib.crc32(prompt.encode("utf-8", "ignore"))
+        img = Image.new("RGB", self.size, ((seed >> 16) & 255, (seed >> 8) & 255, seed & 255))
+        ImageDraw.Draw(img).rectangle([32, 32, self.size[0] - 32, self.size[1] - 32], outline="black", width=6)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return self._upload_to_s3(buffer.getvalue())
+
+
+def synthetic_png(label: str, size=(256, 256)) -> bytes:
+    seed = zlib.crc32(label.encode("utf-8"))
+    img = Image.new("RGB", size, ((seed >> 16) & 255, (seed >> 8) & 255, seed & 255))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeEmbeddings:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text):
+        return [((zlib.crc32(text.encode("utf-8", "ignore")) >> shift) & 255) / 255.0 for shift in (0, 8, 16, 24)]
+
+
+class InMemoryVectorStore:
+    """Chroma stand-in: keeps the splits per persist_directory and returns the first k."""
+
+    _stores = {}
+    _lock = threading.Lock()
+
+    def __init__(self, persist_directory=None, embedding_function=None, **kwargs):
+        with self._lock:
+            self.documents = list(self._stores.get(persist_directory, []))
+
+    @classmethod
+    def from_documents(cls, documents, embedding=None, persist_directory=None, **kwargs):
+        # query_world_rules comprueba que el directorio exista, como con Chroma
+        os.makedirs(persist_directory, exist_ok=True)
+        with cls._lock:
+            cls._stores[persist_directory] = list(documents)
+        return cls(persist_directory)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.documents[:k]
+
+
+# Attribute name -> fake, patched in every already-imported core module that uses it
+FAKE_ATTRIBUTES = {
+    "ChatOpenAI": ScriptedChat,
+    "ChatGoogleGenerativeAI": ScriptedChat,
+    "OpenAIEmbeddings": FakeEmbeddings,
+    "Chroma": InMemoryVectorStore,
+    "get_image_adapter": lambda: SyntheticImageAdapter(),
+}
+
+
+@contextmanager
+def offline_services(workload: Workload, calls: CallLog):
+    """Patches the graph's LLM, embedding, vector store and image provider references."""
+    import sys
+
+    # Importa todos los nodos antes de parchear para que las referencias existan
+    import core.graph  # noqa: F401
+    import core.node_handlers  # noqa: F401
+
+    ScriptedChat.workload = SyntheticImageAdapter.workload = workload
+    ScriptedChat.calls = SyntheticImageAdapter.calls = calls
+    with ExitStack() as stack:
+        for module_name, module in list(sys.modules.items()):
+            if module is None or not (module_name == "core" or module_name.startswith("core.")):
+                continue
+            for attribute, fake in FAKE_ATTRIBUTES.items():
+                if module_name == "core.adapters" and attribute == "get_image_adapter":
+                    continue
+                if hasattr(module, attribute):
+                    stack.enter_context(mock.patch.object(module, attribute, fake))
+        yield
@@ -0,0 +1,255 @@
+"""
+Offline benchmark of the full comic graph.
+
+Runs ``create_comic_graph()`` end to end (ingestion, story understanding, world
+model, planner, layout, generator, balloons, merger) with every external
+service replaced by the deterministic fakes in ``benchmarks.fakes`` and the
+bucket on local disk (``--storage local``, the default; see core/storage.py)
+or served by moto (``--storage s3``). Real LLM / image latencies are simulated
+with sleeps, so the numbers reflect the graph's own orchestration: concurrency settings,
+canon round trips, downloads and serialization.
+
+    python -m benchmarks.run_graph --workload medium
+    python -m benchmarks.run_graph --workload small --generator-concurrency 1,2,4,8 --repeat 3
+    python -m benchmarks.run_graph --panels 40 --image-latency 0.5 --trace-dir ./traces --json
+
+Reports the per-node wall time (from the metrics registry), the total wall time
+and the throughput in generated panels per minute for every combination of
+concurrency settings.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .fakes import CallLog, offline_services, synthetic_png
+from .workloads import WORKLOADS, Workload, write_script_pdf
+
+BUCKET = "comic-benchmark"
+REGION = "us-east-1"
+
+
+def _int_list(value):
+    return [int(v) for v in str(value).split(",") if v.strip()]
+
+
+def _set_environment(concurrency: dict, storage_backend: str, workdir: str, trace_dir: str = ""):
+    os.environ.update({
+        "COMIC_AGENT_STORAGE": storage_backend,
+        "COMIC_AGENT_STORAGE_DIR": os.path.join(workdir, "storage"),
+        "OPENAI_MODEL_ID": "benchmark-chat",
+        "GEMINI_MODEL_ID_TEXT": "benchmark-vision",
+        "AWS_STORAGE_BUCKET_NAME": BUCKET,
+        "AWS_REGION": REGION,
+        "AWS_DEFAULT_REGION": REGION,
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "LANGCHAIN_TRACING_V2": "false",
+        "LANGSMITH_TRACING": "false",
+        "ENABLE_PARALLEL_GENERATOR": "1",
+        "GENERATOR_CONCURRENCY": str(concurrency["generator"]),
+        "STORY_BATCH_CONCURRENCY": str(concurrency["story"]),
+        "WORLD_TRAITS_CONCURRENCY": str(concurrency["world_traits"]),
+        "COMIC_AGENT_METRICS": "1",
+        "COMIC_AGENT_TIMING": "0",
+        "COMIC_AGENT_TRACE_DIR": trace_dir,
+    })
+    # Importado aquí: los flags de telemetry y el backend se leen del entorno recién fijado
+    from core import storage, telemetry
+    from core.knowledge import canonical_store, traits
+    telemetry.configure()
+    storage.configure()
+    # El registro de canon guarda instancias ligadas al backend anterior
+    canonical_store.clear_registry()
+    # Sin rasgos cacheados de la repetición anterior: cada run paga sus llamadas de visión
+    traits.reset_trait_engine()
+
+
+def _seed_bucket(workload: Workload, project_id: str) -> dict:
+    """Uploads the reference images and returns the global_context the backend would send."""
+    from core.storage import S3Storage, get_storage
+
+    store = get_storage()
+    if isinstance(store, S3Storage):
+        store.client.create_bucket(Bucket=BUCKET)
+
+    def entities(kind, names):
+        result = []
+        for name in names:
+            urls = []
+            for n in range(workload.images_per_entity):
+                key = f"projects/{project_id}/{kind}/{name.replace(' ', '_').lower()}_{n}.png"
+                store.put(key, synthetic_png(f"{name}-{n}"), content_type="image/png")
+                urls.append(f"s3://{BUCKET}/{key}")
+            result.append({"name": name, "description": f"{name} (referencia)", "image_urls": urls})
+        return result
+
+    return {
+        "characters": entities("characters", workload.character_names),
+        "sceneries": entities("sceneries", workload.scenery_names),
+        "style_guide": "",
+    }
+
+
+def run_once(workload: Workload, concurrency: dict, storage_backend: str = "local", trace_dir: str = "",
+             verbose: bool = False) -> dict:
+    """One end-to-end graph invocation in a fresh temp dir and a fresh bucket."""
+    from core import metrics, tracing
+    from core.knowledge import canonical_store
+
+    if storage_backend == "s3":
+        from moto import mock_aws
+        bucket_context = mock_aws()
+    else:
+        bucket_context = contextlib.nullcontext()
+
+    project_id = f"bench-{workload.name}"
+    calls = CallLog()
+    previous_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="comic-bench-") as workdir, bucket_context:
+        # data/chroma y data/temp_downloads son relativos al directorio de trabajo
+        os.chdir(workdir)
+        try:
+            _set_environment(concurrency, storage_backend, workdir, trace_dir)
+            global_context = _seed_bucket(workload, project_id)
+            script_path = write_script_pdf(workload, os.path.join(workdir, "script.pdf"))
+
+            with offline_services(workload, calls):
+                from core.graph import create_comic_graph
+
+                graph = create_comic_graph()
+                initial_state = {
+                    "project_id": project_id,
+                    "sources": [script_path],
+                    "max_pages": workload.pages,
+                    "max_panels": workload.panels,
+                    "layout_style": workload.layout_style,
+                    "plan_only": False,
+                    "panels": [],
+                    "merged_pages": [],
+                    "style_guide": "",
+                    "world_model_summary": "",
+                    "script_outline": [],
+                    "current_step": "start",
+                    "reference_images": [],
+                    "global_context": global_context,
+                }
+                output = io.StringIO()
+                started = time.perf_counter()
+                with contextlib.ExitStack() as stack:
+                    if not verbose:
+                        # Los nodos imprimen mucho DEBUG: fuera del cronometraje solo si se pide --verbose
+                        stack.enter_context(contextlib.redirect_stdout(output))
+                    run_metrics = stack.enter_context(metrics.collect_run("benchmark"))
+                    stack.enter_context(tracing.collect_trace("benchmark", project_id, "-".join(
+                        f"{k}{v}" for k, v in sorted(concurrency.items()))))
+                    stack.enter_context(canonical_store.canon_session())
+                    result = graph.invoke(initial_state)
+                wall = time.perf_counter() - started
+        finally:
+            os.chdir(previous_cwd)
+
+    summary = run_metrics.summary() if run_metrics else {"steps": {}}
+    panels = result.get("panels", [])
+    generated = sum(1 for p in panels if p.get("status") == "generated" or p.get("image_url"))
+    return {
+        "workload": workload.name,
+        "storage": storage_backend,
+        "concurrency": dict(concurrency),
+        "wall_seconds": round(wall, 3),
+        "panels": len(panels),
+        "generated_panels": generated,
+        "merged_pages": len(result.get("merged_pages", [])),
+        "panels_per_minute": round(generated / wall * 60, 2) if wall > 0 else 0.0,
+        "nodes": {name: step for name, step in summary["steps"].items() if name.startswith("node.")},
+        "steps": summary["steps"],
+        "fake_calls": dict(sorted(calls.counts.items())),
+        "error": result.get("error"),
+    }
+
+
+def _print_report(results):
+    for r in results:
+        settings = ", ".join(f"{k}={v}" for k, v in r["concurrency"].items())
+        print(f"\n== {r['workload']} [{settings}] storage={r['storage']} run {r['repeat']}")
+        print(f"   wall {r['wall_seconds']:.2f}s   panels {r['generated_panels']}/{r['panels']}   "
+              f"pages {r['merged_pages']}   {r['panels_per_minute']:.1f} panels/min")
+        if r["error"]:
+            print(f"   ERROR: {r['error']}")
+        for name, step in sorted(r["nodes"].items(), key=lambda item: item[1]["total_s"], reverse=True):
+            print(f"   {name:<32} {step['total_s']:>8.3f}s  x{step['count']}")
+        print("   fake calls: " + ", ".join(f"{k}={v}" for k, v in r["fake_calls"].items()))
+
+    if len({json.dumps(r["concurrency"], sort_keys=True) for r in results}) > 1:
+        print("\n== summary (median wall per setting)")
+        by_setting = {}
+        for r in results:
+            by_setting.setdefault(json.dumps(r["concurrency"], sort_keys=True), []).append(r)
+        for key, runs in by_setting.items():
+            walls = sorted(r["wall_seconds"] for r in runs)
+            median = walls[len(walls) // 2]
+            rate = sorted(r["panels_per_minute"] for r in runs)[len(runs) // 2]
+            print(f"   {key:<60} {median:>8.2f}s  {rate:>8.1f} panels/min")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the comic graph.")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="small")
+    parser.add_argument("--pages", type=int)
+    parser.add_argument("--panels", type=int)
+    parser.add_argument("--characters", type=int)
+    parser.add_argument("--sceneries", type=int)
+    parser.add_argument("--script-pages", type=int)
+    parser.add_argument("--images-per-entity", type=int)
+    parser.add_argument("--llm-latency", type=float, help="Seconds per fake chat call (default from the workload).")
+    parser.add_argument("--image-latency", type=float, help="Seconds per fake render (default from the workload).")
+    parser.add_argument("--generator-concurrency", type=_int_list, default=[2], help="Comma list, e.g. 1,2,4,8.")
+    parser.add_argument("--story-concurrency", type=_int_list, default=[2], help="Comma list.")
+    parser.add_argument("--world-traits-concurrency", type=_int_list, default=[2], help="Comma list.")
+    parser.add_argument("--storage", choices=["local", "s3"], default="local",
+                        help="Bucket backend: local disk (no network) or moto's in-process S3.")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--trace-dir", default="", help="Write a Chrome trace per run to this directory.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the nodes' DEBUG output.")
+    args = parser.parse_args(argv)
+
+    if args.storage == "s3":
+        try:
+            import moto  # noqa: F401
+        except ImportError:
+            parser.error("--storage s3 needs moto for the in-process S3 backend (pip install moto)")
+
+    workload = WORKLOADS[args.workload].with_overrides(
+        pages=args.pages, panels=args.panels, characters=args.characters, sceneries=args.sceneries,
+        script_pages=args.script_pages, images_per_entity=args.images_per_entity,
+        llm_latency=args.llm_latency, image_latency=args.image_latency,
+    )
+    trace_dir = os.path.abspath(args.trace_dir) if args.trace_dir else ""
+
+    results = []
+    for generator, story, world_traits in itertools.product(
+        args.generator_concurrency, args.story_concurrency, args.world_traits_concurrency
+    ):
+        concurrency = {"generator": generator, "story": story, "world_traits": world_traits}
+        for repeat in range(1, args.repeat + 1):
+            result = run_once(workload, concurrency, args.storage, trace_dir=trace_dir, verbose=args.verbose)
+            result["repeat"] = repeat
+            results.append(result)
+            if not args.json:
+                print(f"{workload.name} {concurrency} run {repeat}: {result['wall_seconds']:.2f}s", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps({"workload": workload.__dict__, "results": results}, indent=2))
+    else:
+        _print_report(results)
+    return 0 if not any(r["error"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""Parameterized workloads for the offline graph benchmark."""
+import os
+from dataclasses import dataclass, replace
+from typing import Dict, List
+
+
+@dataclass(frozen=True)
+class Workload:
+    name: str
+    pages: int = 3                 # max_pages of the comic
+    panels: int = 9                # max_panels of the comic
+    characters: int = 3
+    sceneries: int = 2
+    script_pages: int = 4          # pages of the synthetic PDF script
+    chars_per_script_page: int = 2500
+    images_per_entity: int = 2     # reference images per character / scenery
+    llm_latency: float = 0.05      # seconds per fake chat call (scaled by a deterministic jitter)
+    image_latency: float = 0.2     # seconds per fake render / merge
+    layout_style: str = "dynamic"
+
+    def with_overrides(self, **overrides) -> "Workload":
+        return replace(self, **{k: v for k, v in overrides.items() if v is not None})
+
+    @property
+    def character_names(self) -> List[str]:
+        return [f"Personaje {chr(65 + i % 26)}{i // 26 or ''}" for i in range(self.characters)]
+
+    @property
+    def scenery_names(self) -> List[str]:
+        return [f"Escenario {i + 1}" for i in range(self.sceneries)]
+
+
+WORKLOADS: Dict[str, Workload] = {
+    "small": Workload("small"),
+    "medium": Workload("medium", pages=6, panels=24, characters=5, sceneries=3, script_pages=12),
+    "large": Workload("large", pages=12, panels=60, characters=8, sceneries=5, script_pages=32),
+}
+
+
+def script_page_text(workload: Workload, page: int) -> str:
+    """Deterministic script text for one PDF page (ASCII, so any PDF text extractor reads it back)."""
+    names = workload.character_names or ["Narrador"]
+    places = workload.scenery_names or ["Ciudad"]
+    lines = [f"[[page {page}]] PAGINA {page}"]
+    panel = 1
+    while sum(len(line) + 1 for line in lines) < workload.chars_per_script_page:
+        who = names[(page + panel) % len(names)]
+        where = places[(page * 3 + panel) % len(places)]
+        lines.append(f"VINETA {panel}. {where}. {who} cruza la escena bajo una luz fria.")
+        lines.append(f"{who.upper()}: No podemos volver atras, no despues de lo que vimos en la pagina {page}.")
+        panel += 1
+    return "\n".join(lines)
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_script_pdf(workload: Workload, path: str) -> str:
+    """Minimal multi-page text PDF (Helvetica, one text line per script line)."""
+    objects = []  # body of objects 1..n (1 = catalog, 2 = pages, 3 = font)
+    page_ids = []
+    pages = [script_page_text(workload, n + 1) for n in range(workload.script_pages)]
+    first_page_obj = 4
+    for index, text in enumerate(pages):
+        content_id = first_page_obj + index * 2 + 1
+        page_ids.append(first_page_obj + index * 2)
+        stream_lines = ["BT", "/F1 8 Tf", "10 TL", "36 806 Td"]
+        for line in text.split("\n"):
+            stream_lines.append(f"({_pdf_escape(line)}) Tj T*")
+        stream_lines.append("ET")
+        stream = "\n".join(stream_lines).encode("latin-1")
+        objects.append((
+            page_ids[-1],
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>".encode()
+        ))
+        objects.append((content_id, b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"))
+
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids)
+    objects = [
+        (1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        (2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()),
+        (3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"),
+    ] + objects
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for obj_id, body in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += b"%d 0 obj\n" % obj_id + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for obj_id in range(1, len(objects) + 1):
+        out += b"%010d 00000 n \n" % offsets[obj_id]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
@@ -21,24 +21,20 @@ class ImageModelAdapter(ABC):
     def edit_image(self, original_image_url: str, prompt: str, style_prompt:str, mask_url: str = None, context_images: list = None) -> str:
         """Edits an existing image (Inpainting/Outpainting/Variation)"""
         import tempfile
-        import boto3
         import requests
-        from urllib.parse import urlparse
+        from .storage import get_storage, is_s3_http_url, split_location
         
         # 1. Obtener la imagen original (URL o S3 Key)
         tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
         tmp_path = tmp.name
         tmp.close() # Cierra el handle para Windows
+        init_path = tmp_path
         
         try:
             img_url = original_image_url
             # Re-routing logic for S3 URLs sent as HTTP
-            if img_url.startswith('http') and (".s3." in img_url or "amazonaws.com" in img_url):
-                parsed = urlparse(img_url)
-                hostname = parsed.netloc
-                parts = hostname.split('.')
-                bucket_name = parts[0]
-                key = parsed.path.lstrip('/')
+            if img_url.startswith('http') and is_s3_http_url(img_url):
+                bucket_name, key = split_location(img_url)
                 img_url = f"s3://{bucket_name}/{key}"
                 print(f"DEBUG: edit_image Re-routed HTTP S3 URL to S3 URI: {img_url}")
 
@@ -49,21 +45,13 @@ class ImageModelAdapter(ABC):
                 with open(tmp_path, "wb") as f:
                     f.write(r.content)
             else:
-                s3 = boto3.client("s3")
-                bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
-                s3_uri = img_url
-                if s3_uri.startswith('s3://'):
-                    parsed = urlparse(s3_uri)
-                    bucket = parsed.netloc
-                    s3_key = parsed.path.lstrip('/')
-                else:
-                    s3_key = s3_uri
-                
-                print(f"DEBUG: edit_image downloading from S3: {bucket}/{s3_key}")
-                s3.download_file(bucket, s3_key, tmp_path)
+                storage = get_storage()
+                print(f"DEBUG: edit_image reading from {storage.name}: {storage.uri(img_url)}")
+                # Con almacenamiento local se usa el archivo directamente, sin copia
+                init_path = storage.local_path(img_url, tmp_path)
         
             # 2. Llamar a la implementación específica de cada modelo pasando el path local y contexto
-            return self.generate_image(prompt, style_prompt=style_prompt, init_image_path=tmp_path, context_images=context_images)
+            return self.generate_image(prompt, style_prompt=style_prompt, init_image_path=init_path, context_images=context_images)
         finally:
             if os.path.exists(tmp_path):
                 try: os.remove(tmp_path)
@@ -72,18 +60,10 @@ class ImageModelAdapter(ABC):
     def _upload_to_s3(self, image_data: bytes, extension: str = "png") -> str:
         """Sube bytes a S3 y retorna la clave (o URL)"""
         import uuid
-        import boto3
+        from .storage import get_storage
         
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION")
-        )
-        bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
         key = f"generated/{uuid.uuid4()}.{extension}"
-        
-        s3.put_object(Bucket=bucket, Key=key, Body=image_data, ContentType=f"image/{extension}")
+        get_storage().put(key, image_data, content_type=f"image/{extension}")
         # Retornamos la clave o URL según conveniencia. El backend espera algo que pueda guardar en ImageField.
         # En AWS S3 con django-storages, guardar la 'key' suele ser suficiente si el bucket es el mismo.
         return key
@@ -214,7 +194,7 @@ class GoogleGeminiAdapter(ImageModelAdapter):
         import requests
         import base64
         import io
-        import tempfile
+        from .storage import get_storage, is_s3_http_url, split_location
         
         # Mapear aspect ratio según soporte de Imagen 3 / Gemini Image
         ar_map = {
@@ -261,17 +241,10 @@ class GoogleGeminiAdapter(ImageModelAdapter):
 
                         # Normalizar el path: S3, HTTP o Local
                         # Detectar si es una URL de S3 (para evitar errores 403 por prefirmado expirado)
-                        if str(img_url).startswith('http') and (".s3." in str(img_url) or "amazonaws.com" in str(img_url)):
-                            from urllib.parse import urlparse
-                            parsed = urlparse(str(img_url))
-                            hostname = parsed.netloc
-                            if hostname.endswith(".amazonaws.com"):
-                                parts = hostname.split('.')
-                                if "s3" in parts:
-                                    bucket_name = parts[0]
-                                    key = parsed.path.lstrip('/')
-                                    img_url = f"s3://{bucket_name}/{key}"
-                                    print(f"DEBUG: Re-routed context URL to S3 URI: {img_url}")
+                        if is_s3_http_url(img_url):
+                            bucket_name, key = split_location(img_url)
+                            img_url = f"s3://{bucket_name}/{key}"
+                            print(f"DEBUG: Re-routed context URL to S3 URI: {img_url}")
                             
                         # El bloque de S3 ahora manejará tanto s3:// como las re-encaminadas
                         if str(img_url).startswith('http'):
@@ -280,25 +253,10 @@ class GoogleGeminiAdapter(ImageModelAdapter):
                             r.raise_for_status()
                             img_bytes = r.content
                         elif str(img_url).startswith('s3://') or ("/" in str(img_url) and not os.path.exists(img_url) and not "\\" in str(img_url)):
-                            # Si no existe localmente y parece una ruta de S3, intentar S3
-                            s3_uri = img_url
-                            if not str(img_url).startswith('s3://'):
-                                bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
-                                s3_uri = f"s3://{bucket}/{img_url}"
-                            
-                            print(f"DEBUG: Resolving context via S3: {s3_uri}")
-                            import boto3
-                            from urllib.parse import urlparse
-                            parsed = urlparse(s3_uri)
-                            bucket_name = parsed.netloc
-                            key = parsed.path.lstrip('/')
-                            with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                                tmp_path = tmp.name
-                            s3 = boto3.client("s3")
-                            s3.download_file(bucket_name, key, tmp_path)
-                            with open(tmp_path, 'rb') as f:
-                                img_bytes = f.read()
-                            os.remove(tmp_path)
+                            # Si no existe localmente y parece una clave del bucket, leerla del almacenamiento
+                            storage = get_storage()
+                            print(f"DEBUG: Resolving context via {storage.name}: {storage.uri(img_url)}")
+                            img_bytes = storage.read(img_url)
                         else:
                             # Local path (especially on Windows)
                             actual_path = img_url
@@ -1,5 +1,7 @@
 from .knowledge.utils import normalize_key
-from .knowledge.canonical_store import CanonicalStore
+from .knowledge.canonical_store import CanonicalStore, canon_session, flush_session, get_canon
+from .knowledge.resolver import EntityResolver, resolver_for, resolver_from_names
+from .knowledge.traits import VisionTraitEngine, get_trait_engine
 from .knowledge.character_manager import CharacterManager
 from .knowledge.style_manager import StyleManager
 from .knowledge.scenery_manager import SceneryManager
@@ -8,6 +10,14 @@ from .knowledge.manager import KnowledgeManager
 __all__ = [
     'normalize_key',
     'CanonicalStore',
+    'get_canon',
+    'canon_session',
+    'flush_session',
+    'EntityResolver',
+    'resolver_for',
+    'resolver_from_names',
+    'VisionTraitEngine',
+    'get_trait_engine',
     'CharacterManager',
     'StyleManager',
     'SceneryManager',
@@ -1,5 +1,7 @@
 from .utils import normalize_key
-from .canonical_store import CanonicalStore
+from .canonical_store import CanonicalStore, canon_session, flush_session, get_canon
+from .resolver import EntityResolver, resolver_for, resolver_from_names
+from .traits import VisionTraitEngine, get_trait_engine
 from .character_manager import CharacterManager
 from .style_manager import StyleManager
 from .scenery_manager import SceneryManager
@@ -8,6 +10,14 @@ from .manager import KnowledgeManager
 __all__ = [
     'normalize_key',
     'CanonicalStore',
+    'get_canon',
+    'canon_session',
+    'flush_session',
+    'EntityResolver',
+    'resolver_for',
+    'resolver_from_names',
+    'VisionTraitEngine',
+    'get_trait_engine',
     'CharacterManager',
     'StyleManager',
     'SceneryManager',
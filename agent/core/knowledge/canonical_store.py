@@ -1,77 +1,198 @@
 import os
 import json
-import boto3
+import time
+import random
+import threading
+import contextvars
+from collections import OrderedDict
 from contextlib import contextmanager
 from typing import Dict
 from .utils import normalize_key
+from .. import metrics
+from ..storage import NotFound, PreconditionFailed, get_storage
 from ..telemetry import timed_function
 
+def _empty_canon() -> Dict:
+    return {
+        "characters": {},
+        "sceneries": {},
+        "style": {},
+        "continuity": {},
+        "metadata": { "original_keys": {} }
+    }
+
 class CanonicalStore:
-    """Agent B: Canonical Builder - Maintains the 'Official Truth' of the project in S3."""
+    """
+    Agent B: Canonical Builder - Maintains the 'Official Truth' of the project in storage.
+
+    Writes are optimistic: every save is a conditional put against the etag
+    the canon was loaded (or last saved) with. If another run wrote the canon
+    in between, the updates not yet stored are replayed on top of the newer
+    version and the save is retried (CANON_WRITE_RETRIES). With autosave,
+    updates are coalesced into at most one put per CANON_FLUSH_INTERVAL seconds.
+    """
     def __init__(self, project_id: str):
         self.project_id = project_id
         self.bucket_name = os.getenv("AWS_STORAGE_BUCKET_NAME")
         self.s3_key = f"projects/{project_id}/canon/canon.json"
-        
-        self.s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION")
-        )
+        self.storage = get_storage()
         self.autosave = True
+        self.flush_interval = max(0.0, float(os.getenv("CANON_FLUSH_INTERVAL", "1.0")))
+        self.write_retries = max(0, int(os.getenv("CANON_WRITE_RETRIES", "5")))
+        self.etag = None
         self._dirty = False
+        # Updates applied to self.data but not stored yet: (section, norm_key, display_name, info)
+        self._pending = []
+        self._last_save = 0.0
+        self._timer = None
+        # Los nodos comparten la instancia (get_canon) y algunos la actualizan desde hilos
+        self._lock = threading.RLock()
+        # Incrementa con cada cambio de self.data (propio o de otro escritor)
+        self.version = 0
+        # Indexes derived from self.data (resolvers, prompt segments), rebuilt when version moves
+        self._indexes = {}
+        # Version of the last local update per (section, key), and of the last (re)load
+        self._changed_at = {}
+        self._reloaded_at = 0
+        # Solo cambia si aparece una entidad o cambia un nombre visible (índices de nombres, resolver)
+        self.names_version = 0
         self.data = self._load()
 
+    @staticmethod
+    def _parse(body: bytes) -> Dict:
+        data = json.loads(body.decode('utf-8'))
+        if "metadata" not in data:
+            data["metadata"] = {"original_keys": {}}
+        return data
+
+    @staticmethod
+    def _apply(data: Dict, update):
+        section, norm_key, name, info = update
+        if section == "style":
+            data.setdefault("style", {}).update(info)
+            return
+        data.setdefault("metadata", {}).setdefault("original_keys", {})[norm_key] = name # Save display name
+        data.setdefault(section, {}).setdefault(norm_key, {}).update(info)
+
     @timed_function("canon.load")
     def _load(self) -> Dict:
         try:
-            print(f"Loading canon from S3: s3://{self.bucket_name}/{self.s3_key}")
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.s3_key)
-            data = json.loads(response['Body'].read().decode('utf-8'))
-            if "metadata" not in data:
-                data["metadata"] = {"original_keys": {}}
+            print(f"Loading canon from {self.storage.name}: {self.storage.uri(self.s3_key)}")
+            stored = self.storage.get(self.s3_key)
+            data = self._parse(stored.data)
+            self.etag = stored.etag
+            metrics.increment("comic_agent_canon_reads_total", result="loaded")
             return data
-        except self.s3.exceptions.NoSuchKey:
-            print("Canon not found in S3, initializing new one.")
-            return {
-                "characters": {},
-                "sceneries": {},
-                "style": {},
-                "continuity": {},
-                "metadata": { "original_keys": {} }
-            }
+        except NotFound:
+            print("Canon not found in storage, initializing new one.")
+            return _empty_canon()
         except Exception as e:
-            print(f"Error loading canon from S3: {e}")
-            return {
-                "characters": {},
-                "sceneries": {},
-                "style": {},
-                "continuity": {},
-                "metadata": { "original_keys": {} }
-            }
+            print(f"Error loading canon from storage: {e}")
+            return _empty_canon()
+
+    def _rebase(self, stored):
+        """Adopts a newer stored canon and replays the pending updates on top of it."""
+        data = self._parse(stored.data) if stored is not None else _empty_canon()
+        for update in self._pending:
+            self._apply(data, update)
+        self.data = data
+        self.etag = stored.etag if stored is not None else None
+        self.version += 1
+        self._reloaded_at = self.version
+        self.names_version += 1
+
+    @timed_function("canon.revalidate")
+    def revalidate(self) -> bool:
+        """
+        Conditional GET against the stored canon: reloads it only if another
+        writer changed it since it was loaded (pending local updates are
+        replayed on top). Returns True if the data was replaced.
+        """
+        with self._lock:
+            try:
+                stored = self.storage.get_if_changed(self.s3_key, self.etag)
+            except NotFound:
+                return False
+            except Exception as e:
+                print(f"WARNING: could not revalidate canon {self.s3_key}: {e}")
+                return False
+            if stored is None:
+                metrics.increment("comic_agent_canon_reads_total", result="not_modified")
+                return False
+            self._rebase(stored)
+            metrics.increment("comic_agent_canon_reads_total", result="reloaded")
+            print(f"DEBUG: Canon {self.s3_key} changed in storage, reloaded.")
+            return True
 
     @timed_function("canon.save")
-    def save(self):
-        try:
-            print(f"Saving canon to S3: s3://{self.bucket_name}/{self.s3_key}")
-            self.s3.put_object(
-                Bucket=self.bucket_name,
-                Key=self.s3_key,
-                Body=json.dumps(self.data, indent=4, ensure_ascii=False),
-                ContentType='application/json; charset=utf-8'
-            )
-            self._dirty = False
-        except Exception as e:
-            print(f"Error saving canon to S3: {e}")
+    def save(self) -> bool:
+        with self._lock:
+            self._cancel_timer()
+            for attempt in range(self.write_retries + 1):
+                body = json.dumps(self.data, indent=4, ensure_ascii=False).encode('utf-8')
+                try:
+                    print(f"Saving canon to {self.storage.name}: {self.storage.uri(self.s3_key)}")
+                    etag = self.storage.put(
+                        self.s3_key, body, content_type='application/json; charset=utf-8',
+                        if_match=self.etag, if_none_match=self.etag is None,
+                    )
+                except PreconditionFailed:
+                    metrics.increment("comic_agent_canon_writes_total", result="conflict")
+                    if attempt == self.write_retries:
+                        print(f"ERROR: canon {self.s3_key} still conflicting after {attempt + 1} attempts, not saved.")
+                        return False
+                    print(f"DEBUG: Canon {self.s3_key} changed concurrently, merging {len(self._pending)} pending updates.")
+                    try:
+                        stored = self.storage.get(self.s3_key)
+                    except NotFound:
+                        stored = None
+                    self._rebase(stored)
+                    # Backoff con jitter para no chocar otra vez con el mismo escritor
+                    time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+                    continue
+                except Exception as e:
+                    metrics.increment("comic_agent_canon_writes_total", result="error")
+                    print(f"Error saving canon to storage: {e}")
+                    return False
+                self.etag = etag
+                self._pending.clear()
+                self._dirty = False
+                self._last_save = time.monotonic()
+                metrics.increment("comic_agent_canon_writes_total", result="ok")
+                return True
+        return False
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _deferred_save(self):
+        with self._lock:
+            self._timer = None
+            if self._dirty:
+                self.save()
 
     def _mark_dirty(self):
         self._dirty = True
-        if self.autosave:
-            self.save()
+        pending = _session.get()
+        if pending is not None:
+            # Dentro de canon_session() se guarda una sola vez al final de la ejecución
+            pending.add(self)
+            return
+        if not self.autosave:
+            return
+        with self._lock:
+            wait = self._last_save + self.flush_interval - time.monotonic()
+            if wait <= 0:
+                self.save()
+            elif self._timer is None:
+                # Coalesce: las actualizaciones dentro del intervalo salen en un único put
+                self._timer = threading.Timer(wait, self._deferred_save)
+                self._timer.start()
 
     def flush(self):
-        if self._dirty:
+        if self._dirty and _session.get() is None:
             self.save()
 
     @contextmanager
@@ -85,26 +206,130 @@ class CanonicalStore:
             if self.autosave:
                 self.flush()
 
-    def update_character(self, name: str, info: Dict):
-        norm_key = normalize_key(name)
-        if "metadata" not in self.data: self.data["metadata"] = {"original_keys": {}}
-        self.data["metadata"]["original_keys"][norm_key] = name # Save display name
-        
-        if norm_key not in self.data["characters"]:
-            self.data["characters"][norm_key] = {}
-        self.data["characters"][norm_key].update(info)
+    def _update(self, update):
+        with self._lock:
+            section, norm_key, name, _ = update
+            if section != "style" and (
+                norm_key not in self.data.get(section, {})
+                or self.data.get("metadata", {}).get("original_keys", {}).get(norm_key) != name
+            ):
+                self.names_version += 1
+            self._apply(self.data, update)
+            self._pending.append(update)
+            self.version += 1
+            self._changed_at[(update[0], update[1])] = self.version
         self._mark_dirty()
 
+    def entity_cached(self, kind: str, section: str, key, build):
+        """
+        Value derived from one entity (kind = what is derived, e.g. "segment"),
+        reused until that entity is updated or the canon is reloaded. `key` is
+        None for the style section.
+        """
+        with self._lock:
+            entry = self._indexes.get((kind, section, key))
+            built_at = self.version
+            if entry is not None and entry[0] >= max(self._reloaded_at, self._changed_at.get((section, key), 0)):
+                return entry[1]
+        # Fuera del lock: en el layout sharded build() puede descargar el shard
+        value = build()
+        with self._lock:
+            self._indexes[(kind, section, key)] = (built_at, value)
+        return value
+
+    def update_character(self, name: str, info: Dict):
+        self._update(("characters", normalize_key(name), name, dict(info)))
+
     def update_style(self, style_info: Dict):
-        self.data["style"].update(style_info)
-        self._mark_dirty()
+        self._update(("style", None, None, dict(style_info)))
 
     def update_scenery(self, name: str, info: Dict):
-        norm_key = normalize_key(name)
-        if "metadata" not in self.data: self.data["metadata"] = {"original_keys": {}}
-        self.data["metadata"]["original_keys"][norm_key] = name # Save display name
+        self._update(("sceneries", normalize_key(name), name, dict(info)))
 
-        if norm_key not in self.data["sceneries"]:
-            self.data["sceneries"][norm_key] = {}
-        self.data["sceneries"][norm_key].update(info)
-        self._mark_dirty()
+
+# Per-process registry: world_model_builder, planner, PromptBuilder, ContinuitySupervisor and
+# StyleManager share one loaded canon per project instead of downloading it on every construction.
+_registry: "OrderedDict[str, CanonicalStore]" = OrderedDict()
+_registry_lock = threading.Lock()
+# Stores modified inside the current canon_session() (None = no session: autosave as before)
+_session: contextvars.ContextVar = contextvars.ContextVar("comic_agent_canon_session", default=None)
+
+
+def _registry_enabled() -> bool:
+    return os.getenv("ENABLE_CANON_REGISTRY", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def _evict_locked():
+    limit = max(1, int(os.getenv("CANON_REGISTRY_SIZE", "32")))
+    for project_id in list(_registry.keys()):
+        if len(_registry) <= limit:
+            break
+        # Un canon con cambios sin guardar no se descarta
+        if not _registry[project_id]._dirty:
+            del _registry[project_id]
+
+
+def _canon_class():
+    """CANON_LAYOUT=sharded (default): manifest + one shard per entity; single: the whole canon in canon.json."""
+    if os.getenv("CANON_LAYOUT", "sharded").strip().lower() == "single":
+        return CanonicalStore
+    from .sharded_store import ShardedCanonicalStore
+    return ShardedCanonicalStore
+
+
+def get_canon(project_id: str) -> CanonicalStore:
+    """
+    Shared CanonicalStore for the project. The first call loads it; later calls
+    return the same instance after an ETag revalidation (no download when unchanged).
+    """
+    project_id = str(project_id)
+    if not _registry_enabled():
+        return _canon_class()(project_id)
+
+    with _registry_lock:
+        store = _registry.get(project_id)
+        if store is not None:
+            _registry.move_to_end(project_id)
+    if store is not None:
+        store.revalidate()
+        return store
+
+    store = _canon_class()(project_id)
+    with _registry_lock:
+        # Otro hilo pudo cargarlo a la vez: se queda la primera instancia registrada
+        store = _registry.setdefault(project_id, store)
+        _evict_locked()
+    return store
+
+
+def flush_session():
+    """Saves every canon modified so far in the current canon_session()."""
+    pending = _session.get()
+    if not pending:
+        return
+    for store in list(pending):
+        if store._dirty:
+            store.save()
+
+
+@contextmanager
+def canon_session():
+    """
+    Defers canon writes for one agent run: updates only mark the canon dirty
+    and each modified canon is written once when the session ends (or at
+    flush_session()). Nested sessions join the outer one.
+    """
+    if _session.get() is not None:
+        yield
+        return
+    token = _session.set(set())
+    try:
+        yield
+    finally:
+        flush_session()
+        _session.reset(token)
+
+
+def clear_registry():
+    with _registry_lock:
+        _registry.clear()
@@ -24,28 +24,18 @@ class KnowledgeManager:
     @timed_function("knowledge.download_s3")
     def _download_from_s3(self, s3_url: str):
         """Descarga un archivo de S3 a un directorio temporal y retorna la ruta local"""
-        import boto3
-        from urllib.parse import urlparse
-        
-        parsed = urlparse(s3_url)
-        bucket = parsed.netloc
-        key = parsed.path.lstrip('/')
-        
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION")
-        )
-        
+        from ..storage import get_storage, split_location
+
+        storage = get_storage()
+        bucket, key = split_location(s3_url)
         local_path = self._build_cached_path(s3_url, key)
         if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
             print(f"DEBUG: Reusing cached S3 download: {local_path}")
             return local_path
         
         print(f"Downloading {s3_url} to {local_path}...")
-        s3.download_file(bucket, key, local_path)
-        return local_path
+        # Con almacenamiento local devuelve la ruta del propio objeto (sin copia)
+        return storage.local_path(key, local_path, bucket=bucket)
 
     @timed_function("knowledge.download_http")
     def _download_from_http(self, url: str):
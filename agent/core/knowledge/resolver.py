@@ -0,0 +1,148 @@
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+from .utils import normalize_key
+
+# Minimum Dice coefficient over character trigrams for a fuzzy match
+FUZZY_THRESHOLD = 0.7
+
+
+def _tokens(name: str) -> Tuple[str, ...]:
+    """Lowercase ASCII words of a name ('Dr. Ána-Ruiz' -> ('dr', 'ana', 'ruiz'))."""
+    text = unicodedata.normalize('NFD', name or "").encode('ascii', 'ignore').decode('utf-8').lower()
+    return tuple(re.findall(r"[a-z0-9]+", text))
+
+
+def _trigrams(folded: str) -> set:
+    padded = f"  {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class EntityResolver:
+    """
+    Name -> entity key index over one canon section (or any key -> display name map).
+
+    Lookup order, first unique hit wins:
+      1. exact key (as given or through normalize_key)
+      2. alias: accent/case/spacing-insensitive form of the key or the display name
+      3. words: every word of the name is a word of exactly one entity, or one
+         entity's words are all in the name ('Ana' -> 'Detective Ana Ruiz')
+      4. fuzzy: best trigram similarity >= FUZZY_THRESHOLD, strictly better than the runner-up
+
+    Ambiguous names (several entities at the same step) resolve to None instead
+    of to whichever entity comes first. Results are memoized per name.
+    """
+
+    def __init__(self, names: Dict[str, str], version: int = 0):
+        self.version = version
+        self._keys = {key: names[key] or key for key in sorted(names)}
+        self._aliases: Dict[str, set] = defaultdict(set)
+        self._words: Dict[str, set] = defaultdict(set)
+        self._key_words: Dict[str, set] = {}
+        self._trigram_index: Dict[str, set] = defaultdict(set)
+        self._key_trigrams: Dict[str, set] = {}
+        self._memo: Dict[str, Optional[str]] = {}
+
+        for key, display_name in self._keys.items():
+            words = set(_tokens(display_name)) | set(_tokens(key))
+            self._key_words[key] = set(_tokens(display_name)) or set(_tokens(key))
+            for word in words:
+                self._words[word].add(key)
+            for alias in {"".join(_tokens(key)), "".join(_tokens(display_name))} - {""}:
+                self._aliases[alias].add(key)
+            grams = _trigrams("".join(_tokens(display_name)) or "".join(_tokens(key)))
+            self._key_trigrams[key] = grams
+            for gram in grams:
+                self._trigram_index[gram].add(key)
+
+    def __contains__(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def resolve(self, name: str) -> Optional[str]:
+        """Entity key for `name`, None if unknown or ambiguous."""
+        if not name:
+            return None
+        if name in self._keys:
+            return name
+        if name in self._memo:
+            return self._memo[name]
+        key = self._lookup(name)
+        self._memo[name] = key
+        return key
+
+    def display_name(self, key: str) -> str:
+        return self._keys.get(key, key)
+
+    def _lookup(self, name: str) -> Optional[str]:
+        norm = normalize_key(name)
+        if norm in self._keys:
+            return norm
+
+        tokens = _tokens(name)
+        folded = "".join(tokens)
+        if not folded:
+            return None
+        candidates = self._aliases.get(folded) or self._by_words(set(tokens))
+        if candidates:
+            # Varias entidades con ese alias o esas palabras: ambiguo, mejor ninguna que la primera
+            return next(iter(candidates)) if len(candidates) == 1 else None
+        return self._by_trigrams(folded)
+
+    def _by_words(self, words: set) -> set:
+        # El nombre es parte del de alguna entidad
+        contained = None
+        for word in words:
+            keys = self._words.get(word, set())
+            contained = set(keys) if contained is None else contained & keys
+            if not contained:
+                break
+        if contained:
+            return contained
+
+        # El nombre de alguna entidad está dentro del nombre buscado
+        return {
+            key for word in words for key in self._words.get(word, ())
+            if self._key_words[key] and self._key_words[key] <= words
+        }
+
+    def _by_trigrams(self, folded: str) -> Optional[str]:
+        grams = _trigrams(folded)
+        shared = defaultdict(int)
+        for gram in grams:
+            for key in self._trigram_index.get(gram, ()):
+                shared[key] += 1
+        if not shared:
+            return None
+        scored = sorted(
+            ((2.0 * count / (len(grams) + len(self._key_trigrams[key])), key) for key, count in shared.items()),
+            key=lambda item: (-item[0], item[1]),
+        )
+        best_score, best_key = scored[0]
+        if best_score < FUZZY_THRESHOLD:
+            return None
+        if len(scored) > 1 and scored[1][0] == best_score:
+            return None
+        return best_key
+
+
+def resolver_for(canon, section: str) -> EntityResolver:
+    """
+    Resolver over a canon section, rebuilt only when an entity was added or
+    renamed (canon.names_version): trait/description updates keep the index.
+    """
+    with canon._lock:
+        resolver = canon._indexes.get(("resolver", section))
+        if resolver is not None and resolver.version == canon.names_version:
+            return resolver
+        original_keys = canon.data.get("metadata", {}).get("original_keys", {})
+        # Solo las keys: en el layout sharded no se descarga ningún shard
+        names = {key: original_keys.get(key, key) for key in canon.data.get(section, {})}
+        resolver = EntityResolver(names, version=canon.names_version)
+        canon._indexes[("resolver", section)] = resolver
+        return resolver
+
+
+def resolver_from_names(names: Iterable[str]) -> EntityResolver:
+    """Resolver over plain names (e.g. the backend's assets): resolve() returns the name itself."""
+    return EntityResolver({name: name for name in names})
@@ -0,0 +1,331 @@
+"""
+Sharded canon layout.
+
+    projects/{id}/canon/manifest.json               style, continuity, display names, entity revisions
+    projects/{id}/canon/characters/{key}.json       one document per character
+    projects/{id}/canon/sceneries/{key}.json        one document per scenery
+
+Everything is stored as compact JSON. Entity shards are read lazily, on first
+access; a save only writes the shards touched since the last save, then the
+manifest. The manifest is the commit point: it carries a revision per entity,
+so revalidation stays a single conditional GET and only the shards whose
+revision moved are re-read.
+
+Shards and manifest are both written with conditional puts. A conflicting
+shard is re-read and the pending updates for that entity are replayed on top;
+a conflicting manifest is merged (entity sets, revisions, style and display
+names) and the commit retried, the same merge-and-retry the single-document
+layout uses.
+
+A project that only has the legacy ``canon.json`` is read from it, and
+migrated (every entity shard plus the manifest) on its first save.
+"""
+import json
+import time
+import random
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+from .canonical_store import CanonicalStore, _empty_canon
+from .. import metrics
+from ..storage import NotFound, PreconditionFailed
+from ..telemetry import timed_function
+
+SECTIONS = ("characters", "sceneries")
+MANIFEST_FORMAT = 2
+# Parallel shard reads / writes per canon
+SHARD_IO_WORKERS = 8
+
+
+def _compact(document) -> bytes:
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class _ShardMap(MutableMapping):
+    """One canon section (characters / sceneries): entity keys known up front, documents loaded on access."""
+
+    def __init__(self, store: "ShardedCanonicalStore", section: str, keys=(), loaded: Optional[Dict] = None):
+        self._store = store
+        self._section = section
+        self._keys = dict.fromkeys(keys)   # ordered set
+        self._loaded = dict(loaded or {})
+        self._etags = {}
+        self._stale = set()
+        self._keys.update(dict.fromkeys(self._loaded))
+
+    def _needs_read(self, key) -> bool:
+        return key not in self._loaded or key in self._stale
+
+    def _read(self, key):
+        """Reads one shard (conditionally if a copy is cached) and caches it."""
+        cached_etag = self._etags.get(key) if key in self._loaded else None
+        stored = self._store._read_shard(self._section, key, cached_etag)
+        with self._store._lock:
+            if self._needs_read(key):
+                if stored is not None:
+                    self._loaded[key] = stored[0]
+                    self._etags[key] = stored[1]
+                self._stale.discard(key)
+            return self._loaded.setdefault(key, {})
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if self._needs_read(key):
+            return self._read(key)
+        return self._loaded[key]
+
+    def __setitem__(self, key, value):
+        self._keys[key] = None
+        self._loaded[key] = value
+        self._stale.discard(key)
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._loaded.pop(key, None)
+        self._etags.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def prefetch(self, keys=None):
+        """Loads the given (default: all) shards in parallel."""
+        missing = [k for k in (self._keys if keys is None else keys) if k in self._keys and self._needs_read(k)]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(SHARD_IO_WORKERS, len(missing)), thread_name_prefix="canon-shard") as pool:
+                list(pool.map(self._read, missing))
+        elif missing:
+            self._read(missing[0])
+
+    def items(self):
+        self.prefetch()
+        return [(k, self._loaded.get(k, {})) for k in list(self._keys)]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def to_dict(self) -> Dict:
+        return dict(self.items())
+
+
+class ShardedCanonicalStore(CanonicalStore):
+    """CanonicalStore over a manifest plus one shard per character / scenery."""
+
+    def __init__(self, project_id: str):
+        self.manifest_key = f"projects/{project_id}/canon/manifest.json"
+        self.legacy_key = f"projects/{project_id}/canon/canon.json"
+        # Revisión de cada entidad según el último manifest leído o escrito
+        self._revisions = {section: {} for section in SECTIONS}
+        # Shards to write on the next save even without pending updates (legacy migration)
+        self._touched = set()
+        super().__init__(project_id)
+        self.s3_key = self.manifest_key
+
+    def _shard_key(self, section: str, key: str) -> str:
+        return f"projects/{self.project_id}/canon/{section}/{key or '_'}.json"
+
+    def _read_shard(self, section, key, etag=None):
+        """(document, etag) of a shard, None if unchanged since `etag`; a missing shard reads as {}."""
+        try:
+            stored = self.storage.get_if_changed(self._shard_key(section, key), etag)
+        except NotFound:
+            print(f"WARNING: canon shard {section}/{key} listed in the manifest but missing.")
+            return {}, None
+        if stored is None:
+            return None
+        metrics.increment("comic_agent_canon_reads_total", result="shard")
+        return json.loads(stored.data.decode("utf-8")), stored.etag
+
+    # -- load / merge -------------------------------------------------------
+
+    def _data_from_manifest(self, manifest: Dict) -> Dict:
+        for section in SECTIONS:
+            self._revisions[section] = dict(manifest.get(section, {}))
+        return {
+            "characters": _ShardMap(self, "characters", manifest.get("characters", {})),
+            "sceneries": _ShardMap(self, "sceneries", manifest.get("sceneries", {})),
+            "style": manifest.get("style", {}),
+            "continuity": manifest.get("continuity", {}),
+            "metadata": manifest.get("metadata") or {"original_keys": {}},
+        }
+
+    def _load_legacy(self) -> Dict:
+        stored = self.storage.get(self.legacy_key)
+        legacy = self._parse(stored.data)
+        print(f"DEBUG: Canon {self.legacy_key} uses the single-document layout; it will be sharded on the next save.")
+        data = {
+            "characters": _ShardMap(self, "characters", loaded=legacy.get("characters", {})),
+            "sceneries": _ShardMap(self, "sceneries", loaded=legacy.get("sceneries", {})),
+            "style": legacy.get("style", {}),
+            "continuity": legacy.get("continuity", {}),
+            "metadata": legacy.get("metadata") or {"original_keys": {}},
+        }
+        self._touched = {(section, key) for section in SECTIONS for key in data[section]}
+        return data
+
+    @timed_function("canon.load")
+    def _load(self) -> Dict:
+        try:
+            print(f"Loading canon manifest from {self.storage.name}: {self.storage.uri(self.manifest_key)}")
+            stored = self.storage.get(self.manifest_key)
+            data = self._data_from_manifest(json.loads(stored.data.decode("utf-8")))
+            self.etag = stored.etag
+            metrics.increment("comic_agent_canon_reads_total", result="loaded")
+            return data
+        except NotFound:
+            pass
+        except Exception as e:
+            print(f"Error loading canon manifest from storage: {e}")
+            return self._empty_data()
+        try:
+            return self._load_legacy()
+        except NotFound:
+            print("Canon not found in storage, initializing new one.")
+        except Exception as e:
+            print(f"Error loading canon from storage: {e}")
+        return self._empty_data()
+
+    def _empty_data(self) -> Dict:
+        data = _empty_canon()
+        for section in SECTIONS:
+            data[section] = _ShardMap(self, section)
+        return data
+
+    def _pending_keys(self):
+        return self._touched | {(u[0], u[1]) for u in self._pending if u[0] in SECTIONS}
+
+    def _rebase(self, stored):
+        """Merges a newer manifest: other writers' entities and revisions, our pending updates on top."""
+        if stored is None:
+            return
+        manifest = json.loads(stored.data.decode("utf-8"))
+        pending = self._pending_keys()
+        for section in SECTIONS:
+            shards = self.data[section]
+            remote = manifest.get(section, {})
+            for key, revision in remote.items():
+                if key not in shards:
+                    shards._keys[key] = None
+                elif (section, key) not in pending and revision != self._revisions[section].get(key):
+                    # Otro escritor cambió esta entidad: se relee en el próximo acceso
+                    shards._stale.add(key)
+            self._revisions[section] = dict(remote)
+        style = dict(manifest.get("style", {}))
+        for update in self._pending:
+            if update[0] == "style":
+                style.update(update[3])
+        self.data["style"] = style
+        self.data["continuity"] = manifest.get("continuity", {})
+        original_keys = dict((manifest.get("metadata") or {}).get("original_keys", {}))
+        for update in self._pending:
+            if update[0] in SECTIONS:
+                original_keys[update[1]] = update[2]
+        self.data["metadata"] = {**(manifest.get("metadata") or {}), "original_keys": original_keys}
+        self.etag = stored.etag
+        self.version += 1
+        self._reloaded_at = self.version
+        self.names_version += 1
+
+    # -- save ---------------------------------------------------------------
+
+    def _write_shard(self, section: str, key: str):
+        """Conditional put of one shard; on conflict re-reads it and replays this entity's pending updates."""
+        shards = self.data[section]
+        for attempt in range(self.write_retries + 1):
+            document = shards._loaded.setdefault(key, {})
+            known_etag = shards._etags.get(key)
+            try:
+                shards._etags[key] = self.storage.put(
+                    self._shard_key(section, key), _compact(document), content_type="application/json; charset=utf-8",
+                    if_match=known_etag, if_none_match=known_etag is None,
+                )
+                return
+            except PreconditionFailed:
+                metrics.increment("comic_agent_canon_writes_total", result="shard_conflict")
+                if attempt == self.write_retries:
+                    raise
+                try:
+                    stored = self.storage.get(self._shard_key(section, key))
+                    document, etag = json.loads(stored.data.decode("utf-8")), stored.etag
+                except NotFound:
+                    document, etag = {}, None
+                for update in self._pending:
+                    if update[0] == section and update[1] == key:
+                        document.update(update[3])
+                shards._loaded[key] = document
+                shards._etags[key] = etag
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+
+    def _manifest(self, touched) -> Dict:
+        manifest = {"format": MANIFEST_FORMAT}
+        for section in SECTIONS:
+            revisions = self._revisions[section]
+            manifest[section] = {
+                key: revisions.get(key, 0) + 1 if (section, key) in touched else revisions.get(key, 0)
+                for key in self.data[section]
+            }
+        manifest["style"] = self.data["style"]
+        manifest["continuity"] = self.data["continuity"]
+        manifest["metadata"] = self.data["metadata"]
+        return manifest
+
+    @timed_function("canon.save")
+    def save(self) -> bool:
+        with self._lock:
+            self._cancel_timer()
+            touched = sorted(self._pending_keys())
+            try:
+                if len(touched) > 1:
+                    with ThreadPoolExecutor(max_workers=min(SHARD_IO_WORKERS, len(touched)), thread_name_prefix="canon-shard") as pool:
+                        list(pool.map(lambda sk: self._write_shard(*sk), touched))
+                elif touched:
+                    self._write_shard(*touched[0])
+            except PreconditionFailed:
+                print(f"ERROR: canon shards of project {self.project_id} still conflicting, not saved.")
+                return False
+            except Exception as e:
+                metrics.increment("comic_agent_canon_writes_total", result="error")
+                print(f"Error saving canon shards to storage: {e}")
+                return False
+
+            touched = set(touched)
+            for attempt in range(self.write_retries + 1):
+                manifest = self._manifest(touched)
+                try:
+                    print(f"Saving canon manifest ({len(touched)} shards) to {self.storage.name}: "
+                          f"{self.storage.uri(self.manifest_key)}")
+                    etag = self.storage.put(
+                        self.manifest_key, _compact(manifest), content_type="application/json; charset=utf-8",
+                        if_match=self.etag, if_none_match=self.etag is None,
+                    )
+                except PreconditionFailed:
+                    metrics.increment("comic_agent_canon_writes_total", result="conflict")
+                    if attempt == self.write_retries:
+                        print(f"ERROR: canon {self.manifest_key} still conflicting after {attempt + 1} attempts, not saved.")
+                        return False
+                    try:
+                        self._rebase(self.storage.get(self.manifest_key))
+                    except NotFound:
+                        self.etag = None
+                    time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+                    continue
+                except Exception as e:
+                    metrics.increment("comic_agent_canon_writes_total", result="error")
+                    print(f"Error saving canon manifest to storage: {e}")
+                    return False
+                self.etag = etag
+                for section in SECTIONS:
+                    self._revisions[section] = dict(manifest[section])
+                self._pending.clear()
+                self._touched.clear()
+                self._dirty = False
+                self._last_save = time.monotonic()
+                metrics.increment("comic_agent_canon_writes_total", result="ok")
+                return True
+        return False
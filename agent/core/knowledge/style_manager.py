@@ -2,13 +2,13 @@ import json
 import os
 from typing import Optional
 from langchain_openai import ChatOpenAI
-from .canonical_store import CanonicalStore
+from .canonical_store import CanonicalStore, get_canon
 from ..telemetry import timed_function, timed_step
 
 class StyleManager:
     """Agent B component for managing visual rules and tokens."""
     def __init__(self, project_id: str, canon: Optional[CanonicalStore] = None):
-        self.canon = canon or CanonicalStore(project_id)
+        self.canon = canon or get_canon(project_id)
 
     @timed_function("style.normalize")
     def normalize_style(self, style_guide_text: str):
@@ -54,6 +54,9 @@ class StyleManager:
             print(f"Error normalizing style: {e}")
 
     def get_style_prompt(self):
+        return self.canon.entity_cached("segment", "style", None, self._compile_style_prompt)
+
+    def _compile_style_prompt(self) -> str:
         tokens = self.canon.data["style"].get("style_tokens", [])
         if tokens:
             return f"Art Style: {', '.join(tokens)}. Organic comic book aesthetic."
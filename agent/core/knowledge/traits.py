@@ -0,0 +1,343 @@
+"""
+Vision trait extraction shared by CharacterManager, SceneryManager and world_model_builder.
+
+- Reference images are fetched concurrently (storage for s3:// / ``projects/``
+  keys, HTTP otherwise) through one process-wide cache, so an image used by
+  several entities or runs is downloaded once.
+- Images are downscaled to TRAIT_IMAGE_MAX_SIDE pixels before base64: the
+  vision model does not need the full-resolution upload to describe traits.
+- Results are cached by (entity kind, sorted image content hashes,
+  PROMPT_VERSION). Two entities with the same reference set, or the same
+  image re-uploaded under another key, cost one vision call; concurrent
+  requests for the same key wait for the first one instead of repeating it.
+- The same results are persisted in storage under ``trait-cache/``, so they
+  survive restarts and FORCE_WORLD_TRAITS_REFRESH. TRAIT_CACHE_SCOPE decides
+  who shares them:
+
+      project (default)   trait-cache/projects/{project_id}/{kind}/v{PROMPT_VERSION}/{hash}.json
+      global              trait-cache/shared/{kind}/v{PROMPT_VERSION}/{hash}.json
+      off                 in-process cache only
+
+  ``trait-cache/`` is outside the prefixes swept by the backend storage GC.
+  To re-analyze images whose traits are cached, bump PROMPT_VERSION or use
+  TRAIT_CACHE_SCOPE=off.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import requests
+from langsmith import traceable
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import HumanMessage
+from .. import metrics
+from ..storage import NotFound, PreconditionFailed, get_storage, split_location
+from ..telemetry import submit_with_current_context, timed_function, timed_step
+
+# Bump when the prompts below change: cached traits from older prompts are not reused
+PROMPT_VERSION = 1
+
+PROMPTS = {
+    "character": """
+        Analiza {image_count_text} del personaje '{name}'.
+        Extrae rasgos visuales invariantes y detallados para incluirlos en prompts de generación de imágenes.
+        Enfócate en:
+        - Peinado y color de cabello (textura).
+        - Color de ojos y rasgos faciales (cicatrices, tatuajes, forma).
+        - Complexión física.
+        - Ropa base o accesorios característicos.
+        - Paleta de colores predominante.
+
+        Si hay múltiples imágenes, busca los rasgos que se mantienen CONSISTENTES entre todas ellas.
+
+        Responde en formato JSON:
+        {{"traits": ["pelirrojo con peinado despeinado", "ojo izquierdo plateado", "pequeña cicatriz en mejilla derecha", ...]}}
+        """,
+    "scenery": """
+        Analiza {image_count_text} del escenario '{name}'.
+        Extrae rasgos visuales invariantes y detallados para incluirlos en prompts de generación de imágenes.
+        Enfócate en:
+        - Arquitectura y estructura (ventanas, techos, materiales).
+        - Objetos clave y mobiliario fijo.
+        - Texturas predominantes (madera, metal, piedra).
+        - Esquema de iluminación habitual (fuentes de luz, sombras).
+        - Paleta de colores distintiva del lugar.
+
+        Si hay múltiples imágenes, busca los rasgos que se mantienen CONSISTENTES entre todas ellas.
+
+        Responde en formato JSON:
+        {{"traits": ["paredes de ladrillo visto", "gran ventana circular al fondo", "iluminación neón púrpura", ...]}}
+        """,
+}
+
+
+def _cache_scope() -> str:
+    scope = os.getenv("TRAIT_CACHE_SCOPE", "project").strip().lower()
+    return scope if scope in {"project", "global", "off"} else "project"
+
+
+def cache_namespace(project_id: Optional[str]) -> Optional[str]:
+    """Who may reuse a result: one project, or every project ("shared") with TRAIT_CACHE_SCOPE=global."""
+    if _cache_scope() == "global":
+        return "shared"
+    return f"projects/{project_id}" if project_id else None
+
+
+class TraitImage(NamedTuple):
+    digest: str      # sha256 of the original bytes
+    mime_type: str
+    b64: str         # downscaled payload sent to the model
+
+
+class _SharedCache:
+    """Thread-safe LRU bounded by total weight; concurrent loads of one key run the loader once."""
+
+    def __init__(self, max_weight: int, weigh=lambda value: 1):
+        self.max_weight = max_weight
+        self._weigh = weigh
+        self._entries = OrderedDict()
+        self._weight = 0
+        self._inflight: Dict[object, Future] = {}
+        self._lock = threading.Lock()
+
+    def _store_locked(self, key, value):
+        if key in self._entries:
+            self._weight -= self._weigh(self._entries.pop(key))
+        self._entries[key] = value
+        self._weight += self._weigh(value)
+        while self._weight > self.max_weight and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._weight -= self._weigh(evicted)
+
+    def get_or_load(self, key, loader):
+        """(value, hit). hit is False only for the caller that ran the loader."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key], True
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result(), True
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._store_locked(key, value)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value, False
+
+
+
+def _parse_traits(content: str) -> List[str]:
+    content = content.strip()
+    if "```json" in content:
+        content = content.split("```json")[1].split("```")[0].strip()
+    elif "```" in content:
+        content = content.split("```")[1].strip()
+
+    if "{" in content:
+        start = content.find("{")
+        end = content.rfind("}") + 1
+        content = content[start:end]
+
+    return json.loads(content).get("traits", [])
+
+
+class VisionTraitEngine:
+    """Fetches, downscales and analyzes reference images; see the module docstring."""
+
+    def __init__(self):
+        self.max_side = max(64, int(os.getenv("TRAIT_IMAGE_MAX_SIDE", "1024")))
+        self.fetch_workers = max(1, int(os.getenv("TRAIT_FETCH_CONCURRENCY", "4")))
+        self.images = _SharedCache(
+            max(1, int(float(os.getenv("TRAIT_IMAGE_CACHE_MB", "64")) * 1024 * 1024)),
+            weigh=lambda image: len(image.b64),
+        )
+        self.results = _SharedCache(max(1, int(os.getenv("TRAIT_RESULT_CACHE_SIZE", "512"))))
+
+    # -- images ---------------------------------------------------------------
+
+    @staticmethod
+    def _resolve_url(image_url: str) -> str:
+        # Robust handling of relative S3 paths (projects/...)
+        if not image_url.startswith(("http", "s3://")) and image_url.startswith("projects/"):
+            bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
+            if bucket:
+                return f"s3://{bucket}/{image_url}"
+        return image_url
+
+    @staticmethod
+    def _download(image_url: str) -> bytes:
+        if image_url.startswith("s3://"):
+            bucket, key = split_location(image_url)
+            return get_storage().read(key, bucket=bucket)
+        print(f"DEBUG: Downloading image from URL: {image_url[:80]}...")
+        r = requests.get(image_url, timeout=30)
+        r.raise_for_status()
+        return r.content
+
+    def _downscale(self, data: bytes, image_url: str):
+        """(mime_type, bytes) no larger than max_side on either axis."""
+        from PIL import Image
+
+        ext = os.path.splitext(image_url.split('?')[0])[1].lower()
+        fallback_mime = "image/jpeg" if ext in ['.jpg', '.jpeg', '.jfif'] else "image/png"
+        try:
+            img = Image.open(io.BytesIO(data))
+            img_format = img.format
+            if max(img.size) <= self.max_side and img_format in ("JPEG", "PNG"):
+                return f"image/{img_format.lower()}", data
+            img.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            if img.mode in ("RGBA", "LA", "P"):
+                img.save(buffer, format="PNG", optimize=True)
+                return "image/png", buffer.getvalue()
+            img.convert("RGB").save(buffer, format="JPEG", quality=90)
+            return "image/jpeg", buffer.getvalue()
+        except Exception as e:
+            print(f"WARNING: could not downscale {image_url[:80]} ({e}), sending it as is.")
+            return fallback_mime, data
+
+    def _load_image(self, image_url: str) -> TraitImage:
+        data = self._download(image_url)
+        mime_type, payload = self._downscale(data, image_url)
+        return TraitImage(hashlib.sha256(data).hexdigest(), mime_type, base64.b64encode(payload).decode("utf-8"))
+
+    def fetch_image(self, image_url: str) -> TraitImage:
+        image_url = self._resolve_url(image_url)
+        image, hit = self.images.get_or_load(image_url, lambda: self._load_image(image_url))
+        metrics.increment("comic_agent_trait_images_total", result="hit" if hit else "fetched")
+        return image
+
+    @timed_function("traits.fetch_images")
+    def fetch_images(self, image_urls: Sequence[str]) -> List[TraitImage]:
+        unique_urls = list(dict.fromkeys(u for u in image_urls if u))
+        if len(unique_urls) <= 1 or self.fetch_workers <= 1:
+            return [self.fetch_image(u) for u in unique_urls]
+        with ThreadPoolExecutor(max_workers=min(self.fetch_workers, len(unique_urls)), thread_name_prefix="trait-fetch") as pool:
+            futures = [submit_with_current_context(pool, self.fetch_image, u) for u in unique_urls]
+            return [f.result() for f in futures]
+
+    # -- analysis -------------------------------------------------------------
+
+    @staticmethod
+    def cache_key(kind: str, images: Sequence[TraitImage], namespace: Optional[str] = None):
+        return (namespace, kind, tuple(sorted({image.digest for image in images})), PROMPT_VERSION)
+
+    @staticmethod
+    def storage_key(cache_key) -> Optional[str]:
+        namespace, kind, digests, prompt_version = cache_key
+        if namespace is None or _cache_scope() == "off":
+            return None
+        image_set = hashlib.sha256("\n".join(digests).encode("utf-8")).hexdigest()
+        return f"trait-cache/{namespace}/{kind}/v{prompt_version}/{image_set}.json"
+
+    def _stored_or_invoke(self, cache_key, name: str, images: Sequence[TraitImage]):
+        """(traits, source): the persisted result for this image set, or a fresh vision call (then persisted)."""
+        kind = cache_key[1]
+        storage_key = self.storage_key(cache_key)
+        if storage_key:
+            try:
+                return json.loads(get_storage().read(storage_key).decode("utf-8"))["traits"], "stored"
+            except NotFound:
+                pass
+            except Exception as e:
+                print(f"WARNING: unreadable trait cache entry {storage_key}: {e}")
+
+        traits = self._invoke(kind, name, images)
+        if storage_key and traits:
+            document = {"kind": kind, "prompt_version": PROMPT_VERSION, "images": list(cache_key[2]), "traits": traits}
+            try:
+                get_storage().put(
+                    storage_key, json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                    content_type="application/json; charset=utf-8", if_none_match=True,
+                )
+            except PreconditionFailed:
+                pass  # Otro proceso analizó el mismo conjunto a la vez: vale cualquiera de los dos
+            except Exception as e:
+                print(f"WARNING: could not store trait cache entry {storage_key}: {e}")
+        return traits, "analyzed"
+
+    def _invoke(self, kind: str, name: str, images: Sequence[TraitImage]) -> List[str]:
+        llm = ChatGoogleGenerativeAI(model=os.getenv("GEMINI_MODEL_ID_TEXT"), temperature=0)
+        image_count_text = "esta imagen de referencia" if len(images) == 1 else f"estas {len(images)} imágenes de referencia"
+        content_parts = [{"type": "text", "text": PROMPTS[kind].format(image_count_text=image_count_text, name=name)}]
+        for image in images:
+            content_parts.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{image.mime_type};base64,{image.b64}"},
+            })
+
+        print(f"DEBUG: Invoking Gemini Vision for {kind} {name} with {len(images)} images...")
+        with timed_step(f"traits.llm_invoke[{name}]"):
+            response = llm.invoke([HumanMessage(content=content_parts)])
+        return _parse_traits(response.content)
+
+    @traceable(name="vision_trait_analysis", project_name=os.getenv("LANGCHAIN_PROJECT", "comic-draft-ai"))
+    @timed_function("traits.analyze")
+    def analyze(self, kind: str, name: str, image_urls: Sequence[str], project_id: Optional[str] = None) -> List[str]:
+        """Visual traits of one character / scenery from its reference images (raises on failure)."""
+        if kind not in PROMPTS:
+            raise ValueError(f"Unknown trait kind: {kind}")
+        if not image_urls:
+            return []
+        images = self.fetch_images(image_urls)
+        key = self.cache_key(kind, images, cache_namespace(project_id))
+        (traits, source), hit = self.results.get_or_load(key, lambda: self._stored_or_invoke(key, name, images))
+        source = "hit" if hit else source
+        metrics.increment("comic_agent_trait_results_total", kind=kind, result=source)
+        if source != "analyzed":
+            print(f"DEBUG: Reusing cached traits for {kind} '{name}' (same reference images, {source}).")
+        return list(traits)
+
+    def analyze_many(self, jobs: Sequence[Dict], max_workers: int = 1, project_id: Optional[str] = None) -> List[Dict]:
+        """
+        Batch API: jobs are {"kind", "name", "image_urls"} dicts; returns them
+        in the same order with "traits" set (None if that job failed).
+        """
+        def run(job):
+            try:
+                return {**job, "traits": self.analyze(job["kind"], job["name"], job["image_urls"], project_id=project_id)}
+            except Exception as trait_error:
+                print(f"WARNING: Trait job failed for {job['kind']} '{job['name']}': {trait_error}")
+                return {**job, "traits": None}
+
+        if max_workers <= 1 or len(jobs) <= 1:
+            return [run(job) for job in jobs]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs)), thread_name_prefix="world-traits") as pool:
+            futures = [submit_with_current_context(pool, run, job) for job in jobs]
+            return [f.result() for f in futures]
+
+
+_engine: Optional[VisionTraitEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_trait_engine() -> VisionTraitEngine:
+    """Process-wide engine: one image cache for every project, results shared per TRAIT_CACHE_SCOPE."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = VisionTraitEngine()
+        return _engine
+
+
+def reset_trait_engine():
+    """Drops the engine and its in-process caches; the next one re-reads the TRAIT_* settings."""
+    global _engine
+    with _engine_lock:
+        _engine = None
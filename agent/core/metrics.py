@@ -0,0 +1,282 @@
+"""
+In-process metrics registry fed by ``telemetry.timed_step``.
+
+Every timed step is recorded as a histogram observation and a counter
+(``comic_agent_step_seconds`` / ``comic_agent_step_total``) labelled with the
+step name. Per-item suffixes such as ``image_generator.render_new[12]`` are
+stripped from the label so panel ids, page numbers or character names never
+create new series; each metric is additionally capped at ``MAX_SERIES`` label
+sets (the overflow is folded into ``step="other"``).
+
+``collect_run()`` scopes a per-invocation aggregate (through a context
+variable, so threads started with ``submit_with_current_context`` report to the
+same run); its ``summary()`` is attached to the result sent to the backend.
+
+Exporters: ``to_prometheus()`` (text exposition format) and ``to_json()``; with
+``COMIC_AGENT_METRICS_DIR`` set both are written to disk after every run
+(``metrics.prom`` works with node_exporter's textfile collector).
+
+``COMIC_AGENT_METRICS=0`` disables everything: ``timed_step`` then does not
+touch the registry at all.
+"""
+import contextvars
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+
+def _env_enabled(name: str, default: str = "1") -> bool:
+    value = os.getenv(name, default)
+    return str(value).strip().lower() not in {"0", "false", "no", "off"}
+
+
+ENABLED = _env_enabled("COMIC_AGENT_METRICS", "1")
+EXPORT_DIR = os.getenv("COMIC_AGENT_METRICS_DIR", "")
+
+
+def configure():
+    global ENABLED, EXPORT_DIR
+    ENABLED = _env_enabled("COMIC_AGENT_METRICS", "1")
+    EXPORT_DIR = os.getenv("COMIC_AGENT_METRICS_DIR", "")
+
+# Distinct label sets kept per metric before folding into "other"
+MAX_SERIES = 200
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_current_run: contextvars.ContextVar = contextvars.ContextVar("comic_agent_run_metrics", default=None)
+
+
+def step_name(label: str) -> str:
+    """Bounded step name: 'image_generator.render_new[12]' -> 'image_generator.render_new'."""
+    bracket = label.find("[")
+    return label[:bracket] if bracket != -1 else label
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{key}="{_escape(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms keyed by (name, sorted labels)."""
+
+    def __init__(self, max_series: int = MAX_SERIES):
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._counters = {}     # name -> {labels: value}
+        self._histograms = {}   # name -> {labels: _Histogram}
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def _series(self, family: dict, name: str, labels: dict, factory):
+        key = tuple(sorted(labels.items()))
+        series = family.setdefault(name, {})
+        if key not in series and len(series) >= self.max_series:
+            key = tuple((k, "other") for k, _ in key)
+        if key not in series:
+            series[key] = factory()
+        return series, key
+
+    def increment(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            series, key = self._series(self._counters, name, labels, float)
+            series[key] += value
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            series, key = self._series(self._histograms, name, labels, lambda: _Histogram(buckets))
+            series[key].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    # -- exporters ----------------------------------------------------------
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        le = 'le="%g"' % bound
+                        lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+                    inf = 'le="+Inf"'
+                    lines.append(f"{name}_bucket{_format_labels(labels, inf)} {hist.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for name, series in sorted(self._counters.items())
+                    for labels, value in sorted(series.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name, "labels": dict(labels), "count": hist.count,
+                        "sum": round(hist.sum, 6), "max": round(hist.max, 6),
+                        "buckets": dict(zip([f"{b:g}" for b in hist.buckets] + ["+Inf"], hist.counts)),
+                    }
+                    for name, series in sorted(self._histograms.items())
+                    for labels, hist in sorted(series.items())
+                ],
+            }
+
+
+registry = MetricsRegistry()
+registry.describe("comic_agent_step_seconds", "Wall time of each timed agent step.")
+registry.describe("comic_agent_step_total", "Timed agent steps by outcome.")
+registry.describe("comic_agent_runs_total", "Agent invocations by action and outcome.")
+registry.describe("comic_agent_run_seconds", "Wall time of whole agent invocations.")
+
+
+class RunMetrics:
+    """Aggregates of one agent invocation (shared by every thread working on it)."""
+
+    def __init__(self, action: str):
+        self.action = action
+        self.outcome = "ok"
+        self._started = perf_counter()
+        self._lock = threading.Lock()
+        self._steps = {}     # name -> [count, total, max, errors]
+        self._counters = {}
+
+    def observe_step(self, name: str, elapsed: float, failed: bool):
+        with self._lock:
+            entry = self._steps.get(name)
+            if entry is None:
+                entry = self._steps[name] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+            if failed:
+                entry[3] += 1
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @property
+    def elapsed(self) -> float:
+        return perf_counter() - self._started
+
+    def summary(self) -> dict:
+        with self._lock:
+            steps = sorted(self._steps.items(), key=lambda item: item[1][1], reverse=True)
+            return {
+                "action": self.action,
+                "outcome": self.outcome,
+                "wall_seconds": round(self.elapsed, 3),
+                "steps": {
+                    name: {"count": count, "total_s": round(total, 3), "max_s": round(peak, 3), "errors": errors}
+                    for name, (count, total, peak, errors) in steps
+                },
+                "counters": dict(self._counters),
+            }
+
+
+def record_step(label: str, elapsed: float, failed: bool = False):
+    """Called by telemetry.timed_step for every finished step."""
+    name = step_name(label)
+    registry.observe("comic_agent_step_seconds", elapsed, step=name)
+    registry.increment("comic_agent_step_total", step=name, outcome="error" if failed else "ok")
+    run = _current_run.get()
+    if run is not None:
+        run.observe_step(name, elapsed, failed)
+
+
+def increment(name: str, value: float = 1, **labels):
+    """Counter in the process registry and in the current run's summary."""
+    if not ENABLED:
+        return
+    registry.increment(name, value, **labels)
+    run = _current_run.get()
+    if run is not None:
+        run.increment(name, value)
+
+
+def current_run():
+    return _current_run.get()
+
+
+@contextmanager
+def collect_run(action: str):
+    """Scopes per-run aggregates; yields the RunMetrics (None when metrics are disabled)."""
+    if not ENABLED:
+        yield None
+        return
+    run = RunMetrics(action)
+    token = _current_run.set(run)
+    try:
+        yield run
+    except BaseException:
+        run.outcome = "error"
+        raise
+    finally:
+        _current_run.reset(token)
+        registry.increment("comic_agent_runs_total", action=action, outcome=run.outcome)
+        registry.observe("comic_agent_run_seconds", run.elapsed, action=action)
+        if EXPORT_DIR:
+            export_to_dir(EXPORT_DIR)
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def export_to_dir(directory: str):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(os.path.join(directory, "metrics.prom"), registry.to_prometheus())
+        _write_atomic(os.path.join(directory, "metrics.json"), json.dumps(registry.to_json()))
+    except OSError as e:
+        print(f"WARNING: could not export metrics to {directory}: {e}")
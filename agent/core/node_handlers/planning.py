@@ -4,7 +4,7 @@ import os
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
 
-from ..knowledge import CanonicalStore, CharacterManager, SceneryManager
+from ..knowledge import CharacterManager, SceneryManager, get_canon
 from ..models import AgentState
 from ..telemetry import timed_function
 
@@ -33,7 +33,7 @@ def planner(state: AgentState):
         structure_str = f"ESTRUCTURA DE LIENZO ACTUAL (REQUERIDA): {', '.join(parts)}."
 
     print("--- STRATEGIC PLANNING (Batched) ---")
-    canon = CanonicalStore(state["project_id"])
+    canon = get_canon(state["project_id"])
     cm = CharacterManager(state["project_id"], canon=canon)
     scm = SceneryManager(state["project_id"], canon=canon)
 
@@ -48,8 +48,8 @@ def planner(state: AgentState):
             assets_context += f"- PERSONAJES: {', '.join(existing_chars)}\n"
         if existing_scenes:
             assets_context += "- ESCENARIOS:\n"
-            for scene in existing_scenes:
-                assets_context += f"  - {scene}: {full_existing_scenes[scene].get('description', '')}\n"
+            for scene, scene_info in full_existing_scenes.items():
+                assets_context += f"  - {scene}: {scene_info.get('description', '')}\n"
         assets_context += (
             "Si el guiÃ³n requiere un escenario o personaje que no estÃ¡ en esta lista, "
             "intenta usar el mÃ¡s parecido, pero si se diferencia mucho, no inventes nuevos escenarios ni personajes."
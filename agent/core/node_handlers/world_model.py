@@ -1,26 +1,25 @@
 import json
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List
+from typing import List
 
 from langchain_openai import ChatOpenAI
-from langsmith import traceable
 
-from ..knowledge import CanonicalStore, CharacterManager, SceneryManager
+from ..knowledge import CharacterManager, SceneryManager, get_canon, get_trait_engine, resolver_from_names
 from ..models import AgentState
-from ..telemetry import submit_with_current_context, timed_function, timed_step
+from ..telemetry import timed_function, timed_step
 
 
 @timed_function("node.world_model_builder")
 def world_model_builder(state: AgentState):
     print("--- WORLD MODEL BUILDING (Characters & Scenarios) ---")
-    canon = CanonicalStore(state["project_id"])
+    canon = get_canon(state["project_id"])
     batch_canon_save = os.getenv("ENABLE_BATCH_CANON_SAVE", "1").strip().lower() not in {"0", "false", "no", "off"}
     if batch_canon_save:
         canon.autosave = False
     cm = CharacterManager(state["project_id"], canon=canon)
     scm = SceneryManager(state["project_id"], canon=canon)
     llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL_ID"), temperature=0)
+    trait_engine = get_trait_engine()
 
     backend_chars = state.get("global_context", {}).get("characters", [])
     backend_scenes = state.get("global_context", {}).get("sceneries", [])
@@ -33,6 +32,8 @@ def world_model_builder(state: AgentState):
         s["name"].lower(): s.get("image_urls", [s["image_url"]] if s.get("image_url") else [])
         for s in backend_scenes
     }
+    backend_character_names = resolver_from_names(known_character_images)
+    backend_scenery_names = resolver_from_names(known_scenery_images)
     enable_parallel_world_traits = (
         os.getenv("ENABLE_PARALLEL_WORLD_TRAITS", "1").strip().lower() not in {"0", "false", "no", "off"}
     )
@@ -131,12 +132,11 @@ def world_model_builder(state: AgentState):
             if existing_char:
                 images = existing_char.get("ref_images", [])
 
-            for b_name, b_urls in known_character_images.items():
-                if target_name.lower() in b_name or b_name in target_name.lower():
-                    for url in b_urls:
-                        if url and url not in images:
-                            images.append(url)
-                    break
+            b_name = backend_character_names.resolve(target_name)
+            if b_name is not None:
+                for url in known_character_images[b_name]:
+                    if url and url not in images:
+                        images.append(url)
 
             if not images:
                 for p in ref_images:
@@ -173,13 +173,13 @@ def world_model_builder(state: AgentState):
             if existing_scene:
                 images = existing_scene.get("ref_images", [])
 
-            for b_name, b_urls in known_scenery_images.items():
-                if target_name.lower() in b_name or b_name in target_name.lower():
-                    for url in b_urls:
-                        if url and url not in images:
-                            images.append(url)
-                    print(f"DEBUG: Scenery '{target_name}' matched with backend scenery '{b_name}' ({len(b_urls)} images)")
-                    break
+            b_name = backend_scenery_names.resolve(target_name)
+            if b_name is not None:
+                b_urls = known_scenery_images[b_name]
+                for url in b_urls:
+                    if url and url not in images:
+                        images.append(url)
+                print(f"DEBUG: Scenery '{target_name}' matched with backend scenery '{b_name}' ({len(b_urls)} images)")
 
             if not images:
                 for p in ref_images:
@@ -210,33 +210,15 @@ def world_model_builder(state: AgentState):
         if pending_trait_jobs:
             print(f"DEBUG: [WorldModelBuilder] Pending trait jobs: {len(pending_trait_jobs)}")
 
-            @traceable(name="world_model_trait_job", project_name=os.getenv("LANGCHAIN_PROJECT", "comic-draft-ai"))
-            def resolve_trait_job(job: Dict[str, object]) -> Dict[str, object]:
-                try:
-                    if job["kind"] == "character":
-                        traits = cm.analyze_visual_traits(job["name"], job["image_urls"])
-                    else:
-                        traits = scm.analyze_visual_traits(job["name"], job["image_urls"])
-                    return {**job, "traits": traits}
-                except Exception as trait_error:
-                    print(f"WARNING: Trait job failed for {job['kind']} '{job['name']}': {trait_error}")
-                    return {**job, "traits": None}
-
-            resolved_trait_jobs = []
             trait_jobs = list(pending_trait_jobs.values())
-
-            if enable_parallel_world_traits and len(trait_jobs) > 1 and max_world_trait_workers > 1:
-                worker_count = min(max_world_trait_workers, len(trait_jobs))
+            worker_count = min(max_world_trait_workers, len(trait_jobs)) if enable_parallel_world_traits else 1
+            if worker_count > 1:
                 print(f"DEBUG: [WorldModelBuilder] Parallel trait extraction enabled with {worker_count} workers.")
-                with timed_step("world_model_builder.parallel_traits"):
-                    with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="world-traits") as executor:
-                        futures = [submit_with_current_context(executor, resolve_trait_job, job) for job in trait_jobs]
-                        for future in as_completed(futures):
-                            resolved_trait_jobs.append(future.result())
             else:
                 print("DEBUG: [WorldModelBuilder] Using sequential trait extraction.")
-                for job in trait_jobs:
-                    resolved_trait_jobs.append(resolve_trait_job(job))
+            # Un solo motor: descargas compartidas y jobs con las mismas imágenes resueltos una vez
+            with timed_step("world_model_builder.traits"):
+                resolved_trait_jobs = trait_engine.analyze_many(trait_jobs, max_workers=worker_count, project_id=state["project_id"])
 
             for job in resolved_trait_jobs:
                 traits = job.get("traits")
@@ -255,11 +237,10 @@ def world_model_builder(state: AgentState):
             print("DEBUG: [WorldModelBuilder] Applying pending trait jobs in fallback mode.")
             for job in pending_trait_jobs.values():
                 try:
+                    traits = trait_engine.analyze(job["kind"], job["name"], job["image_urls"], project_id=state["project_id"])
                     if job["kind"] == "character":
-                        traits = cm.analyze_visual_traits(job["name"], job["image_urls"])
                         canon.update_character(job["name"], {"visual_traits": traits})
                     else:
-                        traits = scm.analyze_visual_traits(job["name"], job["image_urls"])
                         canon.update_scenery(job["name"], {"visual_traits": traits})
                 except Exception as trait_error:
                     print(f"WARNING: Fallback trait job failed for {job['kind']} '{job['name']}': {trait_error}")
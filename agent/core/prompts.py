@@ -2,14 +2,14 @@ import os
 from typing import Dict, List
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
-from .knowledge import CharacterManager, StyleManager, SceneryManager, CanonicalStore
+from .knowledge import CharacterManager, StyleManager, SceneryManager, get_canon
 from .models import Panel
 from .telemetry import timed_function, timed_step
 
 class PromptBuilder:
     """Agent F: Prompt Builder - Composes layered prompts for image generation."""
     def __init__(self, project_id: str):
-        self.canon = CanonicalStore(project_id)
+        self.canon = get_canon(project_id)
         self.cm = CharacterManager(project_id, canon=self.canon)
         self.sm = StyleManager(project_id, canon=self.canon)
         self.scm = SceneryManager(project_id, canon=self.canon)
@@ -35,17 +35,17 @@ class PromptBuilder:
         characters_continuity = continuity_state.get("characters", {})
         environment_continuity = continuity_state.get("environment", {})
         
+        # Case-insensitive index of the continuity state, built once per panel
+        continuity_by_name = {}
+        for name_key, state in characters_continuity.items():
+            continuity_by_name.setdefault(name_key.lower(), state)
+
         for char_name in char_names:
+            # Segmento canónico precompilado (se recompila solo si el personaje cambia)
             base_char = self.cm.get_character_prompt_segment(char_name)
             # Add continuity state (Agent H)
             # Try both the specific name and a case-insensitive match
-            char_state = characters_continuity.get(char_name)
-            if not char_state:
-                # Fallback: look for case-insensitive match
-                for name_key, state in characters_continuity.items():
-                    if name_key.lower() == char_name.lower():
-                        char_state = state
-                        break
+            char_state = characters_continuity.get(char_name) or continuity_by_name.get(char_name.lower())
             
             state_str = ""
             if char_state and isinstance(char_state, dict):
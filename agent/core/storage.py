@@ -0,0 +1,358 @@
+"""
+Object storage used by the agent for canon documents, renders, reference
+images and wire offload blobs.
+
+Two backends, selected with ``COMIC_AGENT_STORAGE``:
+
+- ``s3`` (default): the project bucket through a single shared boto3 client.
+- ``local``: plain files under ``COMIC_AGENT_STORAGE_DIR/<bucket>/<key>``, for
+  single-node deployments, development and zero-network benchmarks. Writes go
+  to a temporary file in the same directory and are published with
+  ``os.replace`` (readers never see a partial object); ``open()`` maps the
+  file read-only instead of copying it into the process.
+
+Callers keep passing what they already have: a key (``generated/x.png``), an
+``s3://bucket/key`` URI or a virtual-hosted S3 URL. ``split_location`` turns
+any of them into ``(bucket, key)``; with the local backend the bucket is just
+the first directory level.
+
+Writers that must not lose concurrent updates (the canon) use conditional
+puts: ``put(..., if_match=etag)`` / ``put(..., if_none_match=True)`` raise
+``PreconditionFailed`` when the stored object is not the expected version
+(S3 ``If-Match`` / ``If-None-Match: *``; locally an exclusive lock around the
+compare-and-replace).
+"""
+import io
+import mmap
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows: las escrituras condicionales solo se serializan dentro del proceso
+    fcntl = None
+
+
+class NotFound(KeyError):
+    """The requested object does not exist."""
+
+
+class PreconditionFailed(Exception):
+    """A conditional put found a different version of the object than expected."""
+
+
+class StoredObject(NamedTuple):
+    data: bytes
+    etag: str
+
+
+def is_s3_http_url(url: str) -> bool:
+    """Virtual-hosted S3 URL (https://bucket.s3.region.amazonaws.com/key), possibly presigned."""
+    if not str(url).startswith("http"):
+        return False
+    hostname = urlparse(str(url)).netloc
+    return hostname.endswith(".amazonaws.com") and "s3" in hostname.split(".")
+
+
+def split_location(location: str, default_bucket: Optional[str] = None) -> Tuple[Optional[str], str]:
+    """(bucket, key) for a key, an s3:// URI or a virtual-hosted S3 URL."""
+    location = str(location)
+    if location.startswith("s3://"):
+        parsed = urlparse(location)
+        return parsed.netloc, parsed.path.lstrip("/")
+    if is_s3_http_url(location):
+        parsed = urlparse(location)
+        return parsed.netloc.split(".")[0], parsed.path.lstrip("/")
+    return default_bucket, location.split("?")[0].lstrip("/")
+
+
+class Storage(ABC):
+    name = "abstract"
+
+    def __init__(self, bucket: Optional[str] = None):
+        self.bucket = bucket
+
+    def _locate(self, key: str, bucket: Optional[str] = None) -> Tuple[str, str]:
+        location_bucket, location_key = split_location(key, self.bucket)
+        return bucket or location_bucket or "default", location_key
+
+    def uri(self, key: str, bucket: Optional[str] = None) -> str:
+        bucket, key = self._locate(key, bucket)
+        return f"s3://{bucket}/{key}"
+
+    @abstractmethod
+    def get(self, key: str, bucket: Optional[str] = None) -> StoredObject:
+        """Object bytes and etag; raises NotFound."""
+
+    @abstractmethod
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None, bucket: Optional[str] = None,
+            if_match: Optional[str] = None, if_none_match: bool = False) -> str:
+        """
+        Stores the object and returns its new etag. With `if_match` the write only
+        happens if the stored etag is still that one; with `if_none_match` only if
+        the object does not exist yet. Otherwise raises PreconditionFailed.
+        """
+
+    @abstractmethod
+    def exists(self, key: str, bucket: Optional[str] = None) -> bool:
+        pass
+
+    @abstractmethod
+    def local_path(self, key: str, download_path: str, bucket: Optional[str] = None) -> str:
+        """A local file with the object's bytes (downloaded to download_path if needed)."""
+
+    def get_if_changed(self, key: str, etag: Optional[str], bucket: Optional[str] = None) -> Optional[StoredObject]:
+        """Conditional GET: None if the object still has `etag`, else the object (raises NotFound)."""
+        stored = self.get(key, bucket)
+        return None if etag and stored.etag == etag else stored
+
+    def read(self, key: str, bucket: Optional[str] = None) -> bytes:
+        return self.get(key, bucket).data
+
+    @contextmanager
+    def open(self, key: str, bucket: Optional[str] = None):
+        """Read-only binary file object over the object (PIL.Image.open accepts it)."""
+        yield io.BytesIO(self.read(key, bucket))
+
+
+class S3Storage(Storage):
+    name = "s3"
+
+    def __init__(self, bucket: Optional[str] = None, client=None):
+        super().__init__(bucket)
+        if client is None:
+            import boto3
+            client = boto3.client(
+                "s3",
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_REGION"),
+            )
+        self.client = client
+
+    @staticmethod
+    def _is_missing(error) -> bool:
+        code = str(getattr(error, "response", {}).get("Error", {}).get("Code", ""))
+        return code in {"NoSuchKey", "404", "NotFound"}
+
+    def get(self, key, bucket=None):
+        from botocore.exceptions import ClientError
+
+        bucket, key = self._locate(key, bucket)
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if self._is_missing(e):
+                raise NotFound(f"s3://{bucket}/{key}") from e
+            raise
+        return StoredObject(response["Body"].read(), response.get("ETag", "").strip('"'))
+
+    def get_if_changed(self, key, etag, bucket=None):
+        from botocore.exceptions import ClientError
+
+        if not etag:
+            return self.get(key, bucket)
+        bucket, key = self._locate(key, bucket)
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=key, IfNoneMatch=f'"{etag}"')
+        except ClientError as e:
+            code = str(e.response.get("Error", {}).get("Code", ""))
+            if code in {"304", "NotModified"}:
+                return None
+            if self._is_missing(e):
+                raise NotFound(f"s3://{bucket}/{key}") from e
+            raise
+        return StoredObject(response["Body"].read(), response.get("ETag", "").strip('"'))
+
+    def put(self, key, data, content_type=None, bucket=None, if_match=None, if_none_match=False):
+        from botocore.exceptions import ClientError
+
+        bucket, key = self._locate(key, bucket)
+        extra = {"ContentType": content_type} if content_type else {}
+        if if_match:
+            extra["IfMatch"] = f'"{if_match}"'
+        elif if_none_match:
+            extra["IfNoneMatch"] = "*"
+        try:
+            response = self.client.put_object(Bucket=bucket, Key=key, Body=data, **extra)
+        except ClientError as e:
+            code = str(e.response.get("Error", {}).get("Code", ""))
+            # 409 ConditionalRequestConflict: otra escritura condicional en curso sobre la misma clave
+            if code in {"PreconditionFailed", "412", "ConditionalRequestConflict"}:
+                raise PreconditionFailed(f"s3://{bucket}/{key}") from e
+            raise
+        return response.get("ETag", "").strip('"')
+
+    def exists(self, key, bucket=None):
+        from botocore.exceptions import ClientError
+
+        bucket, key = self._locate(key, bucket)
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as e:
+            if self._is_missing(e):
+                return False
+            raise
+
+    def local_path(self, key, download_path, bucket=None):
+        from botocore.exceptions import ClientError
+
+        bucket, key = self._locate(key, bucket)
+        try:
+            self.client.download_file(bucket, key, download_path)
+        except ClientError as e:
+            if self._is_missing(e):
+                raise NotFound(f"s3://{bucket}/{key}") from e
+            raise
+        return download_path
+
+
+class LocalStorage(Storage):
+    name = "local"
+
+    def __init__(self, root: str, bucket: Optional[str] = None, fsync: bool = True):
+        super().__init__(bucket)
+        self.root = os.path.abspath(root)
+        self.fsync = fsync
+
+    def path(self, key, bucket=None) -> str:
+        bucket, key = self._locate(key, bucket)
+        path = os.path.abspath(os.path.join(self.root, bucket, key))
+        # Una clave con '..' no puede salir del directorio de almacenamiento
+        if not path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    @staticmethod
+    def _etag(stat) -> str:
+        # os.replace publica un inodo nuevo en cada escritura
+        return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def get(self, key, bucket=None):
+        path = self.path(key, bucket)
+        try:
+            with open(path, "rb") as f:
+                return StoredObject(f.read(), self._etag(os.fstat(f.fileno())))
+        except FileNotFoundError as e:
+            raise NotFound(path) from e
+
+    def get_if_changed(self, key, etag, bucket=None):
+        path = self.path(key, bucket)
+        try:
+            # Solo un stat si no cambió
+            if etag and self._etag(os.stat(path)) == etag:
+                return None
+        except FileNotFoundError as e:
+            raise NotFound(path) from e
+        return self.get(key, bucket)
+
+    @contextmanager
+    def _directory_lock(self, directory):
+        if fcntl is None:
+            with _local_put_lock:
+                yield
+            return
+        fd = os.open(os.path.join(directory, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _check_precondition(self, path, if_match, if_none_match):
+        try:
+            current = self._etag(os.stat(path))
+        except FileNotFoundError:
+            current = None
+        if (if_match and current != if_match) or (if_none_match and current is not None):
+            raise PreconditionFailed(path)
+
+    def put(self, key, data, content_type=None, bucket=None, if_match=None, if_none_match=False):
+        path = self.path(key, bucket)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data.encode("utf-8") if isinstance(data, str) else data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            if if_match or if_none_match:
+                # Comparar y publicar bajo el lock, para que nadie reemplace el archivo entre medias
+                with self._directory_lock(directory):
+                    self._check_precondition(path, if_match, if_none_match)
+                    os.replace(tmp_path, path)
+                    return self._etag(os.stat(path))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return self._etag(os.stat(path))
+
+    def exists(self, key, bucket=None):
+        return os.path.isfile(self.path(key, bucket))
+
+    def local_path(self, key, download_path=None, bucket=None):
+        # El objeto ya es un archivo local: no hace falta copiarlo
+        path = self.path(key, bucket)
+        if not os.path.isfile(path):
+            raise NotFound(path)
+        return path
+
+    @contextmanager
+    def open(self, key, bucket=None):
+        path = self.path(key, bucket)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError as e:
+            raise NotFound(path) from e
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap no admite archivos vacíos
+                yield io.BytesIO(b"")
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+
+_local_put_lock = threading.Lock()
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+
+def _create_storage() -> Storage:
+    backend = os.getenv("COMIC_AGENT_STORAGE", "s3").strip().lower()
+    bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
+    if backend == "local":
+        fsync = os.getenv("COMIC_AGENT_STORAGE_FSYNC", "1").strip().lower() not in {"0", "false", "no", "off"}
+        return LocalStorage(os.getenv("COMIC_AGENT_STORAGE_DIR", "./data/storage"), bucket, fsync=fsync)
+    if backend == "s3":
+        return S3Storage(bucket)
+    raise ValueError(f"Storage backend {backend} not supported.")
+
+
+def get_storage() -> Storage:
+    """Process-wide storage backend (created on first use from the environment)."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = _create_storage()
+    return _storage
+
+
+def configure():
+    """Drops the current backend so the next get_storage() re-reads the environment."""
+    global _storage
+    with _storage_lock:
+        _storage = None
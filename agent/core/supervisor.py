@@ -2,14 +2,14 @@ import os
 import json
 from typing import Dict
 from langchain_openai import ChatOpenAI
-from .knowledge import CanonicalStore
+from .knowledge import get_canon
 from .models import Panel
 from .telemetry import timed_function, timed_step
 
 class ContinuitySupervisor:
     """Agent H: Continuity Supervisor - Tracks and validates state between panels."""
     def __init__(self, project_id: str):
-        self.canon = CanonicalStore(project_id)
+        self.canon = get_canon(project_id)
         
     @timed_function("continuity.update_state")
     def update_state(self, current_state: Dict, panel: Panel) -> Dict:
@@ -4,24 +4,49 @@ from contextlib import contextmanager
 from functools import wraps
 from time import perf_counter
 
+from . import metrics, tracing
+
 
 def _env_enabled(name: str, default: str = "1") -> bool:
     value = os.getenv(name, default)
     return str(value).strip().lower() not in {"0", "false", "no", "off"}
 
 
+# Leídos una sola vez (y de nuevo en configure()): sin timing, métricas ni traza activa
+# timed_step no mide nada
+PRINT_TIMING = _env_enabled("COMIC_AGENT_TIMING", "1")
+
+
+def configure():
+    """Re-reads the telemetry flags (call after loading a .env file)."""
+    global PRINT_TIMING
+    PRINT_TIMING = _env_enabled("COMIC_AGENT_TIMING", "1")
+    metrics.configure()
+    tracing.configure()
+
+
 @contextmanager
 def timed_step(label: str):
-    if not _env_enabled("COMIC_AGENT_TIMING", "1"):
+    """Times a step: TIMING log line, metrics registry and, while a trace is collected, a span."""
+    span = tracing.start_span(label)
+    if span is None and not (PRINT_TIMING or metrics.ENABLED):
         yield
         return
 
     start = perf_counter()
+    failed = False
     try:
         yield
+    except BaseException:
+        failed = True
+        raise
     finally:
         elapsed = perf_counter() - start
-        print(f"TIMING: {label} took {elapsed:.3f}s")
+        tracing.finish_span(span, failed)
+        if PRINT_TIMING:
+            print(f"TIMING: {label} took {elapsed:.3f}s")
+        if metrics.ENABLED:
+            metrics.record_step(label, elapsed, failed)
 
 
 def timed_function(label: str | None = None):
@@ -0,0 +1,169 @@
+"""
+Per-run span timeline, exported in the Chrome trace event format (opens in
+Perfetto / chrome://tracing).
+
+``telemetry.timed_step`` opens a span for every node, LLM call and render while
+a trace is being collected. The parent span and the trace itself live in
+context variables, so spans started in worker threads through
+``submit_with_current_context`` become children of the span that submitted
+them. Each span records the thread it ran on and monotonic start / end times
+(``perf_counter_ns`` relative to the start of the run).
+
+Cross-thread parent/child links are exported as flow events (arrows in
+Perfetto), so the fan-out of the panel generation workers is visible.
+
+Tracing is off unless ``COMIC_AGENT_TRACE_DIR`` is set; then every invocation
+writes ``<dir>/<project_id>/<action>-<run>.trace.json``.
+"""
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter_ns
+
+TRACE_DIR = os.getenv("COMIC_AGENT_TRACE_DIR", "")
+
+
+def configure():
+    global TRACE_DIR
+    TRACE_DIR = os.getenv("COMIC_AGENT_TRACE_DIR", "")
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("comic_agent_trace", default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("comic_agent_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ("span_id", "name", "parent", "start_ns", "tid", "thread_name")
+
+    def __init__(self, name, parent):
+        self.span_id = next(_span_ids)
+        self.name = name
+        self.parent = parent
+        self.start_ns = perf_counter_ns()
+        thread = threading.current_thread()
+        self.tid = thread.ident
+        self.thread_name = thread.name
+
+
+class Trace:
+    """Finished spans of one run (appended from any thread)."""
+
+    def __init__(self, name, metadata=None):
+        self.name = name
+        self.metadata = metadata or {}
+        self.started_ns = perf_counter_ns()
+        self.wall_started = time.time()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    def _us(self, ns):
+        return (ns - self.started_ns) / 1000.0
+
+    def record(self, span, end_ns, error=False):
+        event = {
+            "name": span.name,
+            "cat": span.name.split(".", 1)[0],
+            "ph": "X",
+            "ts": self._us(span.start_ns),
+            "dur": (end_ns - span.start_ns) / 1000.0,
+            "pid": os.getpid(),
+            "tid": span.tid,
+            "args": {"span_id": span.span_id, "parent_id": span.parent.span_id if span.parent else None},
+        }
+        if error:
+            event["args"]["error"] = True
+        flow = None
+        if span.parent is not None and span.parent.tid != span.tid:
+            # Flecha en Perfetto desde el span padre (otro hilo) hasta el hijo
+            flow = (
+                {"name": "spawn", "cat": "flow", "ph": "s", "id": span.span_id, "ts": event["ts"],
+                 "pid": event["pid"], "tid": span.parent.tid},
+                {"name": "spawn", "cat": "flow", "ph": "f", "bp": "e", "id": span.span_id, "ts": event["ts"],
+                 "pid": event["pid"], "tid": span.tid},
+            )
+        with self._lock:
+            self._events.append(event)
+            if flow:
+                self._events.extend(flow)
+            self._threads.setdefault(span.tid, span.thread_name)
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"comic-agent {self.name}"}}]
+        metadata += [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        return {
+            "traceEvents": metadata + sorted(events, key=lambda e: e["ts"]),
+            "displayTimeUnit": "ms",
+            "otherData": {**self.metadata, "started_at": self.wall_started},
+        }
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f)
+        os.replace(tmp_path, path)
+
+
+def active() -> bool:
+    return _current_trace.get() is not None
+
+
+def start_span(name):
+    """Opens a child of the current span; returns (span, token) for finish_span (None if not tracing)."""
+    if _current_trace.get() is None:
+        return None
+    span = Span(name, _current_span.get())
+    return span, _current_span.set(span)
+
+
+def finish_span(handle, error=False):
+    if handle is None:
+        return
+    span, token = handle
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(span, perf_counter_ns(), error)
+    _current_span.reset(token)
+
+
+@contextmanager
+def collect_trace(name, project_id=None, run_id=None):
+    """
+    Collects the spans of one run under a root span and dumps them to
+    COMIC_AGENT_TRACE_DIR when it ends. Yields the Trace (None when disabled).
+    """
+    if not TRACE_DIR:
+        yield None
+        return
+    trace = Trace(name, {"project_id": project_id, "run_id": run_id})
+    trace_token = _current_trace.set(trace)
+    root = start_span(f"run.{name}")
+    error = False
+    try:
+        yield trace
+    except BaseException:
+        error = True
+        raise
+    finally:
+        finish_span(root, error)
+        _current_trace.reset(trace_token)
+        run_label = run_id or time.strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(TRACE_DIR, str(project_id or "unknown"), f"{name}-{run_label}.trace.json")
+        try:
+            trace.dump(path)
+            print(f"TRACE: {path}")
+        except OSError as e:
+            print(f"WARNING: could not write trace {path}: {e}")
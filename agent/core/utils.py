@@ -3,7 +3,7 @@ from io import BytesIO
 import os
 import tempfile
 import textwrap
-import boto3
+from .storage import get_storage
 
 class PageRenderer:
     # Proportional padding matching the frontend's 20px on an 800px canvas = 2.5%
@@ -67,24 +67,10 @@ class PageRenderer:
                     response = requests.get(image_url, timeout=10)
                     panel_img = Image.open(BytesIO(response.content))
                 else:
-                    # Asumimos que es una llave de S3 (ej: generated/uuid.png)
-                    s3 = boto3.client(
-                        "s3",
-                        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-                        region_name=os.getenv("AWS_REGION")
-                    )
-                    bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_img:
-                        tmp_img_path = tmp_img.name
-                        tmp_img.close()  # Cierra el handle ANTES de descargar con s3.download_file
-                        s3.download_file(bucket, image_url, tmp_img_path)
-                    
-                    with Image.open(tmp_img_path) as img:
-                        panel_img = img.copy()  # Copia a memoria para cerrar el archivo inmediatamente
-                    
-                    try: os.remove(tmp_img_path)  # Limpiar temporal local
-                    except: pass
+                    # Asumimos que es una llave del bucket (ej: generated/uuid.png)
+                    with get_storage().open(image_url) as f:
+                        with Image.open(f) as img:
+                            panel_img = img.copy()  # Copia a memoria para liberar el objeto inmediatamente
                 
                 # Use the same formula as the frontend:
                 # x = (layout.x / 100) * inner_w + pad_x
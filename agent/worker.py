@@ -1,12 +1,17 @@
 import os
 import json
+import uuid
 import requests
 import boto3
 from dotenv import load_dotenv
 from core.graph import create_comic_graph
+from core import wire, metrics, storage, telemetry, tracing
+from core.knowledge import canon_session, flush_session
 from bedrock_agentcore.runtime import BedrockAgentCoreApp
 
 load_dotenv(override=True)
+telemetry.configure()
+storage.configure()
 
 # Initialize Bedrock Agent Core App
 app = BedrockAgentCoreApp()
@@ -15,28 +20,86 @@ app = BedrockAgentCoreApp()
 sqs = boto3.client('sqs', region_name=os.getenv('AWS_REGION', 'us-east-1'))
 queue_url = os.getenv('AWS_SQS_QUEUE_URL')
 
+# Compact wire format (core/wire.py) for SQS results; 0 = legacy plain JSON
+ENABLE_COMPACT_WIRE = os.getenv("ENABLE_COMPACT_WIRE", "1").strip().lower() not in {"0", "false", "no", "off"}
+# 1 = regenerate_panel / regenerate_merge report only what changed, 0 = legacy full state
+ENABLE_DELTA_RESULTS = os.getenv("ENABLE_DELTA_RESULTS", "1").strip().lower() not in {"0", "false", "no", "off"}
+WIRE_INLINE_LIMIT = int(os.getenv("WIRE_INLINE_LIMIT", str(wire.DEFAULT_INLINE_LIMIT)))
+
 # Compile the LangGraph
 graph = create_comic_graph()
 
-def notify_completion(project_id, result, action):
-    """Notify backend via SQS upon task completion or failure."""
+def _wire_offload(project_id):
+    """Stores an oversized wire body in the bucket and returns its key."""
+    def offload(blob):
+        key = f"projects/{project_id}/wire/{uuid.uuid4()}.json.z"
+        storage.get_storage().put(key, blob, content_type="application/octet-stream")
+        print(f"DEBUG: Wire body offloaded to {storage.get_storage().name} ({len(blob)} bytes): {key}")
+        return key
+    return offload
+
+def _wire_fetch(key):
+    return storage.get_storage().read(key)
+
+def notify_completion(project_id, result, action, run_id=None):
+    """
+    Notify backend via SQS upon task completion or failure.
+    `run_id` is echoed back so the backend can deduplicate redeliveries.
+    """
+    # El canon de la ejecución se guarda antes de avisar al backend
+    flush_session()
+
     if not queue_url:
         print(f"WARNING: AWS_SQS_QUEUE_URL not set. Action '{action}' results will not be sent.")
         return
 
     print(f"DEBUG: Notifying completion for action '{action}' on project {project_id}")
     try:
-        message_body = json.dumps({
+        message = {
             "project_id": project_id,
             "status": "completed" if "error" not in result else "failed",
             "action": action,
+            "run_id": run_id,
             "result": result
-        })
+        }
+        run_metrics = metrics.current_run()
+        if run_metrics is not None:
+            # Resumen de tiempos por paso de esta ejecución (el backend lo ignora si no lo usa)
+            message["metrics"] = run_metrics.summary()
+        if ENABLE_COMPACT_WIRE:
+            message = wire.pack(message, offload=_wire_offload(project_id), inline_limit=WIRE_INLINE_LIMIT)
+        message_body = json.dumps(message)
         sqs.send_message(QueueUrl=queue_url, MessageBody=message_body)
         print("DEBUG: SQS message sent successfully.")
     except Exception as e:
         print(f"ERROR: Failed to send SQS message: {e}")
 
+# Panel fields the backend persists from a result; only these are diffed for deltas
+DELTA_PANEL_FIELDS = (
+    "prompt", "scene_description", "balloons", "layout", "order_in_page",
+    "characters", "sceneries", "scenery", "image_url", "status"
+)
+
+def panel_delta_result(original_panel, updated_state, panel_id):
+    """
+    Projects a regenerate_panel state onto the target panel's changed fields.
+    `original_panel` is the panel as the backend sent it.
+    """
+    updated = next((p for p in updated_state.get("panels", []) if str(p.get("id")) == str(panel_id)), None)
+    if updated is None:
+        return {"delta": True, "panel_id": panel_id, "panels": []}
+
+    original_panel = original_panel or {}
+    changed = {"id": updated.get("id"), "page_number": updated.get("page_number")}
+    for field in DELTA_PANEL_FIELDS:
+        if field in updated and updated[field] != original_panel.get(field):
+            changed[field] = updated[field]
+    return {"delta": True, "panel_id": panel_id, "panels": [changed]}
+
+def merge_delta_result(updated_state):
+    """Projects a regenerate_merge state onto the pages it merged (the state starts with none)."""
+    return {"delta": True, "merged_pages": updated_state.get("merged_pages", [])}
+
 def generate_comic_logic(project_id, sources, max_pages=3, max_panels=None, layout_style="dynamic", **kwargs):
     """
     Core logic for initial comic generation.
@@ -76,12 +139,12 @@ def generate_comic_logic(project_id, sources, max_pages=3, max_panels=None, layo
         result = graph.invoke(initial_state, config=config)
         
         # Notify backend via SQS
-        notify_completion(project_id, result, "generate")
+        notify_completion(project_id, result, "generate", kwargs.get("run_id"))
             
         return result
     except Exception as e:
         print(f"Error in graph execution: {e}")
-        notify_completion(project_id, {"error": str(e)}, "generate")
+        notify_completion(project_id, {"error": str(e)}, "generate", kwargs.get("run_id"))
         return {"current_step": "error", "error": str(e)}
 
 def regenerate_panel_logic(project_id, panel_id, prompt, scene_description, balloons, **kwargs):
@@ -97,6 +160,9 @@ def regenerate_panel_logic(project_id, panel_id, prompt, scene_description, ball
     world_model_summary = kwargs.get('world_model_summary', "")
     global_context = kwargs.get('global_context', {})
     
+    # Copia del panel tal como lo envió el backend, para calcular el delta al final
+    original_panel = next((dict(p) for p in all_panels if str(p.get('id')) == str(panel_id)), None)
+
     # Pre-process panels to ensure format is consistent with AgentState
     processed_panels = []
     for p in all_panels:
@@ -157,11 +223,13 @@ def regenerate_panel_logic(project_id, panel_id, prompt, scene_description, ball
             return app.invoke(state, config={"recursion_limit": 5})
             
         updated_state = run_traced()
+        if ENABLE_DELTA_RESULTS:
+            updated_state = panel_delta_result(original_panel, updated_state, panel_id)
         # Notify backend via SQS
-        notify_completion(project_id, updated_state, "regenerate_panel")
+        notify_completion(project_id, updated_state, "regenerate_panel", kwargs.get("run_id"))
         return updated_state
     except Exception as e:
-        notify_completion(project_id, {"error": str(e)}, "regenerate_panel")
+        notify_completion(project_id, {"error": str(e)}, "regenerate_panel", kwargs.get("run_id"))
         return {"error": str(e)}
 
 def regenerate_merge_logic(project_id, instructions, **kwargs):
@@ -207,11 +275,13 @@ def regenerate_merge_logic(project_id, instructions, **kwargs):
             return app.invoke(state, config={"recursion_limit": 10})
             
         updated_state = run_traced()
+        if ENABLE_DELTA_RESULTS:
+            updated_state = merge_delta_result(updated_state)
         # Notify backend via SQS
-        notify_completion(project_id, updated_state, "regenerate_merge")
+        notify_completion(project_id, updated_state, "regenerate_merge", kwargs.get("run_id"))
         return updated_state
     except Exception as e:
-        notify_completion(project_id, {"error": str(e)}, "regenerate_merge")
+        notify_completion(project_id, {"error": str(e)}, "regenerate_merge", kwargs.get("run_id"))
         return {"error": str(e)}
 
 @app.entrypoint
@@ -221,7 +291,11 @@ def agent_invocation(payload, context):
     Handles 'generate', 'regenerate_panel', and 'regenerate_merge'.
     """
     print(f"--- BEDROCK AGENT INVOCATION ---")
-    print(f"Payload: {payload}")
+    if wire.is_packed(payload):
+        print(f"Payload: compact wire message ({'offloaded' if 'ref' in payload else 'inline'})")
+        payload = wire.unpack(payload, fetch=_wire_fetch)
+    else:
+        print(f"Payload: {payload}")
     action = payload.get("action", "generate")
     project_id = payload.get("project_id")
     
@@ -232,21 +306,29 @@ def agent_invocation(payload, context):
         return {"status": "error", "message": "Missing action in payload"}
 
     try:
-        if action == "generate":
-            result = generate_comic_logic(**payload)
-        elif action == "regenerate_panel":
-            result = regenerate_panel_logic(**payload)
-        elif action == "regenerate_merge":
-            result = regenerate_merge_logic(**payload)
-        else:
-            return {"status": "error", "message": f"Unknown action: {action}"}
-
-        return {
+        with metrics.collect_run(action) as run_metrics, \
+                tracing.collect_trace(action, project_id, payload.get("run_id")), \
+                canon_session():
+            if action == "generate":
+                result = generate_comic_logic(**payload)
+            elif action == "regenerate_panel":
+                result = regenerate_panel_logic(**payload)
+            elif action == "regenerate_merge":
+                result = regenerate_merge_logic(**payload)
+            else:
+                return {"status": "error", "message": f"Unknown action: {action}"}
+            if run_metrics is not None and isinstance(result, dict) and result.get("error"):
+                run_metrics.outcome = "error"
+
+        response = {
             "status": "success",
             "action": action,
             "project_id": project_id,
             "result": result
         }
+        if run_metrics is not None:
+            response["metrics"] = run_metrics.summary()
+        return response
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
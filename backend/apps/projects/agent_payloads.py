@@ -0,0 +1,153 @@
+"""
+Payload builders for agent invocations.
+
+All three entry points (generate, regenerate_panel, regenerate_merge) share the
+same query plan: one query for the panels (page joined), one per entity kind for
+characters/sceneries plus one prefetch for their reference images. The
+character/scenery part of global_context is memoized per project and keyed on
+those entities' own count and newest revision, so panel, page or status writes
+(which move the project revision on every request) do not invalidate it.
+"""
+import copy
+import threading
+from collections import OrderedDict
+
+from django.db.models import Count, Max
+
+from .models import Panel
+
+_GLOBAL_CONTEXT_CACHE_SIZE = 256
+_global_context_cache = OrderedDict()
+_global_context_lock = threading.Lock()
+
+
+def _get_all_image_urls(entity):
+    """Returns a list of all image URLs for a Character or Scenery (primary + references)."""
+    urls = []
+    if entity.image:
+        urls.append(entity.image.name)
+    for ref in entity.reference_images.all():
+        if ref.image:
+            urls.append(ref.image.name)
+    return urls
+
+
+def _serialize_entity(entity):
+    return {
+        "name": entity.name,
+        "description": entity.description,
+        "metadata": entity.metadata,
+        "image_url": entity.image.name if entity.image else "",
+        "image_urls": _get_all_image_urls(entity)
+    }
+
+
+def _entities_version(project):
+    """
+    (count, newest revision) of the project's characters and of its sceneries.
+    Revisions only grow, so any write or delete of an entity or of its reference
+    images moves it.
+    """
+    return tuple(
+        tuple(queryset.aggregate(n=Count('id'), revision=Max('revision')).values())
+        for queryset in (project.characters.all(), project.sceneries.all())
+    )
+
+
+def build_global_context(project):
+    """Returns the agent's global_context for the project; entities are memoized per _entities_version."""
+    # Versión leída antes que los datos: el contenido cacheado es al menos tan nuevo como su clave
+    version = _entities_version(project)
+    cache_key = str(project.id)
+    with _global_context_lock:
+        cached = _global_context_cache.get(cache_key)
+        if cached and cached[0] == version:
+            _global_context_cache.move_to_end(cache_key)
+            entities = cached[1]
+        else:
+            entities = None
+
+    if entities is None:
+        entities = {
+            "characters": [_serialize_entity(c) for c in project.characters.prefetch_related('reference_images')],
+            "sceneries": [_serialize_entity(s) for s in project.sceneries.prefetch_related('reference_images')]
+        }
+        with _global_context_lock:
+            _global_context_cache[cache_key] = (version, entities)
+            _global_context_cache.move_to_end(cache_key)
+            while len(_global_context_cache) > _GLOBAL_CONTEXT_CACHE_SIZE:
+                _global_context_cache.popitem(last=False)
+
+    return {
+        "description": project.description,
+        "world_bible": project.world_bible,
+        "style_guide": project.style_guide,
+        # Copia: el llamador puede modificar el payload sin tocar la entrada cacheada
+        **copy.deepcopy(entities),
+    }
+
+
+def serialize_project_panels(project):
+    """All project panels in reading order, in the agent's panel format."""
+    panels = (
+        Panel.objects.filter(project=project)
+        .select_related('page')
+        .order_by('page__page_number', 'order')
+    )
+    return [{
+        "id": p.id,
+        "page_number": p.page.page_number,
+        "order_in_page": p.order,
+        "prompt": p.prompt,
+        "scene_description": p.scene_description,
+        "image_url": p.image.name if p.image else "",
+        "status": p.status,
+        "balloons": p.balloons,
+        "layout": p.layout,
+        "character_refs": p.character_refs,
+        "scenery_refs": p.scenery_refs
+    } for p in panels]
+
+
+def build_generate_payload(project, sources, request_data):
+    return {
+        "project_id": str(project.id),
+        "sources": sources,
+        "max_pages": project.max_pages,
+        "max_panels": len(request_data.get("panels", [])),
+        "layout_style": project.layout_style,
+        "plan_only": request_data.get("plan_only", False),
+        "panels": request_data.get("panels", []),
+        "global_context": build_global_context(project)
+    }
+
+
+def build_regenerate_panel_payload(project, panel, instructions, use_current_as_base):
+    return {
+        "action": "regenerate_panel",
+        "project_id": str(project.id),
+        "panel_id": panel.id,
+        "page_number": panel.page.page_number,
+        "prompt": panel.prompt,
+        "scene_description": panel.scene_description,
+        "balloons": panel.balloons,
+        "panel_style": panel.panel_style or '',
+        "instructions": instructions,
+        "current_image_url": panel.image.name if panel.image and use_current_as_base else None,
+        "reference_image_url": panel.reference_image.name if panel.reference_image else None,
+        "panels": serialize_project_panels(project),
+        "global_context": build_global_context(project)
+    }
+
+
+def build_regenerate_merge_payload(project, instructions, page_number):
+    return {
+        "action": "regenerate_merge",
+        "project_id": str(project.id),
+        "instructions": instructions,
+        "page_number": page_number,
+        "world_model_summary": project.world_model_summary,
+        "panels": serialize_project_panels(project),
+        "global_context": build_global_context(project)
+    }
+
@@ -1,8 +1,82 @@
 import boto3
 import json
 import os
+import uuid
 from botocore.config import Config
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from . import wire
+
+
+def _wire_offload(project_id):
+    """Stores an oversized wire body next to the project's files and returns its key."""
+    def offload(blob):
+        return default_storage.save(f"projects/{project_id}/wire/{uuid.uuid4()}.json.z", ContentFile(blob))
+    return offload
+
+
+def _wire_fetch(key):
+    with default_storage.open(key, 'rb') as f:
+        return f.read()
+
+
+def pack_agent_message(payload, project_id):
+    """Encodes a payload for the agent, honouring AGENT_COMPACT_WIRE."""
+    if not getattr(settings, 'AGENT_COMPACT_WIRE', False):
+        return payload
+    return wire.pack(
+        payload,
+        offload=_wire_offload(project_id),
+        inline_limit=getattr(settings, 'AGENT_WIRE_INLINE_LIMIT', wire.DEFAULT_INLINE_LIMIT)
+    )
+
+
+def unpack_agent_message(message):
+    """Decodes a message coming from the agent (compact envelope or legacy plain JSON)."""
+    return wire.unpack(message, fetch=_wire_fetch)
+
+
+# Lecturas del stream en bloques grandes (antes: iter_lines(chunk_size=1), un byte por lectura)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def iter_sse_data(chunks):
+    """
+    Incremental SSE parser: yields the text of every `data:` line as soon as
+    the line is complete. Partial lines are kept in a buffer between chunks,
+    so the whole stream is processed in linear time.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if line.startswith(b"data: "):
+                yield line[6:].decode("utf-8")
+        del buffer[:start]
+    line = bytes(buffer).rstrip(b"\r")
+    if line.startswith(b"data: "):
+        yield line[6:].decode("utf-8")
+
+
+def _emit_progress(on_event, data):
+    try:
+        event = json.loads(data)
+    except json.JSONDecodeError:
+        return
+    try:
+        on_event(event)
+    except Exception as e:
+        print(f"WARNING: Agent progress callback failed: {e}")
+
 
 class BedrockAgentClient:
     """
@@ -24,9 +98,13 @@ class BedrockAgentClient:
         )
         self.agent_arn = os.getenv('BEDROCK_AGENT_ARN')
 
-    def invoke(self, payload, project_id):
+    def invoke(self, payload, project_id, on_event=None):
         """
         Invokes the agent as per the provided boto3 example.
+
+        For event-stream responses, `on_event(event)` (optional) is called with
+        every SSE data payload that parses as JSON, as soon as the chunk holding it
+        (up to STREAM_CHUNK_SIZE bytes) has been read.
         """
         if not self.agent_arn:
             raise ValueError("BEDROCK_AGENT_ARN is not configured in environment variables.")
@@ -35,40 +113,28 @@ class BedrockAgentClient:
             boto3_response = self.client.invoke_agent_runtime(
                 agentRuntimeArn=self.agent_arn,
                 qualifier="DEFAULT",
-                payload=json.dumps(payload)
+                payload=json.dumps(pack_agent_message(payload, project_id))
             )
 
-            response_content = []
             if "text/event-stream" in boto3_response.get("contentType", ""):
-                for line in boto3_response["response"].iter_lines(chunk_size=1):
-                    if line:
-                        decoded_line = line.decode("utf-8")
-                        if decoded_line.startswith("data: "):
-                            content_data = decoded_line[6:]
-                            response_content.append(content_data)
-                
+                data_parts = []
+                for data in iter_sse_data(boto3_response["response"].iter_chunks(chunk_size=STREAM_CHUNK_SIZE)):
+                    data_parts.append(data)
+                    if on_event is not None:
+                        _emit_progress(on_event, data)
+
                 # Join and attempt to parse as JSON if it's the final result
-                full_text = "".join(response_content)
+                full_text = "".join(data_parts)
                 try:
                     return json.loads(full_text)
                 except json.JSONDecodeError:
                     return {"status": "success", "raw_response": full_text}
             else:
-                full_bytes = b""
-                for event in boto3_response.get("response", []):
-                    # Each event in the response might be a chunk of the total payload
-                    if isinstance(event, bytes):
-                        full_bytes += event
-                    else:
-                        # Fallback for unexpected format
-                        full_bytes += str(event).encode("utf-8")
-                
-                if full_bytes:
-                    full_text = full_bytes.decode("utf-8")
-                    try:
-                        return json.loads(full_text)
-                    except json.JSONDecodeError as e:
-                        raise e
+                body = boto3_response.get("response")
+                # Respuesta completa de una vez (iterar el StreamingBody lee en bloques de 1 KB)
+                data = body.read() if body is not None else b""
+                if data:
+                    return json.loads(data.decode("utf-8"))
                 return {"status": "error", "message": "No response events received from agent."}
 
         except Exception as e:
@@ -0,0 +1,250 @@
+"""
+Agent invocation queue.
+
+Views no longer start a thread per request: they persist the invocation as a
+queued AgentRun (payload included) and wake the dispatcher. A bounded set of
+worker threads claims queued runs from the database, oldest first, and invokes
+the agent through one shared BedrockAgentClient.
+
+Because the queue lives in the database, nothing is lost if a gunicorn worker
+restarts: each web worker starts a sweeper (core_project/wsgi.py) that wakes
+the dispatcher at startup and every AGENT_DISPATCH_SWEEP_SECONDS, so runs left
+queued by a previous worker are claimed without waiting for a new enqueue. The
+same dispatcher can run out of process instead (``AGENT_DISPATCH_MODE=external``
++ ``manage.py dispatch_agent_runs``).
+
+A claimed run keeps its payload until the agent accepts the invocation, and
+'dispatched' is a lease (``dispatched_at``) of AGENT_DISPATCH_LEASE_SECONDS.
+When it expires the sweep re-queues the run if it still has its payload (the
+worker died before the agent took it) or fails it if the agent took it but no
+result ever arrived. Invocations that never reached the agent (connection
+errors, rejected requests) fail straight away.
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .agent_utils import BedrockAgentClient
+from .models import AgentRun, Project
+
+
+# Acciones que se repiten en ráfaga mientras el usuario ajusta prompts
+DEBOUNCED_ACTIONS = ('regenerate_panel', 'regenerate_merge')
+# El agente nunca recibió (o rechazó) la invocación: no llegará ningún resultado
+NOT_ACCEPTED_ERRORS = (BotoConnectionError, ClientError, ValueError)
+
+
+def enqueue_agent_run(project, payload):
+    """
+    Queues an agent invocation and returns its AgentRun.
+
+    Regenerations wait AGENT_REGENERATE_DEBOUNCE_SECONDS before being sent, and
+    a newer request for the same scope (same panel, same page merge, whole
+    project) supersedes older runs: queued ones are never sent, and the result
+    of one already in flight is ignored when it arrives.
+    """
+    action = payload.get("action", "generate")
+    debounce = float(getattr(settings, 'AGENT_REGENERATE_DEBOUNCE_SECONDS', 0)) if action in DEBOUNCED_ACTIONS else 0
+    # El id va dentro del payload desde el INSERT: nunca hay una fila 'queued' sin payload
+    run_id = uuid.uuid4()
+    payload["run_id"] = str(run_id)
+    with transaction.atomic():
+        run = AgentRun.objects.create(
+            id=run_id,
+            project=project,
+            action=action,
+            scope=AgentRun.scope_for(action, panel_id=payload.get("panel_id"), page_number=payload.get("page_number")),
+            status='queued',
+            payload=payload,
+            not_before=timezone.now() + timedelta(seconds=debounce) if debounce else None
+        )
+
+        AgentRun.objects.filter(
+            project=project, scope=run.scope, status__in=('queued', 'dispatched'), created_at__lte=run.created_at
+        ).exclude(pk=run.pk).update(status='superseded', payload=None)
+
+        if getattr(settings, 'AGENT_DISPATCH_MODE', 'inprocess') == 'inprocess':
+            transaction.on_commit(lambda: dispatcher.notify(delay=debounce))
+    return run
+
+
+def claim_next_run():
+    """Atomically moves the oldest due queued run to 'dispatched' and returns it (None if there is none)."""
+    while True:
+        run = (
+            AgentRun.objects.filter(status='queued')
+            .filter(Q(not_before__isnull=True) | Q(not_before__lte=timezone.now()))
+            .order_by('created_at')
+            .first()
+        )
+        if run is None:
+            return None
+        # Claim condicional: si otro proceso lo tomó (o fue reemplazado) se prueba con el siguiente
+        now = timezone.now()
+        if AgentRun.objects.filter(pk=run.pk, status='queued').update(status='dispatched', dispatched_at=now):
+            run.status = 'dispatched'
+            run.dispatched_at = now
+            return run
+
+
+def _fail_project(project_id, error):
+    project = Project.objects.filter(pk=project_id).first()
+    if project:
+        project.status = 'failed'
+        project.last_error = error
+        project.save()
+
+
+def reap_expired_runs(lease=None):
+    """
+    Handles 'dispatched' runs whose lease expired and returns how many were
+    re-queued: runs still holding their payload were never accepted by the agent
+    and go back to the queue; the rest were accepted but their result never
+    came, so they are failed (and their project too, unless it has other runs
+    pending).
+    """
+    lease = float(lease if lease is not None else getattr(settings, 'AGENT_DISPATCH_LEASE_SECONDS', 1800))
+    expired = AgentRun.objects.filter(status='dispatched', dispatched_at__lt=timezone.now() - timedelta(seconds=lease))
+    requeued = expired.filter(payload__isnull=False).update(status='queued', dispatched_at=None)
+
+    lost = dict(expired.filter(payload__isnull=True).values_list('pk', 'project_id'))
+    if lost:
+        AgentRun.objects.filter(pk__in=list(lost), status='dispatched').update(status='failed', applied_at=timezone.now())
+        for project_id in set(lost.values()):
+            if not AgentRun.objects.filter(project_id=project_id, status__in=('queued', 'dispatched')).exists():
+                _fail_project(project_id, "El Agente no devolvió ningún resultado.")
+        print(f"WARNING: {len(lost)} agent run(s) got no result within {lease:.0f}s and were failed.")
+    return requeued
+
+
+class AgentDispatcher:
+    """Bounded pool of threads that drain the queued AgentRuns."""
+
+    def __init__(self, workers=None, client_factory=BedrockAgentClient):
+        self.workers = workers or int(getattr(settings, 'AGENT_DISPATCH_WORKERS', 4))
+        self._client_factory = client_factory
+        self._client = None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._wakeups = 0
+        self._stopping = False
+        self._sweeper_pid = None
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe: one client (and connection pool) per process
+        with self._lock:
+            if self._client is None:
+                self._client = self._client_factory()
+            return self._client
+
+    def notify(self, delay=0):
+        """Signals that there may be queued runs; starts a worker if below the limit."""
+        if delay:
+            # The run is not due yet: wake up again when its debounce window closes
+            timer = threading.Timer(delay, self.notify)
+            timer.daemon = True
+            timer.start()
+            return
+        with self._lock:
+            self._wakeups += 1
+            if self._stopping or self._active >= self.workers:
+                return
+            self._active += 1
+        threading.Thread(target=self._worker, name="agent-dispatch", daemon=True).start()
+
+    def start_sweeper(self, interval=None):
+        """
+        Wakes the dispatcher now and then every `interval` seconds, so queued runs
+        left by a restarted worker (or whose notify() was lost) are still claimed.
+        Idempotent per process.
+        """
+        interval = float(interval if interval is not None else getattr(settings, 'AGENT_DISPATCH_SWEEP_SECONDS', 30))
+        with self._lock:
+            # Tras un fork el hilo del padre no existe en el hijo: se arranca de nuevo
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+
+        def sweep():
+            while True:
+                with self._lock:
+                    if self._stopping:
+                        return
+                self.sweep()
+                if interval <= 0:
+                    return
+                time.sleep(interval)
+
+        threading.Thread(target=sweep, name="agent-dispatch-sweeper", daemon=True).start()
+
+    def sweep(self):
+        """Reclaims expired leases, then wakes the workers."""
+        try:
+            reap_expired_runs()
+        except Exception as e:
+            print(f"ERROR: Agent run sweep failed: {e}")
+        finally:
+            connection.close()
+        self.notify()
+
+    def stop(self):
+        """Workers finish the invocation they are running and exit."""
+        with self._lock:
+            self._stopping = True
+
+    @property
+    def active(self):
+        with self._lock:
+            return self._active
+
+    def _worker(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._stopping:
+                        return
+                    seen = self._wakeups
+                run = claim_next_run()
+                if run is not None:
+                    self.execute(run)
+                    continue
+                with self._lock:
+                    # Nothing claimable and no notify() since we looked: this worker can exit
+                    if self._wakeups == seen:
+                        return
+        finally:
+            with self._lock:
+                self._active -= 1
+            connection.close()
+
+    def execute(self, run):
+        try:
+            self.client.invoke(run.payload or {}, run.project_id)
+        except NOT_ACCEPTED_ERRORS as e:
+            print(f"ERROR: Agent invocation {run.pk} ({run.action}) was not accepted: {e}")
+            AgentRun.objects.filter(pk=run.pk, status='dispatched').update(
+                status='failed', payload=None, applied_at=timezone.now()
+            )
+            _fail_project(run.project_id, f"Bedrock Agent error: {e}")
+        except Exception as e:
+            # La ejecución se deja en 'dispatched': tras un timeout de lectura el agente puede
+            # seguir trabajando y su resultado todavía debe poder aplicarse (o vence el lease).
+            print(f"ERROR: Agent invocation {run.pk} ({run.action}) failed: {e}")
+            AgentRun.objects.filter(pk=run.pk).update(payload=None)
+            _fail_project(run.project_id, f"Bedrock Agent error: {e}")
+        else:
+            # Aceptada: ya no hay que reenviarla aunque este proceso muera
+            AgentRun.objects.filter(pk=run.pk).update(payload=None)
+        finally:
+            close_old_connections()
+
+dispatcher = AgentDispatcher()
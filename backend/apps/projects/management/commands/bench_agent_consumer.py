@@ -0,0 +1,94 @@
+import json
+import random
+import time
+import uuid
+import boto3
+from django.core.management.base import BaseCommand, CommandError
+from apps.projects.sqs_consumer import AgentResultConsumer
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks consume_agent_results throughput against a local SQS stand-in '
+        '(moto in-process by default, or ElasticMQ via --endpoint-url). '
+        'Results are applied by a synthetic processor that sleeps, so no database is touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--projects', type=int, default=20, help='Distinct project ids in the workload.')
+        parser.add_argument('--process-ms', type=float, default=20.0,
+                            help='Simulated reconciliation time per message.')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--endpoint-url', default=None,
+                            help='Use a running SQS-compatible server (e.g. http://localhost:9324 for ElasticMQ).')
+
+    def handle(self, *args, **options):
+        if options['endpoint_url']:
+            self._run_all(options, boto3.client(
+                'sqs', region_name='us-east-1', endpoint_url=options['endpoint_url'],
+                aws_access_key_id='x', aws_secret_access_key='x'
+            ))
+            return
+
+        try:
+            from moto import mock_aws
+        except ImportError:
+            raise CommandError('moto is not installed: pip install moto, or pass --endpoint-url for ElasticMQ.')
+        with mock_aws():
+            self._run_all(options, boto3.client('sqs', region_name='us-east-1'))
+
+    def _run_all(self, options, sqs):
+        scenarios = [
+            ("legacy (batch=1, workers=1)", 1, 1),
+            ("batched (batch=10, workers=1)", 10, 1),
+            (f"batched + pool (batch=10, workers={options['workers']})", 10, options['workers']),
+        ]
+        self.stdout.write(
+            f"{options['messages']} messages over {options['projects']} projects, "
+            f"{options['process_ms']} ms per message"
+        )
+        for label, batch_size, workers in scenarios:
+            elapsed, ordered = self._run_scenario(sqs, options, batch_size, workers)
+            rate = options['messages'] / elapsed if elapsed else 0
+            self.stdout.write(
+                f"{label:<42} {elapsed:7.2f}s  {rate:8.1f} msg/s  per-project serialized: {ordered}"
+            )
+
+    def _run_scenario(self, sqs, options, batch_size, workers):
+        queue_url = sqs.create_queue(QueueName=f"bench-{uuid.uuid4().hex[:8]}")['QueueUrl']
+        projects = [str(uuid.uuid4()) for _ in range(options['projects'])]
+        counters = {p: 0 for p in projects}
+        bodies = []
+        for _ in range(options['messages']):
+            project_id = random.choice(projects)
+            bodies.append({"project_id": project_id, "action": "regenerate_panel", "seq": counters[project_id]})
+            counters[project_id] += 1
+        for start in range(0, len(bodies), 10):
+            sqs.send_message_batch(QueueUrl=queue_url, Entries=[
+                {"Id": str(i), "MessageBody": json.dumps(body)}
+                for i, body in enumerate(bodies[start:start + 10])
+            ])
+
+        delay = options['process_ms'] / 1000.0
+        last_seen = {}
+        ordered = [True]
+
+        def processor(project_id, body):
+            # Standard queues do not guarantee FIFO delivery; only check that a lane never overlaps itself
+            previous = last_seen.get(project_id)
+            if previous == "running":
+                ordered[0] = False
+            last_seen[project_id] = "running"
+            time.sleep(delay)
+            last_seen[project_id] = "done"
+            return {"status": "success"}
+
+        consumer = AgentResultConsumer(
+            sqs, queue_url, processor=processor, workers=workers, batch_size=batch_size,
+            wait_time=1, visibility_timeout=30, log=lambda msg: None
+        )
+        started = time.perf_counter()
+        consumer.run(max_messages=options['messages'])
+        elapsed = time.perf_counter() - started
+        sqs.delete_queue(QueueUrl=queue_url)
+        return elapsed, ordered[0]
@@ -0,0 +1,103 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from apps.projects.models import Project, Page, Panel, ProjectNote
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a throwaway test database (N projects x M panels) and times the hot '
+        'project/page/panel queries, printing the query plan of each one.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=1000)
+        parser.add_argument('--panels', type=int, default=100, help='Panels per project.')
+        parser.add_argument('--panels-per-page', type=int, default=20)
+        parser.add_argument('--samples', type=int, default=200, help='Projects sampled per query.')
+        parser.add_argument('--no-explain', action='store_true', help='Skip the EXPLAIN output.')
+
+    def handle(self, *args, **options):
+        # Nunca sobre la base de datos real: se crea (y destruye) la base de pruebas de Django
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            project_ids = self._seed(options)
+            self._bench(project_ids, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _seed(self, options):
+        started = time.perf_counter()
+        pages_per_project = max(1, options['panels'] // options['panels_per_page'])
+        projects = Project.objects.bulk_create(
+            [Project(name=f"bench-{i}") for i in range(options['projects'])], batch_size=1000
+        )
+        pages = Page.objects.bulk_create([
+            Page(project=project, page_number=n + 1)
+            for project in projects for n in range(pages_per_project)
+        ], batch_size=2000)
+        Panel.objects.bulk_create([
+            Panel(page=page, project_id=page.project_id, order=o, prompt="Cinematic comic panel", status="completed")
+            for page in pages for o in range(options['panels_per_page'])
+        ], batch_size=5000)
+        ProjectNote.objects.bulk_create([
+            ProjectNote(project=project, title=t, note_type=t)
+            for project in projects for t in ("script", "style", "general")
+        ], batch_size=3000)
+        self.stdout.write(
+            f"Seeded {len(projects)} projects, {len(pages)} pages, "
+            f"{Panel.objects.count()} panels in {time.perf_counter() - started:.1f}s ({connection.vendor})"
+        )
+        return [p.id for p in projects]
+
+    def _queries(self, project_id, page_number, order):
+        return {
+            "page by (project, page_number)":
+                lambda: Page.objects.filter(project_id=project_id, page_number=page_number).first(),
+            "panel by (project, page_number, order)":
+                lambda: Panel.objects.filter(
+                    project_id=project_id, page__page_number=page_number, order=order
+                ).first(),
+            "project panel scan (reading order)":
+                lambda: list(
+                    Panel.objects.filter(project_id=project_id)
+                    .select_related('page').order_by('page__page_number', 'order')
+                ),
+            "note by (project, note_type)":
+                lambda: ProjectNote.objects.filter(project_id=project_id, note_type="script").first(),
+        }
+
+    def _querysets(self, project_id):
+        return {
+            "page by (project, page_number)": Page.objects.filter(project_id=project_id, page_number=1),
+            "panel by (project, page_number, order)": Panel.objects.filter(
+                project_id=project_id, page__page_number=1, order=3
+            ),
+            "project panel scan (reading order)": Panel.objects.filter(project_id=project_id)
+                .select_related('page').order_by('page__page_number', 'order'),
+            "note by (project, note_type)": ProjectNote.objects.filter(project_id=project_id, note_type="script"),
+        }
+
+    def _bench(self, project_ids, options):
+        sample = random.sample(project_ids, min(options['samples'], len(project_ids)))
+        pages_per_project = max(1, options['panels'] // options['panels_per_page'])
+        timings = {}
+        for project_id in sample:
+            queries = self._queries(
+                project_id, random.randint(1, pages_per_project), random.randrange(options['panels_per_page'])
+            )
+            for label, run in queries.items():
+                started = time.perf_counter()
+                run()
+                timings.setdefault(label, []).append((time.perf_counter() - started) * 1000)
+
+        self.stdout.write(f"\n{'query':<40} {'mean ms':>9} {'p95 ms':>9}")
+        for label, values in timings.items():
+            values.sort()
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            self.stdout.write(f"{label:<40} {statistics.mean(values):9.3f} {p95:9.3f}")
+
+        if not options['no_explain']:
+            for label, queryset in self._querysets(sample[0]).items():
+                self.stdout.write(f"\n-- {label}\n{queryset.explain()}")
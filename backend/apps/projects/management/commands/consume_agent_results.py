@@ -1,14 +1,24 @@
-import time
-import json
 import os
+import signal
 import boto3
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from apps.projects.result_processor import process_agent_result
+from apps.projects.sqs_consumer import AgentResultConsumer, SQS_MAX_BATCH
 
 class Command(BaseCommand):
     help = 'Consumes agent results from SQS queue'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=int(os.getenv('AGENT_RESULTS_WORKERS', '4')),
+                            help='Threads applying results (different projects run in parallel).')
+        parser.add_argument('--batch-size', type=int, default=SQS_MAX_BATCH,
+                            help='Messages per receive call (max 10).')
+        parser.add_argument('--wait-time', type=int, default=20, help='Long polling wait, in seconds.')
+        parser.add_argument('--visibility-timeout', type=int, default=120,
+                            help='Visibility timeout (seconds) kept extended while a message is being processed.')
+        parser.add_argument('--endpoint-url', default=os.getenv('AWS_SQS_ENDPOINT_URL'),
+                            help='Custom SQS endpoint (e.g. ElasticMQ for local runs).')
+
     def handle(self, *args, **options):
         queue_url = os.getenv('AWS_SQS_QUEUE_URL')
         if not queue_url:
@@ -19,43 +29,30 @@ class Command(BaseCommand):
             'sqs',
             region_name=os.getenv('AWS_S3_REGION_NAME', 'us-east-1'),
             aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            endpoint_url=options['endpoint_url']
+        )
+
+        consumer = AgentResultConsumer(
+            sqs,
+            queue_url,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            wait_time=options['wait_time'],
+            visibility_timeout=options['visibility_timeout'],
+            log=self.stdout.write
         )
 
-        self.stdout.write(self.style.SUCCESS(f'Starting SQS consumer on {queue_url}...'))
-
-        while True:
-            try:
-                # Long polling
-                response = sqs.receive_message(
-                    QueueUrl=queue_url,
-                    MaxNumberOfMessages=1,
-                    WaitTimeSeconds=20,
-                    AttributeNames=['All']
-                )
-
-                messages = response.get('Messages', [])
-                if not messages:
-                    # self.stdout.write('No messages, continuing...')
-                    continue
-
-                for message in messages:
-                    receipt_handle = message['ReceiptHandle']
-                    body = json.loads(message['Body'])
-                    
-                    project_id = body.get('project_id')
-                    self.stdout.write(f'Processing result for project: {project_id}')
-                    
-                    # Process the result using the shared logic
-                    result = process_agent_result(project_id, body)
-                    
-                    if result.get("status") in ["success", "error_logged", "no_panels_found"]:
-                        # Delete message if processed successfully (even if it's a known error)
-                        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-                        self.stdout.write(self.style.SUCCESS(f'Successfully processed/deleted message for {project_id}'))
-                    else:
-                        self.stdout.write(self.style.WARNING(f'Processing failed for {project_id}: {result.get("message")}'))
-
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Error in consumer loop: {str(e)}'))
-                time.sleep(5) # Wait before retrying
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING('Shutdown requested, finishing in-flight messages...'))
+            consumer.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Starting SQS consumer on {queue_url} '
+            f'(workers={consumer.workers}, batch={consumer.batch_size})...'
+        ))
+        consumer.run()
+        self.stdout.write(self.style.SUCCESS(f'Consumer stopped: {consumer.stats}'))
@@ -0,0 +1,41 @@
+import signal
+import time
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.projects.dispatch import AgentDispatcher
+
+class Command(BaseCommand):
+    help = 'Dispatches queued agent runs to Bedrock (use with AGENT_DISPATCH_MODE=external)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.AGENT_DISPATCH_WORKERS,
+                            help='Concurrent agent invocations.')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds between checks for newly queued runs.')
+
+    def handle(self, *args, **options):
+        dispatcher = AgentDispatcher(workers=options['workers'])
+        stopping = []
+
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING('Shutdown requested, waiting for running invocations...'))
+            stopping.append(signum)
+            dispatcher.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.stdout.write(self.style.SUCCESS(f'Dispatching agent runs with {dispatcher.workers} workers...'))
+        next_sweep = 0
+        while not stopping:
+            if time.monotonic() >= next_sweep:
+                # Leases vencidos: reencola o da por fallidos los runs sin resultado
+                dispatcher.sweep()
+                next_sweep = time.monotonic() + settings.AGENT_DISPATCH_SWEEP_SECONDS
+            else:
+                dispatcher.notify()
+            time.sleep(options['poll_interval'])
+
+        while dispatcher.active:
+            time.sleep(1)
+        self.stdout.write(self.style.SUCCESS('Dispatcher stopped.'))
@@ -0,0 +1,68 @@
+import json
+import os
+from datetime import timedelta
+import boto3
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from apps.projects.storage_gc import StorageGC, DEFAULT_PREFIXES
+
+class Command(BaseCommand):
+    help = (
+        'Deletes media objects no longer referenced by any panel, page, panel version, '
+        'character, scenery, note or canon document (dry run unless --delete is given).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true',
+                            help='Actually delete the orphaned objects (default is a dry run).')
+        parser.add_argument('--grace-hours', type=float, default=24.0,
+                            help='Never delete objects modified more recently than this.')
+        parser.add_argument('--prefix', action='append', dest='prefixes',
+                            help=f'Prefix to sweep (repeatable, default: {", ".join(DEFAULT_PREFIXES)}).')
+        parser.add_argument('--workers', type=int, default=8, help='Parallel list / read / delete calls.')
+        parser.add_argument('--endpoint-url', default=os.getenv('AWS_S3_ENDPOINT_URL'),
+                            help='Custom S3 endpoint (e.g. MinIO or moto server for local runs).')
+        parser.add_argument('--show', type=int, default=20, help='Orphaned keys to print.')
+        parser.add_argument('--json', action='store_true', help='Print the metrics as a JSON line.')
+
+    def handle(self, *args, **options):
+        bucket = settings.AWS_STORAGE_BUCKET_NAME
+        if not bucket:
+            raise CommandError('AWS_STORAGE_BUCKET_NAME is not set (media is on the local filesystem).')
+
+        s3 = boto3.client(
+            's3',
+            region_name=settings.AWS_S3_REGION_NAME,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            endpoint_url=options['endpoint_url']
+        )
+        self.collect(s3, bucket, options)
+
+    def collect(self, s3, bucket, options):
+        gc = StorageGC(
+            s3, bucket,
+            grace=timedelta(hours=options['grace_hours']),
+            workers=options['workers'],
+            dry_run=not options['delete'],
+            log=self.stdout.write
+        )
+        orphans = gc.run(tuple(options['prefixes'] or DEFAULT_PREFIXES))
+
+        mode = 'Deleted' if options['delete'] else 'Dry run, would delete'
+        for key in orphans[:options['show']]:
+            self.stdout.write(f"  {key}")
+        if len(orphans) > options['show']:
+            self.stdout.write(f"  ... and {len(orphans) - options['show']} more")
+
+        stats = gc.stats
+        self.stdout.write(self.style.SUCCESS(
+            f"{mode} {stats['orphaned']} orphaned objects ({stats['orphaned_bytes'] / 1e6:.1f} MB) "
+            f"of {stats['listed']} listed; kept {stats['kept_live']} live and {stats['kept_recent']} recent "
+            f"[{stats['live_keys']} live keys, {stats['canon_documents']} canon documents; "
+            f"list {stats['list_seconds']}s, mark {stats['mark_seconds']}s, sweep {stats['sweep_seconds']}s]"
+        ))
+        if stats['delete_errors']:
+            self.stdout.write(self.style.ERROR(f"{stats['delete_errors']} objects could not be deleted."))
+        if options['json']:
+            self.stdout.write(json.dumps({"bucket": bucket, "dry_run": not options['delete'], **stats}))
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("projects", "0017_panel_scenery_refs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="character",
+            name="revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="page",
+            name="revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="panel",
+            name="revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="project",
+            name="revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="scenery",
+            name="revision",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
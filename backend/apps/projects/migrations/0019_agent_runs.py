@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:32
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0018_snapshot_revisions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgentRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('action', models.CharField(max_length=50)),
+                ('scope', models.CharField(default='project', max_length=100)),
+                ('status', models.CharField(default='dispatched', max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='agent_runs', to='projects.project')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['project', 'status', 'scope', 'created_at'], name='projects_ag_project_2f2154_idx')],
+            },
+        ),
+    ]
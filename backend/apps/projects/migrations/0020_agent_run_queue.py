@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0019_agent_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentrun',
+            name='payload',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='agentrun',
+            name='status',
+            field=models.CharField(default='queued', max_length=50),
+        ),
+    ]
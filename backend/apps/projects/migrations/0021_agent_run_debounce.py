@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0020_agent_run_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentrun',
+            name='not_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='agentrun',
+            index=models.Index(fields=['status', 'created_at'], name='projects_ag_status_5e2500_idx'),
+        ),
+    ]
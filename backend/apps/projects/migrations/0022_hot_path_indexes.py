@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:36
+
+import django.db.models.constraints
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def renumber_duplicates(apps, schema_editor):
+    """
+    Makes existing rows satisfy the new unique constraints without deleting data:
+    duplicate pages are moved after the project's last page, and panel orders
+    are renumbered 0..n-1 within every page that has collisions.
+    """
+    Page = apps.get_model('projects', 'Page')
+    Panel = apps.get_model('projects', 'Panel')
+
+    duplicated_pages = (
+        Page.objects.values('project_id', 'page_number')
+        .annotate(n=Count('id')).filter(n__gt=1)
+    )
+    for dup in duplicated_pages:
+        next_number = Page.objects.filter(project_id=dup['project_id']).aggregate(m=Max('page_number'))['m'] + 1
+        extra_pages = Page.objects.filter(
+            project_id=dup['project_id'], page_number=dup['page_number']
+        ).order_by('id')[1:]
+        for page in extra_pages:
+            page.page_number = next_number
+            page.save(update_fields=['page_number'])
+            next_number += 1
+
+    pages_with_collisions = (
+        Panel.objects.values('page_id', 'order')
+        .annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('page_id', flat=True).distinct()
+    )
+    for page_id in list(pages_with_collisions):
+        for index, panel in enumerate(Panel.objects.filter(page_id=page_id).order_by('order', 'id')):
+            if panel.order != index:
+                panel.order = index
+                panel.save(update_fields=['order'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0021_agent_run_debounce'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='character',
+            index=models.Index(fields=['project', 'name'], name='projects_ch_project_da4026_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='projectnote',
+            index=models.Index(fields=['project', 'note_type'], name='projects_pr_project_d0541e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='scenery',
+            index=models.Index(fields=['project', 'name'], name='projects_sc_project_e6c187_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='page',
+            constraint=models.UniqueConstraint(fields=('project', 'page_number'), name='unique_page_number_per_project'),
+        ),
+        migrations.AddConstraint(
+            model_name='panel',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('page', 'order'), name='unique_panel_order_per_page'),
+        ),
+    ]
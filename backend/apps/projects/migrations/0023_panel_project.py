@@ -0,0 +1,25 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Tres migraciones separadas: en PostgreSQL el UPDATE del backfill deja eventos de
+    # triggers de FK pendientes y un ALTER TABLE en la misma transacción falla.
+
+    dependencies = [
+        ("projects", "0022_hot_path_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="panel",
+            name="project",
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="panels",
+                to="projects.project",
+            ),
+        ),
+    ]
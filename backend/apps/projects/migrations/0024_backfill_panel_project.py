@@ -0,0 +1,21 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_panel_project(apps, schema_editor):
+    Page = apps.get_model("projects", "Page")
+    Panel = apps.get_model("projects", "Panel")
+    Panel.objects.filter(project__isnull=True).update(
+        project=Subquery(Page.objects.filter(pk=OuterRef("page_id")).values("project_id")[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("projects", "0023_panel_project"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_panel_project, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("projects", "0024_backfill_panel_project"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="panel",
+            name="project",
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="panels",
+                to="projects.project",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="panel",
+            index=models.Index(fields=["project", "revision"], name="projects_pa_project_3291d3_idx"),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_current_versions(apps, schema_editor):
+    """Every panel that already has an image gets its current render as its first history entry."""
+    Panel = apps.get_model('projects', 'Panel')
+    PanelVersion = apps.get_model('projects', 'PanelVersion')
+    batch = []
+    for panel in Panel.objects.exclude(image='').exclude(image__isnull=True).only('id', 'version', 'image', 'prompt').iterator():
+        batch.append(PanelVersion(panel_id=panel.id, version=panel.version or 1, image_key=panel.image.name, prompt=panel.prompt))
+        if len(batch) >= 1000:
+            PanelVersion.objects.bulk_create(batch)
+            batch = []
+    PanelVersion.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0025_panel_project_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PanelVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField()),
+                ('image_key', models.CharField(max_length=2000)),
+                ('prompt', models.TextField(blank=True)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('duration_ms', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('panel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='projects.panel')),
+                ('run', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='panel_versions', to='projects.agentrun')),
+            ],
+            options={
+                'ordering': ['-version'],
+                'constraints': [models.UniqueConstraint(fields=('panel', 'version'), name='unique_version_per_panel')],
+            },
+        ),
+        migrations.RunPython(backfill_current_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:21
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_existing_leases(apps, schema_editor):
+    """Runs already dispatched get a lease from their creation, so the sweeper can reclaim them."""
+    AgentRun = apps.get_model('projects', 'AgentRun')
+    AgentRun.objects.filter(status='dispatched').update(dispatched_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0026_panel_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentrun',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(start_existing_leases, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 import uuid
 import os
+from .url_signing import signed_url
+from .revisions import RevisionedQuerySet, RevisionedDeleteMixin
 
 def get_project_id(instance):
     if hasattr(instance, 'project'):
@@ -40,24 +42,42 @@ class Project(models.Model):
     max_pages = models.IntegerField(default=3)
     max_panels = models.IntegerField(blank=True, null=True)
     world_model_summary = models.TextField(blank=True, null=True, help_text="Resumen generado por el Agente sobre las reglas del mundo")
+    # Contador monótono del snapshot (ver revisions.py). Nunca se escribe desde save() normal.
+    revision = models.BigIntegerField(default=0, editable=False)
+
+    def save(self, *args, **kwargs):
+        # Un objeto Project en memoria puede tener una revisión obsoleta: no la sobrescribimos.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'revision'
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
-class Page(models.Model):
+class Page(RevisionedDeleteMixin, models.Model):
     project = models.ForeignKey(Project, related_name='pages', on_delete=models.CASCADE)
     page_number = models.IntegerField()
     layout_data = models.JSONField(default=dict) # Posiciones de paneles
     merged_image = models.ImageField(upload_to=page_upload_path, max_length=2000, blank=True, null=True)
+    revision = models.BigIntegerField(default=0, editable=False) # Revisión del proyecto en la última escritura
+    objects = RevisionedQuerySet.as_manager()
 
     @property
     def merged_image_url(self):
-        if self.merged_image:
-            return self.merged_image.url
-        return ""
+        return signed_url(self.merged_image)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'page_number'], name='unique_page_number_per_project'),
+        ]
 
-class Panel(models.Model):
+class Panel(RevisionedDeleteMixin, models.Model):
     page = models.ForeignKey(Page, related_name='panels', on_delete=models.CASCADE)
+    # Copia de page.project (se sincroniza en save()) para recorrer los paneles de un proyecto sin JOIN
+    project = models.ForeignKey(Project, related_name='panels', on_delete=models.CASCADE, editable=False)
     order = models.IntegerField()
     prompt = models.TextField()
     scene_description = models.TextField(blank=True)
@@ -65,11 +85,9 @@ class Panel(models.Model):
 
     @property
     def image_url(self):
-        if self.image:
-            return self.image.url
-        return ""
+        return signed_url(self.image)
     status = models.CharField(max_length=100, default="pending")
-    version = models.IntegerField(default=1)
+    version = models.IntegerField(default=1) # Versión actual (puntero a PanelVersion.version)
     # Metadatos adicionales para consistencia y diálogo
     balloons = models.JSONField(default=list, blank=True)
     layout = models.JSONField(default=dict, blank=True)
@@ -79,13 +97,60 @@ class Panel(models.Model):
     # Context Engineering Overrides
     panel_style = models.TextField(blank=True, null=True, help_text="Override style for this specific panel")
     reference_image = models.ImageField(upload_to=panel_upload_path, max_length=2000, blank=True, null=True)
+    revision = models.BigIntegerField(default=0, editable=False)
+    objects = RevisionedQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        # Sin consulta extra si la página ya está cargada o el proyecto ya se conoce
+        if self.page_id and (self.project_id is None or Panel.page.is_cached(self)):
+            self.project_id = self.page.project_id
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'page' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'project'}
+        super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'revision']),
+        ]
+        constraints = [
+            # Diferida: la reconciliación del agente reordena paneles dentro de una transacción
+            models.UniqueConstraint(
+                fields=['page', 'order'], name='unique_panel_order_per_page',
+                deferrable=models.Deferrable.DEFERRED
+            ),
+        ]
+
+class PanelVersion(models.Model):
+    """
+    Append-only history of a panel's renders. Image objects are referenced by
+    key, never copied: restoring a version only moves Panel.image / Panel.version.
+    """
+    panel = models.ForeignKey(Panel, related_name='versions', on_delete=models.CASCADE)
+    version = models.IntegerField()
+    image_key = models.CharField(max_length=2000)
+    prompt = models.TextField(blank=True)
+    params = models.JSONField(default=dict, blank=True) # Contexto del render (estilo, refs, acción...)
+    run = models.ForeignKey('AgentRun', related_name='panel_versions', on_delete=models.SET_NULL, null=True, blank=True)
+    duration_ms = models.IntegerField(blank=True, null=True) # Desde la petición hasta aplicar el resultado
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def image_url(self):
+        return signed_url(self.image_key)
+
+    class Meta:
+        ordering = ['-version']
+        constraints = [
+            models.UniqueConstraint(fields=['panel', 'version'], name='unique_version_per_panel'),
+        ]
 
 class Asset(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     file_path = models.CharField(max_length=500)
     asset_type = models.CharField(max_length=50) # character, setting, script
 
-class Character(models.Model):
+class Character(RevisionedDeleteMixin, models.Model):
     project = models.ForeignKey(Project, related_name='characters', on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
@@ -94,15 +159,20 @@ class Character(models.Model):
 
     @property
     def image_url(self):
-        if self.image:
-            return self.image.url
-        return ""
+        return signed_url(self.image)
     created_at = models.DateTimeField(auto_now_add=True)
+    revision = models.BigIntegerField(default=0, editable=False)
+    objects = RevisionedQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.name} ({self.project.name})"
 
-class Scenery(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'name']),
+        ]
+
+class Scenery(RevisionedDeleteMixin, models.Model):
     project = models.ForeignKey(Project, related_name='sceneries', on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
@@ -111,14 +181,19 @@ class Scenery(models.Model):
 
     @property
     def image_url(self):
-        if self.image:
-            return self.image.url
-        return ""
+        return signed_url(self.image)
     created_at = models.DateTimeField(auto_now_add=True)
+    revision = models.BigIntegerField(default=0, editable=False)
+    objects = RevisionedQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.name} ({self.project.name})"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'name']),
+        ]
+
 def reference_image_upload_path(instance, filename):
     """Upload path for reference images linked to characters or sceneries."""
     if instance.character:
@@ -151,9 +226,7 @@ class ReferenceImage(models.Model):
 
     @property
     def image_url(self):
-        if self.image:
-            return self.image.url
-        return ""
+        return signed_url(self.image)
 
     def __str__(self):
         owner = self.character or self.scenery
@@ -162,7 +235,7 @@ class ReferenceImage(models.Model):
     class Meta:
         ordering = ['order', 'created_at']
 
-class ProjectNote(models.Model):
+class ProjectNote(RevisionedDeleteMixin, models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     project = models.ForeignKey(Project, related_name='notes', on_delete=models.CASCADE)
     title = models.CharField(max_length=255)
@@ -171,11 +244,61 @@ class ProjectNote(models.Model):
 
     @property
     def file_url(self):
-        if self.file:
-            return self.file.url
-        return ""
+        return signed_url(self.file)
     note_type = models.CharField(max_length=50, default="general") # global, character_note, scenery_note, style
     created_at = models.DateTimeField(auto_now_add=True)
+    objects = RevisionedQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.title} ({self.project.name})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'note_type']),
+        ]
+
+class AgentRun(models.Model):
+    """
+    One agent invocation. Its id travels to the agent as `run_id` and comes back
+    with the result, so this table is also the ledger of processed results.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(Project, related_name='agent_runs', on_delete=models.CASCADE)
+    action = models.CharField(max_length=50) # generate, regenerate_panel, regenerate_merge
+    # Qué parte del proyecto reescribe el resultado: project, panel:<id>, merge:<page> o merge:all
+    scope = models.CharField(max_length=100, default="project")
+    status = models.CharField(max_length=50, default="queued") # queued, dispatched, applied, failed, stale, superseded
+    # Payload pendiente de envío (ver dispatch.py); se vacía cuando el agente acepta la invocación
+    payload = models.JSONField(blank=True, null=True)
+    # Inicio del lease de un run 'dispatched': vencido, el sweeper lo reencola o lo da por fallido
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+    # Ventana de debounce: no se despacha antes de este instante
+    not_before = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(blank=True, null=True)
+
+    FINISHED_STATUSES = ('applied', 'failed', 'stale', 'superseded')
+
+    @staticmethod
+    def scope_for(action, panel_id=None, page_number=None):
+        if action == 'regenerate_panel':
+            return f"panel:{panel_id}"
+        if action == 'regenerate_merge':
+            return f"merge:{page_number}" if page_number else "merge:all"
+        return "project"
+
+    def covering_scopes(self):
+        """Scopes whose newer results make this run's result obsolete."""
+        scopes = {self.scope, "project"}
+        if self.scope.startswith("merge:"):
+            scopes.add("merge:all")
+        return scopes
+
+    def __str__(self):
+        return f"{self.action} [{self.scope}] {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'status', 'scope', 'created_at']),
+            models.Index(fields=['status', 'created_at']),
+        ]
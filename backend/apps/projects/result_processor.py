@@ -1,209 +1,408 @@
-from .models import Project, Page, Panel, Character, Scenery
+import uuid
 
-def process_agent_result(project_id, data):
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Project, Page, Panel, PanelVersion, Character, Scenery, AgentRun
+from .agent_utils import unpack_agent_message
+
+
+def _clean_image_key(image_url):
+    """Storage key for an image reference sent by the agent (drops query strings and bucket URLs)."""
+    raw_url = image_url.split('?')[0]
+    # If it's a full URL (contains http), try to extract only the path after the bucket
+    # This protects against accidental corruption if the agent echoes back a full URL
+    if "http" in raw_url:
+        parts = raw_url.split('/')
+        if "projects" in parts:
+            idx = parts.index("projects")
+            return "/".join(parts[idx:])
+    return raw_url
+
+
+def _merge_balloons(existing_balloons, new_balloons_list):
+    """ENHANCED BALLOON MERGE: Match by content to preserve interactive props"""
+    eb_map = {}
+    for eb in existing_balloons or []:
+        key = f"{eb.get('character', '')}:{eb.get('text', '')[:30]}".lower().strip()
+        eb_map[key] = eb
+
+    merged = []
+    for nb in new_balloons_list:
+        nb_key = f"{nb.get('character', '')}:{nb.get('text', '')[:30]}".lower().strip()
+        if nb_key in eb_map:
+            eb = eb_map[nb_key]
+            for prop in ('x', 'y', 'width', 'height', 'fontSize'):
+                if prop in eb and prop not in nb:
+                    nb[prop] = eb[prop]
+        merged.append(nb)
+    return merged
+
+
+def _find_panel(project, panel_id):
+    """Smart ID matching (UUID or Int)"""
+    if not panel_id:
+        return None
+    panel_id_str = str(panel_id)
+    if len(panel_id_str) > 30: # Likely UUID
+        return Panel.objects.filter(id=panel_id_str, project=project).first()
+    if panel_id_str.isdigit(): # Likely serial ID (Int)
+        return Panel.objects.filter(id=int(panel_id_str), project=project).first()
+    return None
+
+
+def _apply_panel_data(panel, p_data):
+    """Copies the agent's panel fields onto an existing panel (without saving)."""
+    # PRESERVE existing prompt if the new one is empty or the placeholder
+    new_prompt = p_data.get('prompt')
+    if new_prompt and "placeholder" not in new_prompt.lower():
+        panel.prompt = new_prompt
+
+    panel.scene_description = p_data.get('scene_description', panel.scene_description)
+
+    new_balloons_list = p_data.get('balloons')
+    if new_balloons_list is not None:
+        panel.balloons = _merge_balloons(panel.balloons, new_balloons_list)
+
+    panel.layout = p_data.get('layout', panel.layout)
+    panel.status = "completed"
+    panel.order = p_data.get('order_in_page', panel.order)
+    # Persist character assignments from the planner so they survive regeneration
+    if p_data.get('characters'):
+        panel.character_refs = p_data['characters']
+    if p_data.get('sceneries') or p_data.get('scenery'):
+        panel.scenery_refs = p_data.get('sceneries') or [p_data.get('scenery')]
+
+
+def _renumber_panels(pages, written=()):
     """
-    Processes the result from the agent (can be from SQS or HTTP callback).
+    Restores unique panel orders on each page. The agent may hand a panel an
+    order another panel still holds; left as is, the deferred
+    unique_panel_order_per_page constraint would fail at commit.
     """
-    
-    try:
-        project = Project.objects.get(id=project_id)
-        status_received = data.get('status')
-        action = data.get('action', 'NOT_FOUND')
-        
-        if status_received == 'failed':
-            error_msg = data.get('error', 'Unknown Error')
-            project.status = 'failed'
-            project.last_error = error_msg
-            project.save()
-            return {"status": "error_logged"}
-
-        result = data.get('result', {})
-        panels_data = result.get('panels', [])
-        
-        if not panels_data:
-            project.status = 'failed'
-            project.last_error = "El Agente no pudo generar una maquetación válida (0 paneles)."
-            project.save()
-            return {"status": "no_panels_found"}
-
-        # Page and Panel reconciliation logic
-        pages_map = {}
-        processed_panel_ids = []
-        
-        for p_data in panels_data:
-            p_num = int(p_data.get('page_number', 1))
-            if p_num not in pages_map:
-                page, created_page = Page.objects.get_or_create(project=project, page_number=p_num)
-                pages_map[p_num] = page
-            
-            panel_id = p_data.get('id')
-            panel = None
-            
-            # Smart ID matching (UUID or Int)
-            if panel_id:
-                panel_id_str = str(panel_id)
-                if len(panel_id_str) > 30: # Likely UUID
-                    panel = Panel.objects.filter(id=panel_id_str, page__project=project).first()
-                elif panel_id_str.isdigit(): # Likely serial ID (Int)
-                    panel = Panel.objects.filter(id=int(panel_id_str), page__project=project).first()                        
+    rank = {panel_id: i for i, panel_id in enumerate(written)}
+    for page in pages:
+        panels = list(page.panels.order_by('order', 'id'))
+        if len({p.order for p in panels}) == len(panels):
+            continue
+        # Empates: el panel que acaba de escribir el agente conserva el puesto
+        panels.sort(key=lambda p: (p.order, rank.get(p.id, len(rank))))
+        for index, panel in enumerate(panels):
+            if panel.order != index:
+                panel.order = index
+                panel.save(update_fields=['order', 'revision'])
+
+
+class _VersionLog:
+    """
+    Records every new render applied by one agent result as a PanelVersion.
+
+    The image object is referenced by key (no copy), and the rows are written in
+    one bulk insert once the result has been applied.
+    """
+
+    def __init__(self, action, run=None):
+        self.action = action
+        self.run = run
+        self._latest = None
+        self._pending = []
+
+    def preload(self, project):
+        """Loads the latest version of every panel in the project with a single query."""
+        self._latest = dict(
+            PanelVersion.objects.filter(panel__project=project)
+            .values('panel_id').annotate(latest=Max('version')).values_list('panel_id', 'latest')
+        )
+
+    def _latest_version(self, panel):
+        if self._latest is not None:
+            return self._latest.get(panel.id, 0)
+        return PanelVersion.objects.filter(panel=panel).aggregate(latest=Max('version'))['latest'] or 0
+
+    def set_image(self, panel, image_url):
+        """Points the panel at a new render and moves its version pointer (call before panel.save())."""
+        image_key = _clean_image_key(image_url)
+        if image_key == panel.image.name:
+            return
+        panel.image.name = image_key
+        panel.version = self._latest_version(panel) + 1
+        if self._latest is not None:
+            self._latest[panel.id] = panel.version
+        self._pending.append(panel)
+
+    def flush(self):
+        if not self._pending:
+            return
+        duration_ms = None
+        if self.run is not None:
+            duration_ms = int((timezone.now() - self.run.created_at).total_seconds() * 1000)
+        PanelVersion.objects.bulk_create([
+            PanelVersion(
+                panel=panel,
+                version=panel.version,
+                image_key=panel.image.name,
+                prompt=panel.prompt,
+                params={
+                    "action": self.action,
+                    "panel_style": panel.panel_style,
+                    "scene_description": panel.scene_description,
+                    "character_refs": panel.character_refs,
+                    "scenery_refs": panel.scenery_refs,
+                },
+                run=self.run,
+                duration_ms=duration_ms
+            )
+            for panel in self._pending
+        ])
+        self._pending = []
+
+
+def _complete_project(project, result):
+    project.status = 'completed'
+    project.last_error = None
+    # Persist world model summary for successive merges/regenerations
+    if result.get('world_model_summary'):
+        project.world_model_summary = result['world_model_summary']
+    project.save()
+
+
+def _process_delta(project, action, data, result, versions):
+    """
+    Fast path for delta results (regenerate_panel / regenerate_merge): the agent
+    only sends what changed, so nothing else in the project is read or written.
+    """
+    if action == 'regenerate_panel':
+        target_pid = data.get('panel_id') or result.get('panel_id')
+        for p_data in result.get('panels', []):
+            if str(p_data.get('id')) != str(target_pid):
+                continue
+            panel = _find_panel(project, target_pid)
             if not panel:
-                # ONLY create new panels during a full generation or if explicitly missing.
-                # During 'regenerate_panel', we should NOT be re-creating panels by order fallback.
-                if action == 'regenerate_panel':
-                    continue
-
-                # Fallback to page/order matching
-                order_val = int(p_data.get('order_in_page', 0))
-                panel, created = Panel.objects.update_or_create(
-                    page=pages_map[p_num],
-                    order=order_val,
-                    defaults={
-                        "prompt": p_data.get('prompt', 'Cinematic comic panel'),
-                        "scene_description": p_data.get('scene_description', ''),
-                        "balloons": p_data.get('balloons', []),
-                        "layout": p_data.get('layout', {}),
-                        "character_refs": p_data.get('characters', []),
-                        "scenery_refs": p_data.get('sceneries') or ([p_data.get('scenery')] if p_data.get('scenery') else []),
-                        "status": "completed"
-                    }
-                )
-            else:
-                # Update found panel
-                
-                # CRITICAL: For specialized actions (like regenerate_panel), ONLY update if it's the target.
-                # Otherwise, the agent context might overwrite valid user modifications on other panels.
-                is_target = True
-                if action == 'regenerate_panel':
-                    target_pid = data.get('panel_id') or result.get('panel_id')
-                    is_target = str(panel.id) == str(target_pid)
-                elif action == 'regenerate_merge':
-                    is_target = False # Merges shouldn't touch panels
-                
-                if not is_target:
-                    processed_panel_ids.append(panel.id)
-                    continue
-
-                # PRESERVE existing prompt if the new one is empty or the placeholder
-                new_prompt = p_data.get('prompt')
-                if new_prompt and "placeholder" not in new_prompt.lower():
-                    panel.prompt = new_prompt
-                
-                panel.scene_description = p_data.get('scene_description', panel.scene_description)
-                
-                # ENHANCED BALLOON MERGE: Match by content to preserve interactive props
-                new_balloons_list = p_data.get('balloons')
-                if new_balloons_list is not None:
-                    existing_balloons = panel.balloons or []
-                    eb_map = {}
-                    for eb in existing_balloons:
-                        key = f"{eb.get('character', '')}:{eb.get('text', '')[:30]}".lower().strip()
-                        eb_map[key] = eb
-
-                    merged = []
-                    for nb in new_balloons_list:
-                        nb_key = f"{nb.get('character', '')}:{nb.get('text', '')[:30]}".lower().strip()
-                        if nb_key in eb_map:
-                            eb = eb_map[nb_key]
-                            for prop in ('x', 'y', 'width', 'height', 'fontSize'):
-                                if prop in eb and prop not in nb:
-                                    nb[prop] = eb[prop]
-                        merged.append(nb)
-                    panel.balloons = merged
-                
-                panel.layout = p_data.get('layout', panel.layout)
-                panel.status = "completed"
-                panel.order = p_data.get('order_in_page', panel.order)
-                # Persist character assignments from the planner so they survive regeneration
-                if p_data.get('characters'):
-                    panel.character_refs = p_data['characters']
-                if p_data.get('sceneries') or p_data.get('scenery'):
-                    panel.scenery_refs = p_data.get('sceneries') or [p_data.get('scenery')]
-                panel.save()
-            
-            processed_panel_ids.append(panel.id)
-            
-            # Reconcile Image: Only update if it's a full generation OR if this is the target panel of a regeneration
-            # This prevents mirroring back absolute URLs into the FileField name for unchanged panels
-            should_update_image = (action == 'generate' or action == 'NOT_FOUND') or (action == 'regenerate_panel' and str(panel.id) == str(data.get('panel_id') or result.get('panel_id')))
-
-            if p_data.get('image_url') and should_update_image:
-                raw_url = p_data['image_url'].split('?')[0]
-                # If it's a full URL (contains http), try to extract only the path after the bucket
-                # This protects against accidental corruption if the agent echoes back a full URL
-                if "http" in raw_url:
-                    parts = raw_url.split('/')
-                    if "projects" in parts:
-                        idx = parts.index("projects")
-                        clean_url = "/".join(parts[idx:])
-                    else:
-                        clean_url = raw_url # Fallback
-                else:
-                    clean_url = raw_url
-                
-                panel.image.name = clean_url
-                panel.save()
-
-        # Reconcile Panels/Pages ONLY for full generation
-        # Specialized actions (regenerate_panel, regenerate_merge) should only update, not delete.
-        if action == 'generate' or action == 'NOT_FOUND':
-            # Reconcile Panels
-            for p_num, page in pages_map.items():
-                deleted_count = page.panels.exclude(id__in=processed_panel_ids).count()
-                page.panels.exclude(id__in=processed_panel_ids).delete()
-            
-            # Reconcile Pages
-            deleted_pages = project.pages.exclude(page_number__in=pages_map.keys()).count()
-            project.pages.exclude(page_number__in=pages_map.keys()).delete()
-        
-        # Merged Pages
-        merged_pages_data = result.get('merged_pages', [])
+                continue
+            _apply_panel_data(panel, p_data)
+            if p_data.get('image_url'):
+                versions.set_image(panel, p_data['image_url'])
+            panel.save()
+            _renumber_panels([panel.page], written=[panel.id])
+
+    elif action == 'regenerate_merge':
+        merged_pages_data = [m for m in result.get('merged_pages', []) if m.get('image_url')]
+        pages = {page.page_number: page for page in Page.objects.filter(
+            project=project,
+            page_number__in=[int(m['page_number']) for m in merged_pages_data]
+        )}
         for m_data in merged_pages_data:
-            p_num = m_data.get('page_number')
-            page = Page.objects.filter(project=project, page_number=p_num).first()
+            page = pages.get(int(m_data['page_number']))
             if page:
-                image_url = m_data.get('image_url', '')
-                if image_url:
-                    clean_url = image_url.split('?')[0]
-                    page.merged_image.name = clean_url
+                page.merged_image.name = _clean_image_key(m_data['image_url'])
                 page.save()
 
-        # Character & Scenery Synchronization (Canon)
-        characters_data = result.get('characters', [])
-        for c_data in characters_data:
-            name = c_data.get('name')
-            if name:
-                Character.objects.update_or_create(
-                    project=project,
-                    name=name,
-                    defaults={
-                        "description": c_data.get('description', ''),
-                        "metadata": c_data.get('metadata', c_data.get('visual_traits', {}))
-                    }
-                )
-
-        sceneries_data = result.get('sceneries', [])
-        for s_data in sceneries_data:
-            name = s_data.get('name')
-            if name:
-                Scenery.objects.update_or_create(
-                    project=project,
-                    name=name,
-                    defaults={
-                        "description": s_data.get('description', ''),
-                        "metadata": s_data.get('metadata', s_data.get('visual_traits', {}))
-                    }
-                )
-
-        project.status = 'completed'
-        project.last_error = None
-        # Persist world model summary for successive merges/regenerations
-        if result.get('world_model_summary'):
-            project.world_model_summary = result['world_model_summary']
+    versions.flush()
+    _complete_project(project, result)
+    return {"status": "success"}
+
+
+def _apply_agent_result(project_id, data, run=None):
+    """Applies one (already decoded) agent result to the project."""
+    project = Project.objects.get(id=project_id)
+    status_received = data.get('status')
+    action = data.get('action', 'NOT_FOUND')
+    
+    if status_received == 'failed':
+        error_msg = data.get('error', 'Unknown Error')
+        project.status = 'failed'
+        project.last_error = error_msg
         project.save()
+        return {"status": "error_logged"}
+
+    result = data.get('result', {})
+    versions = _VersionLog(action, run)
+    if result.get('delta') and action in ('regenerate_panel', 'regenerate_merge'):
+        return _process_delta(project, action, data, result, versions)
+
+    panels_data = result.get('panels', [])
+    
+    if not panels_data:
+        project.status = 'failed'
+        project.last_error = "El Agente no pudo generar una maquetación válida (0 paneles)."
+        project.save()
+        return {"status": "no_panels_found"}
+
+    versions.preload(project)
+
+    # Page and Panel reconciliation logic
+    pages_map = {}
+    processed_panel_ids = []
+    
+    for p_data in panels_data:
+        p_num = int(p_data.get('page_number', 1))
+        if p_num not in pages_map:
+            page, created_page = Page.objects.get_or_create(project=project, page_number=p_num)
+            pages_map[p_num] = page
+        
+        panel = _find_panel(project, p_data.get('id'))
+        if not panel:
+            # ONLY create new panels during a full generation or if explicitly missing.
+            # During 'regenerate_panel', we should NOT be re-creating panels by order fallback.
+            if action == 'regenerate_panel':
+                continue
+
+            # Fallback to page/order matching
+            order_val = int(p_data.get('order_in_page', 0))
+            panel, created = Panel.objects.update_or_create(
+                page=pages_map[p_num],
+                order=order_val,
+                defaults={
+                    "prompt": p_data.get('prompt', 'Cinematic comic panel'),
+                    "scene_description": p_data.get('scene_description', ''),
+                    "balloons": p_data.get('balloons', []),
+                    "layout": p_data.get('layout', {}),
+                    "character_refs": p_data.get('characters', []),
+                    "scenery_refs": p_data.get('sceneries') or ([p_data.get('scenery')] if p_data.get('scenery') else []),
+                    "status": "completed"
+                }
+            )
+        else:
+            # Update found panel
+            
+            # CRITICAL: For specialized actions (like regenerate_panel), ONLY update if it's the target.
+            # Otherwise, the agent context might overwrite valid user modifications on other panels.
+            is_target = True
+            if action == 'regenerate_panel':
+                target_pid = data.get('panel_id') or result.get('panel_id')
+                is_target = str(panel.id) == str(target_pid)
+            elif action == 'regenerate_merge':
+                is_target = False # Merges shouldn't touch panels
+            
+            if not is_target:
+                processed_panel_ids.append(panel.id)
+                continue
+
+            _apply_panel_data(panel, p_data)
+            panel.save()
         
-        final_pages = project.pages.count()
-        final_panels = Panel.objects.filter(page__project=project).count()
-        return {"status": "success"}
+        processed_panel_ids.append(panel.id)
+        
+        # Reconcile Image: Only update if it's a full generation OR if this is the target panel of a regeneration
+        # This prevents mirroring back absolute URLs into the FileField name for unchanged panels
+        should_update_image = (action == 'generate' or action == 'NOT_FOUND') or (action == 'regenerate_panel' and str(panel.id) == str(data.get('panel_id') or result.get('panel_id')))
+
+        if p_data.get('image_url') and should_update_image:
+            versions.set_image(panel, p_data['image_url'])
+            panel.save()
+
+    # Reconcile Panels/Pages ONLY for full generation
+    # Specialized actions (regenerate_panel, regenerate_merge) should only update, not delete.
+    if action == 'generate' or action == 'NOT_FOUND':
+        # Reconcile Panels
+        for p_num, page in pages_map.items():
+            deleted_count = page.panels.exclude(id__in=processed_panel_ids).count()
+            page.panels.exclude(id__in=processed_panel_ids).delete()
+        
+        # Reconcile Pages
+        deleted_pages = project.pages.exclude(page_number__in=pages_map.keys()).count()
+        project.pages.exclude(page_number__in=pages_map.keys()).delete()
+
+    _renumber_panels(pages_map.values(), written=processed_panel_ids)
+    
+    # Merged Pages
+    merged_pages_data = result.get('merged_pages', [])
+    for m_data in merged_pages_data:
+        p_num = m_data.get('page_number')
+        page = Page.objects.filter(project=project, page_number=p_num).first()
+        if page:
+            image_url = m_data.get('image_url', '')
+            if image_url:
+                clean_url = _clean_image_key(image_url)
+                page.merged_image.name = clean_url
+            page.save()
+
+    # Character & Scenery Synchronization (Canon)
+    characters_data = result.get('characters', [])
+    for c_data in characters_data:
+        name = c_data.get('name')
+        if name:
+            Character.objects.update_or_create(
+                project=project,
+                name=name,
+                defaults={
+                    "description": c_data.get('description', ''),
+                    "metadata": c_data.get('metadata', c_data.get('visual_traits', {}))
+                }
+            )
+
+    sceneries_data = result.get('sceneries', [])
+    for s_data in sceneries_data:
+        name = s_data.get('name')
+        if name:
+            Scenery.objects.update_or_create(
+                project=project,
+                name=name,
+                defaults={
+                    "description": s_data.get('description', ''),
+                    "metadata": s_data.get('metadata', s_data.get('visual_traits', {}))
+                }
+            )
+
+    versions.flush()
+    _complete_project(project, result)
+    
+    final_pages = project.pages.count()
+    final_panels = Panel.objects.filter(project=project).count()
+    return {"status": "success"}
+
+
+def _lock_run(project_id, run_id):
+    """The ledger row for `run_id`, locked until the end of the transaction (None for legacy messages)."""
+    try:
+        run_uuid = uuid.UUID(str(run_id))
+    except ValueError:
+        return None
+    return AgentRun.objects.select_for_update().filter(pk=run_uuid, project_id=project_id).first()
+
+
+def _is_stale(run):
+    """True if a newer run covering the same part of the project was already applied."""
+    return AgentRun.objects.filter(
+        project_id=run.project_id,
+        status='applied',
+        scope__in=run.covering_scopes(),
+        created_at__gt=run.created_at
+    ).exists()
+
+
+def process_agent_result(project_id, data):
+    """
+    Processes the result from the agent (can be from SQS or HTTP callback).
+
+    Results carrying a `run_id` are applied at most once: redeliveries of a run
+    that already finished are skipped, and results overtaken by a newer applied
+    run for the same scope are discarded.
+    """
+    
+    try:
+        data = unpack_agent_message(data)
+        with transaction.atomic():
+            run = _lock_run(project_id, data.get('run_id')) if data.get('run_id') else None
+            if run is not None:
+                if run.status == 'superseded':
+                    # Una petición más reciente para el mismo panel/página reemplazó esta ejecución
+                    return {"status": "stale"}
+                if run.status in AgentRun.FINISHED_STATUSES:
+                    return {"status": "duplicate"}
+                if _is_stale(run):
+                    run.status = 'stale'
+                    run.save(update_fields=['status'])
+                    return {"status": "stale"}
+
+            outcome = _apply_agent_result(project_id, data, run=run)
+
+            if run is not None:
+                run.status = 'applied' if outcome.get("status") == "success" else 'failed'
+                run.applied_at = timezone.now()
+                run.save(update_fields=['status', 'applied_at'])
+            return outcome
 
     except Project.DoesNotExist:
         return {"status": "project_not_found"}
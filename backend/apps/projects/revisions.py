@@ -0,0 +1,139 @@
+"""
+Project snapshot revisions.
+
+Every write to a Project, Page, Panel, Character or Scenery bumps the owning
+project's monotonically increasing ``revision`` counter and stamps the written
+row with the new value. Pollers can then ask "did anything change since N?"
+with a single indexed read instead of re-serializing the whole project.
+Notes carry no revision of their own; writing one only bumps the project's.
+
+A transaction takes at most one revision per project: every row it writes is
+stamped with the same value, so the project row is updated once per
+transaction instead of once per child write. Deletes bump through
+RevisionedQuerySet / RevisionedDeleteMixin rather than post_delete receivers,
+which keeps Django's fast-delete path (one DELETE per table) for bulk deletes.
+"""
+import time
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import F
+
+
+class _TransactionRevisions(dict):
+    """project id -> revision taken by the current transaction; cleared when it commits."""
+
+    def __call__(self):
+        self.clear()
+
+
+def _transaction_revisions():
+    """Revisions already taken by the open transaction, None in autocommit."""
+    if not connection.in_atomic_block:
+        return None
+    cache = getattr(connection, '_project_revisions', None)
+    # Válida mientras su on_commit siga pendiente: un commit o un rollback (también
+    # de un savepoint) lo descartan junto con el UPDATE del proyecto que la produjo
+    if cache is None or not any(func is cache for _, func, _ in connection.run_on_commit):
+        cache = _TransactionRevisions()
+        connection._project_revisions = cache
+        transaction.on_commit(cache)
+    return cache
+
+
+def next_revision(project_id):
+    """Atomically increments the project's revision and returns the new value."""
+    from .models import Project
+
+    if not project_id:
+        return 0
+    taken = _transaction_revisions()
+    if taken is not None and str(project_id) in taken:
+        return taken[str(project_id)]
+    if connection.vendor == 'postgresql':
+        # Single round-trip on the production database
+        table = Project._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE "{table}" SET "revision" = "revision" + 1 WHERE "id" = %s RETURNING "revision"',
+                [str(project_id)]
+            )
+            row = cursor.fetchone()
+        revision = row[0] if row else 0
+    else:
+        Project.objects.filter(pk=project_id).update(revision=F('revision') + 1)
+        revision = current_revision(project_id) or 0
+    if taken is not None:
+        taken[str(project_id)] = revision
+    return revision
+
+
+def bump_revision(project_id):
+    """Increments the project's revision without reading it back (used for deletes)."""
+    from .models import Project
+
+    if not project_id:
+        return
+    if connection.in_atomic_block:
+        # Comparte la revisión que ya haya tomado la transacción
+        next_revision(project_id)
+        return
+    Project.objects.filter(pk=project_id).update(revision=F('revision') + 1)
+
+
+class RevisionedQuerySet(models.QuerySet):
+    """QuerySet whose delete() bumps each affected project's revision once."""
+
+    def delete(self):
+        with transaction.atomic():
+            project_ids = set(self.values_list('project_id', flat=True).distinct())
+            result = super().delete()
+            for project_id in project_ids:
+                bump_revision(project_id)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class RevisionedDeleteMixin:
+    """Model.delete() counterpart of RevisionedQuerySet, for models with a `project` FK."""
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            bump_revision(self.project_id)
+        return result
+
+
+def current_revision(project_id):
+    """Returns the current project revision, or None if the project does not exist."""
+    from .models import Project
+
+    return Project.objects.filter(pk=project_id).values_list('revision', flat=True).first()
+
+
+def url_epoch():
+    """
+    Time bucket used in snapshot ETags.
+
+    Snapshots embed presigned S3 URLs. Including this bucket in the ETag forces a
+    fresh body well before the URLs cached by the client expire, even when the
+    revision did not change.
+    """
+    expire = int(getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600))
+    return int(time.time() // max(60, expire // 2))
+
+
+def snapshot_etag(project_id, revision, since=None):
+    suffix = f"-since{since}" if since is not None else ""
+    return f'W/"{project_id}-{revision}-{url_epoch()}{suffix}"'
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match header contains ``etag`` (or '*')."""
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    return '*' in candidates or etag in candidates
@@ -0,0 +1,57 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Project, Page, Panel, Character, Scenery, ReferenceImage, ProjectNote
+from .revisions import next_revision, bump_revision
+
+
+def _project_id_of(instance):
+    return getattr(instance, 'project_id', None)
+
+
+@receiver(post_save, sender=Project)
+def bump_project_revision(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # Project.save() never writes `revision`, so the counter is only moved here
+    instance.revision = next_revision(instance.pk)
+
+
+@receiver(pre_save, sender=Page)
+@receiver(pre_save, sender=Panel)
+@receiver(pre_save, sender=Character)
+@receiver(pre_save, sender=Scenery)
+def stamp_entity_revision(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance.revision = next_revision(_project_id_of(instance))
+
+
+# Los borrados de Page/Panel/Character/Scenery/ProjectNote suben la revisión desde
+# RevisionedQuerySet / RevisionedDeleteMixin: un post_delete aquí desactivaría el fast-delete
+
+
+@receiver(post_save, sender=ProjectNote)
+def bump_on_note_change(sender, instance, raw=False, **kwargs):
+    """Notes have no revision of their own but are part of the full snapshot (and its ETag)."""
+    if raw:
+        return
+    bump_revision(_project_id_of(instance))
+
+
+@receiver(post_save, sender=ReferenceImage)
+@receiver(post_delete, sender=ReferenceImage)
+def stamp_reference_owner(sender, instance, raw=False, **kwargs):
+    """Reference images are serialized inside their owner, so the owner is re-stamped."""
+    if raw:
+        return
+    # Solo ids: en un borrado en cascada el dueño ya no existe y el UPDATE no toca nada
+    if instance.character_id:
+        owners = Character.objects.filter(pk=instance.character_id)
+    elif instance.scenery_id:
+        owners = Scenery.objects.filter(pk=instance.scenery_id)
+    else:
+        return
+    project_id = owners.values_list('project_id', flat=True).first()
+    if project_id is not None:
+        owners.update(revision=next_revision(project_id))
@@ -0,0 +1,219 @@
+"""
+Concurrent SQS consumer for agent results.
+
+Messages are received in batches and processed by a thread pool. Results for
+the same project are applied one at a time and in receive order (each project
+has a "lane" drained by a single worker), while different projects run in
+parallel. A heartbeat thread keeps the visibility of in-flight messages
+extended for long reconciliations, and deletions are sent in batches: by the
+worker that fills a batch, or by the heartbeat every ACK_FLUSH_SECONDS, never
+held back behind a long poll.
+"""
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .result_processor import process_agent_result
+
+# Estados que cuentan como procesados (incluidos errores conocidos y duplicados): el mensaje se borra
+DONE_STATUSES = {"success", "error_logged", "no_panels_found", "duplicate", "stale"}
+
+SQS_MAX_BATCH = 10
+# Máxima espera de un borrado en el buffer: el mensaje procesado ya no se extiende y podría reentregarse
+ACK_FLUSH_SECONDS = 1
+
+
+class AgentResultConsumer:
+    def __init__(self, sqs, queue_url, processor=process_agent_result, workers=4,
+                 batch_size=SQS_MAX_BATCH, wait_time=20, visibility_timeout=120, log=print):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.processor = processor
+        self.workers = max(1, workers)
+        self.batch_size = max(1, min(batch_size, SQS_MAX_BATCH))
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.log = log
+        # Received but not yet acknowledged; bounded so a slow database does not pile up messages
+        self.max_in_flight = self.workers + self.batch_size
+
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._lanes = {}          # project_id -> deque of messages waiting in that lane
+        self._in_flight = {}      # message_id -> receipt_handle
+        self._to_delete = []      # (message_id, receipt_handle) ready for delete_message_batch
+        self.stats = {"received": 0, "processed": 0, "failed": 0, "deleted": 0}
+
+    # -- lifecycle -------------------------------------------------------
+
+    def stop(self):
+        """Stops receiving; messages already received are still processed and deleted."""
+        self._stop.set()
+
+    def run(self, max_messages=None):
+        """Consumes until stop() is called (or `max_messages` have been handled)."""
+        heartbeat = threading.Thread(target=self._heartbeat, name="sqs-visibility", daemon=True)
+        heartbeat.start()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sqs-worker") as pool:
+            self._pool = pool
+            while not self._stop.is_set():
+                if max_messages is not None and self._handled() >= max_messages:
+                    break
+                self._flush_deletes()
+                free = self._wait_for_capacity()
+                if free and not self._stop.is_set():
+                    self._receive(free)
+            self._drain()
+        self._finished.set()
+        heartbeat.join(timeout=5)
+        self._flush_deletes()
+
+    # -- receive / dispatch ----------------------------------------------
+
+    def _handled(self):
+        with self._lock:
+            return self.stats["processed"] + self.stats["failed"]
+
+    def _wait_for_capacity(self):
+        with self._idle:
+            while len(self._in_flight) >= self.max_in_flight and not self._stop.is_set():
+                self._idle.wait(timeout=1)
+            return min(self.batch_size, self.max_in_flight - len(self._in_flight))
+
+    def _receive(self, count):
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=count,
+                WaitTimeSeconds=self.wait_time,
+                VisibilityTimeout=self.visibility_timeout,
+                AttributeNames=['All']
+            )
+        except Exception as e:
+            self.log(f"Error receiving messages: {e}")
+            self._stop.wait(5)
+            return
+
+        for message in response.get('Messages', []):
+            self._dispatch(message)
+
+    def _dispatch(self, message):
+        try:
+            body = json.loads(message['Body'])
+        except ValueError:
+            self.log(f"Discarding malformed message {message.get('MessageId')}")
+            with self._lock:
+                self._to_delete.append((message['MessageId'], message['ReceiptHandle']))
+            return
+
+        project_id = str(body.get('project_id'))
+        with self._lock:
+            self.stats["received"] += 1
+            self._in_flight[message['MessageId']] = message['ReceiptHandle']
+            lane = self._lanes.get(project_id)
+            if lane is not None:
+                # Ya hay un worker aplicando resultados de este proyecto: se encola detrás
+                lane.append((message, body))
+                return
+            self._lanes[project_id] = deque([(message, body)])
+        self._pool.submit(self._run_lane, project_id)
+
+    def _run_lane(self, project_id):
+        while True:
+            with self._lock:
+                lane = self._lanes[project_id]
+                if not lane:
+                    del self._lanes[project_id]
+                    return
+                message, body = lane.popleft()
+            self._process(message, body)
+
+    def _process(self, message, body):
+        close_old_connections()
+        try:
+            result = self.processor(body.get('project_id'), body)
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+        finally:
+            close_old_connections()
+
+        done = result.get("status") in DONE_STATUSES
+        with self._idle:
+            receipt_handle = self._in_flight.pop(message['MessageId'], None)
+            if done:
+                self.stats["processed"] += 1
+                self._to_delete.append((message['MessageId'], receipt_handle))
+            else:
+                # Sin borrar: SQS lo reentrega cuando vence la visibilidad
+                self.stats["failed"] += 1
+            batch_full = len(self._to_delete) >= SQS_MAX_BATCH
+            self._idle.notify_all()
+
+        if batch_full:
+            self._flush_deletes()
+
+        if done:
+            self.log(f"Processed message for project {body.get('project_id')}")
+        else:
+            self.log(f"Processing failed for {body.get('project_id')}: {result.get('message')}")
+
+    def _drain(self):
+        with self._idle:
+            while self._in_flight:
+                self._idle.wait(timeout=1)
+
+    # -- acknowledgements ------------------------------------------------
+
+    def _flush_deletes(self):
+        with self._lock:
+            if not self._to_delete:
+                return
+            pending, self._to_delete = self._to_delete, []
+
+        for start in range(0, len(pending), SQS_MAX_BATCH):
+            chunk = pending[start:start + SQS_MAX_BATCH]
+            try:
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{"Id": str(i), "ReceiptHandle": handle} for i, (_, handle) in enumerate(chunk)]
+                )
+                failed = response.get('Failed', [])
+                with self._lock:
+                    self.stats["deleted"] += len(chunk) - len(failed)
+                for failure in failed:
+                    self.log(f"Failed to delete message: {failure.get('Message', failure.get('Code'))}")
+            except Exception as e:
+                self.log(f"Error deleting messages: {e}")
+
+    def _heartbeat(self):
+        """Flushes deletions every ACK_FLUSH_SECONDS and extends the visibility of in-flight messages well before it runs out."""
+        interval = max(1, self.visibility_timeout // 2)
+        next_extension = time.monotonic() + interval
+        while not self._finished.wait(ACK_FLUSH_SECONDS):
+            self._flush_deletes()
+            if time.monotonic() >= next_extension:
+                next_extension = time.monotonic() + interval
+                self._extend_visibility()
+
+    def _extend_visibility(self):
+        with self._lock:
+            handles = list(self._in_flight.values())
+        for start in range(0, len(handles), SQS_MAX_BATCH):
+            chunk = handles[start:start + SQS_MAX_BATCH]
+            try:
+                self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{
+                        "Id": str(i),
+                        "ReceiptHandle": handle,
+                        "VisibilityTimeout": self.visibility_timeout
+                    } for i, handle in enumerate(chunk)]
+                )
+            except Exception as e:
+                self.log(f"Error extending message visibility: {e}")
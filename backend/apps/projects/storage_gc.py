@@ -0,0 +1,229 @@
+"""
+Mark-and-sweep garbage collector for the media bucket.
+
+Every render and merge uploads a fresh ``generated/{uuid}.png`` and nothing
+deletes the objects they replace. The collector:
+
+1. **mark**: builds the set of live keys from the database (panel images and
+   references, merged pages, PanelVersion history, character / scenery /
+   reference images, note files) and from every canon JSON document under
+   ``projects/{id}/canon/`` (``ref_images`` and any other stored key);
+2. **list**: lists the swept prefixes in parallel, one paginated lister per
+   shard (hex shards of ``generated/``, one per project under ``projects/``);
+3. **sweep**: deletes unreferenced objects older than the grace period with
+   ``delete_objects`` batches of up to 1000 keys.
+
+Canon documents are never deleted. Wire offload blobs (``projects/{id}/wire/``)
+are only needed while a message is in transit, so they are garbage once they
+are older than the grace period. Objects newer than the grace period are always
+kept: an agent may have uploaded a render whose result has not been applied yet.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from django.utils import timezone
+
+from .models import Panel, PanelVersion, Page, Character, Scenery, ReferenceImage, ProjectNote
+
+DEFAULT_PREFIXES = ("generated/", "projects/")
+S3_MAX_DELETE = 1000
+HEX_DIGITS = "0123456789abcdef"
+
+
+def normalize_key(value, bucket=None):
+    """Object key for a stored reference: a key, an s3:// URI or a (signed) bucket URL."""
+    if not value or not isinstance(value, str):
+        return None
+    value = value.split('?')[0].strip()
+    if value.startswith("s3://"):
+        return value[5:].split('/', 1)[1] if '/' in value[5:] else None
+    if value.startswith(("http://", "https://")):
+        path = urlparse(value).path.lstrip('/')
+        # Path-style URLs (https://s3.../bucket/key) llevan el bucket delante
+        if bucket and path.startswith(f"{bucket}/"):
+            path = path[len(bucket) + 1:]
+        return path or None
+    return value.lstrip('/') or None
+
+
+def _is_canon(key):
+    return "/canon/" in key
+
+
+def _is_wire(key):
+    return "/wire/" in key
+
+
+def _walk_strings(node):
+    """Every string value in a decoded JSON document."""
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for value in node.values():
+            yield from _walk_strings(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk_strings(value)
+
+
+class StorageGC:
+    def __init__(self, s3, bucket, grace=timedelta(hours=24), workers=8, dry_run=True, log=print):
+        self.s3 = s3
+        self.bucket = bucket
+        self.grace = grace
+        self.workers = max(1, workers)
+        self.dry_run = dry_run
+        self.log = log
+        self._lock = threading.Lock()
+        self.stats = {
+            "live_keys": 0, "canon_documents": 0, "listed": 0, "listed_bytes": 0,
+            "kept_live": 0, "kept_recent": 0, "orphaned": 0, "orphaned_bytes": 0,
+            "deleted": 0, "delete_errors": 0,
+            "mark_seconds": 0.0, "list_seconds": 0.0, "sweep_seconds": 0.0,
+        }
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    # -- mark --------------------------------------------------------------
+
+    def _database_keys(self):
+        fields = (
+            (Panel.objects.all(), 'image'),
+            (Panel.objects.all(), 'reference_image'),
+            (Page.objects.all(), 'merged_image'),
+            (PanelVersion.objects.all(), 'image_key'),
+            (Character.objects.all(), 'image'),
+            (Scenery.objects.all(), 'image'),
+            (ReferenceImage.objects.all(), 'image'),
+            (ProjectNote.objects.all(), 'file'),
+        )
+        for queryset, field in fields:
+            for value in queryset.exclude(**{field: ''}).exclude(**{f"{field}__isnull": True}) \
+                    .values_list(field, flat=True).iterator(chunk_size=5000):
+                yield value
+
+    def _canon_keys(self, canon_objects):
+        def read(key):
+            body = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+            try:
+                return list(_walk_strings(json.loads(body)))
+            except ValueError:
+                self.log(f"WARNING: {key} is not valid JSON, skipped")
+                return []
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gc-canon") as pool:
+            for strings in pool.map(read, [o['Key'] for o in canon_objects if o['Key'].endswith('.json')]):
+                self._count(canon_documents=1)
+                yield from strings
+
+    def mark(self, canon_objects):
+        """Set of keys referenced by the database or by a canon document."""
+        started = time.monotonic()
+        live = set()
+        for value in self._database_keys():
+            key = normalize_key(value, self.bucket)
+            if key:
+                live.add(key)
+        for value in self._canon_keys(canon_objects):
+            key = normalize_key(value, self.bucket)
+            # Solo cadenas con forma de clave: las descripciones y rasgos también son strings
+            if key and '/' in key and ' ' not in key:
+                live.add(key)
+        self.stats["live_keys"] = len(live)
+        self.stats["mark_seconds"] = round(time.monotonic() - started, 3)
+        return live
+
+    # -- list --------------------------------------------------------------
+
+    def _shards(self, prefix):
+        """Sub-prefixes that can be listed independently (and therefore in parallel)."""
+        if prefix == "generated/":
+            # Las claves del agente son generated/{uuid4}.{ext}: 16 shards hexadecimales
+            return [f"{prefix}{c}" for c in HEX_DIGITS]
+        shards = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            shards.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+            # Objetos sueltos directamente bajo el prefijo
+            shards.extend(o['Key'] for o in page.get('Contents', []))
+        return shards or [prefix]
+
+    def _list_shard(self, shard):
+        objects = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=shard, PaginationConfig={'PageSize': 1000}):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def _list(self, shards):
+        objects = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gc-list") as pool:
+            for listed in pool.map(self._list_shard, shards):
+                for obj in listed:
+                    # Shards may overlap (e.g. a loose key that is also a prefix): keep one entry per key
+                    objects[obj['Key']] = obj
+        return list(objects.values())
+
+    def list_objects(self, prefixes):
+        started = time.monotonic()
+        objects = self._list([shard for prefix in prefixes for shard in self._shards(prefix)])
+        self.stats["listed"] = len(objects)
+        self.stats["listed_bytes"] = sum(o.get('Size', 0) for o in objects)
+        self.stats["list_seconds"] = round(time.monotonic() - started, 3)
+        return objects
+
+    def list_canon(self):
+        """Every object under projects/{id}/canon/ (a single document today, shards later)."""
+        return self._list([f"{shard}canon/" for shard in self._shards("projects/") if shard.endswith('/')])
+
+    # -- sweep -------------------------------------------------------------
+
+    def _delete_batch(self, keys):
+        response = self.s3.delete_objects(
+            Bucket=self.bucket, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+        for error in errors[:5]:
+            self.log(f"ERROR: could not delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+        self._count(deleted=len(keys) - len(errors), delete_errors=len(errors))
+
+    def sweep(self, objects, live):
+        started = time.monotonic()
+        cutoff = timezone.now() - self.grace
+        orphans = []
+        for obj in objects:
+            key = obj['Key']
+            if _is_canon(key) or (key in live and not _is_wire(key)):
+                self.stats["kept_live"] += 1
+            elif obj['LastModified'] > cutoff:
+                self.stats["kept_recent"] += 1
+            else:
+                orphans.append(key)
+                self.stats["orphaned_bytes"] += obj.get('Size', 0)
+        self.stats["orphaned"] = len(orphans)
+
+        if not self.dry_run and orphans:
+            batches = [orphans[i:i + S3_MAX_DELETE] for i in range(0, len(orphans), S3_MAX_DELETE)]
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gc-delete") as pool:
+                list(pool.map(self._delete_batch, batches))
+        self.stats["sweep_seconds"] = round(time.monotonic() - started, 3)
+        return orphans
+
+    def run(self, prefixes=DEFAULT_PREFIXES):
+        """Lists, marks and sweeps; returns the orphaned keys (deleted unless dry_run)."""
+        # Se lista antes de marcar: una clave que pasa a estar referenciada mientras se
+        # lista aparece igualmente en el marcado
+        objects = self.list_objects(prefixes)
+        if any("projects/".startswith(p) for p in prefixes):
+            canon_objects = [o for o in objects if _is_canon(o['Key'])]
+        else:
+            canon_objects = self.list_canon()
+        live = self.mark(canon_objects)
+        return self.sweep(objects, live)
@@ -0,0 +1,92 @@
+"""
+Process-local cache for storage URLs.
+
+With S3 + AWS_QUERYSTRING_AUTH every ``FieldFile.url`` access computes a fresh
+SigV4 presigned URL. A project snapshot touches hundreds of files, many of them
+several times per request and again on every poll, so signed URLs are cached
+per object key until shortly before they stop being safe to hand out.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+
+class SignedUrlCache:
+    """Thread-safe LRU of ``name -> (url, expires_at)``."""
+
+    def __init__(self, storage=None, max_entries=20000):
+        self._storage = storage
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    @property
+    def storage(self):
+        return self._storage or default_storage
+
+    def ttl(self):
+        """
+        Seconds a signed URL is served from cache.
+
+        Snapshot ETags (see revisions.url_epoch) let clients keep a body for up to
+        half the presign lifetime, so a cached URL must be handed out within the
+        other half, minus a safety margin.
+        """
+        expire = int(getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600))
+        margin = int(getattr(settings, 'SIGNED_URL_REFRESH_MARGIN', 300))
+        return max(0, expire // 2 - margin)
+
+    def get_many(self, names):
+        """Returns ``{name: url}`` signing only the names that are missing or stale."""
+        names = [n for n in dict.fromkeys(names) if n]
+        now = time.monotonic()
+        result = {}
+        missing = []
+        with self._lock:
+            for name in names:
+                entry = self._entries.get(name)
+                if entry and entry[1] > now:
+                    result[name] = entry[0]
+                    self._entries.move_to_end(name)
+                else:
+                    missing.append(name)
+
+        if missing:
+            storage = self.storage
+            signed = {name: storage.url(name) for name in missing}
+            expires_at = now + self.ttl()
+            with self._lock:
+                for name, url in signed.items():
+                    self._entries[name] = (url, expires_at)
+                    self._entries.move_to_end(name)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            result.update(signed)
+        return result
+
+    def get(self, name):
+        if not name:
+            return ""
+        return self.get_many([name]).get(name, "")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+signed_urls = SignedUrlCache()
+
+
+def signed_url(field):
+    """URL for a FieldFile (or raw object name), served from the shared cache."""
+    if not field:
+        return ""
+    return signed_urls.get(getattr(field, 'name', field))
+
+
+def warm_signed_urls(fields):
+    """Signs every non-empty FieldFile / name in one pass so later lookups are cache hits."""
+    signed_urls.get_many(getattr(f, 'name', f) for f in fields if f)
@@ -1,22 +1,18 @@
 import requests
-import threading
+from itertools import chain
+from django.db.models import Prefetch
 from django.conf import settings
-from .agent_utils import BedrockAgentClient
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, parsers
-from .models import Project, Page, Panel, Character, Scenery, ReferenceImage
+from .models import Project, Page, Panel, PanelVersion, Character, Scenery, ReferenceImage
 from .result_processor import process_agent_result
-
-def _get_all_image_urls(entity):
-    """Returns a list of all image URLs for a Character or Scenery (primary + references)."""
-    urls = []
-    if entity.image:
-        urls.append(entity.image.name)
-    for ref in entity.reference_images.all():
-        if ref.image:
-            urls.append(ref.image.name)
-    return urls
+from .agent_payloads import (
+    build_generate_payload, build_regenerate_panel_payload, build_regenerate_merge_payload
+)
+from .dispatch import enqueue_agent_run
+from .revisions import current_revision, snapshot_etag, etag_matches
+from .url_signing import signed_url, warm_signed_urls
 
 def _serialize_ref_images(entity):
     """Returns the reference_images serialization for API responses."""
@@ -26,6 +22,66 @@ def _serialize_ref_images(entity):
         "order": ref.order
     } for ref in entity.reference_images.all()]
 
+def _serialize_panel(panel, page_number):
+    return {
+        "id": panel.id,
+        "page_number": page_number,
+        "order": panel.order,
+        "prompt": panel.prompt,
+        "scene_description": panel.scene_description,
+        "image_url": panel.image_url,
+        "status": panel.status,
+        "version": panel.version,
+        "balloons": panel.balloons,
+        "layout": panel.layout,
+        "panel_style": panel.panel_style,
+        "reference_image": signed_url(panel.reference_image) or None
+    }
+
+def _serialize_owner(entity):
+    """Character / Scenery serialization shared by the detail and delta views."""
+    return {
+        "id": entity.id,
+        "name": entity.name,
+        "description": entity.description,
+        "metadata": entity.metadata,
+        "image_url": entity.image_url,
+        "reference_images": _serialize_ref_images(entity)
+    }
+
+def _serialize_project_fields(project):
+    return {
+        "id": project.id,
+        "revision": project.revision,
+        "name": project.name,
+        "description": project.description,
+        "world_bible": project.world_bible,
+        "style_guide": project.style_guide,
+        "status": project.status,
+        "last_error": project.last_error,
+        "layout_style": project.layout_style,
+        "max_pages": project.max_pages,
+        "max_panels": project.max_panels,
+    }
+
+def _owner_files(entities):
+    """Primary + reference image files of Characters/Sceneries (reference_images prefetched)."""
+    for entity in entities:
+        yield entity.image
+        for ref in entity.reference_images.all():
+            yield ref.image
+
+def _not_modified(etag):
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response['ETag'] = etag
+    return response
+
+def _with_etag(response, etag):
+    response['ETag'] = etag
+    # Permite al navegador revalidar con If-None-Match en cada sondeo
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 class GenerateComicView(APIView):
     def post(self, request, project_id):
         try:
@@ -90,7 +146,11 @@ class GenerateComicView(APIView):
                         project.pages.all().delete()
                     
                     for p_num in range(1, max_pages + 1):
-                        page, _ = Page.objects.get_or_create(project=project, page_number=p_num)
+                        page, created_page = Page.objects.get_or_create(project=project, page_number=p_num)
+                        # skip_cleaning conserva las páginas con paneles: solo se maquetan las vacías
+                        # (añadir placeholders con order=0.. chocaría con unique_panel_order_per_page)
+                        if not created_page and page.panels.exists():
+                            continue
                         
                         for i in range(panels_per_page):
                             row = i // 2
@@ -154,34 +214,7 @@ class GenerateComicView(APIView):
         else:
             # Fallback por si no hay archivo, pero ya no es hardcoded a un bucket fijo ajeno
             sources = state_sources if (state_sources := request.data.get("sources")) else []
-        payload = {
-            "project_id": str(project.id),
-            "sources": sources,
-            "max_pages": project.max_pages,
-            "max_panels": len(request.data.get("panels", [])),
-            "layout_style": project.layout_style,
-            "plan_only": request.data.get("plan_only", False),
-            "panels": request.data.get("panels", []),
-            "global_context": {
-                "description": project.description,
-                "world_bible": project.world_bible,
-                "style_guide": project.style_guide,
-                "characters": [{
-                    "name": c.name,
-                    "description": c.description,
-                    "metadata": c.metadata,
-                    "image_url": c.image.name if c.image else "",
-                    "image_urls": _get_all_image_urls(c)
-                } for c in project.characters.all()],
-                "sceneries": [{
-                    "name": s.name,
-                    "description": s.description,
-                    "metadata": s.metadata,
-                    "image_url": s.image.name if s.image else "",
-                    "image_urls": _get_all_image_urls(s)
-                } for s in project.sceneries.all()]
-            }
-        }
+        payload = build_generate_payload(project, sources, request.data)
 
         import json
         try:
@@ -189,14 +222,9 @@ class GenerateComicView(APIView):
             project.last_error = None
             project.save()
 
-            # Invocar al agente en un hilo separado para no bloquear la respuesta HTTP
-            # El agente notificará al AgentCallbackView cuando termine
-            client = BedrockAgentClient()
-            thread = threading.Thread(
-                target=client.invoke,
-                args=(payload, project.id)
-            )
-            thread.start()
+            # Encolar la invocación (dispatch.py) para no bloquear la respuesta HTTP
+            # El agente notificará al backend por SQS cuando termine
+            enqueue_agent_run(project, payload)
 
             return Response({
                 "project_id": str(project.id),
@@ -209,28 +237,42 @@ class GenerateComicView(APIView):
 class ProjectDetailView(APIView):
     """Obtén el estado actual del cómic (páginas y paneles)"""
     def get(self, request, project_id):
+        # Lectura barata de la revisión antes de construir el snapshot completo
+        revision = current_revision(project_id)
+        if revision is None:
+            return Response({"error": "Project not found"}, status=status.HTTP_404_NOT_FOUND)
+        etag = snapshot_etag(project_id, revision)
+        if etag_matches(request, etag):
+            return _not_modified(etag)
+
         try:
             project = Project.objects.get(id=project_id)
-            pages = project.pages.all().order_by('page_number')
+            pages = list(
+                project.pages.all().order_by('page_number')
+                .prefetch_related(Prefetch('panels', queryset=Panel.objects.order_by('order')))
+            )
+            notes = list(project.notes.all())
+            characters = list(project.characters.prefetch_related('reference_images'))
+            sceneries = list(project.sceneries.prefetch_related('reference_images'))
+
+            # Firmar todas las URLs del snapshot de una sola vez (caché por key)
+            panels = [panel for page in pages for panel in page.panels.all()]
+            warm_signed_urls(chain(
+                (page.merged_image for page in pages),
+                (panel.image for panel in panels),
+                (panel.reference_image for panel in panels),
+                (n.file for n in notes),
+                _owner_files(characters),
+                _owner_files(sceneries),
+            ))
             
             pages_data = []
             for page in pages:
                 # Obtener paneles de esta página
-                page_panels = []
-                for panel in page.panels.all().order_by('order'):
-                    page_panels.append({
-                        "id": panel.id,
-                        "page_number": page.page_number,
-                        "order": panel.order,
-                        "prompt": panel.prompt,
-                        "scene_description": panel.scene_description,
-                        "image_url": panel.image_url,
-                        "status": panel.status,
-                        "balloons": panel.balloons,
-                        "layout": panel.layout,
-                        "panel_style": panel.panel_style,
-                        "reference_image": panel.reference_image.url if panel.reference_image else None
-                    })
+                page_panels = [
+                    _serialize_panel(panel, page.page_number)
+                    for panel in page.panels.all()
+                ]
                 
                 pages_data.append({
                     "page_number": page.page_number,
@@ -238,17 +280,8 @@ class ProjectDetailView(APIView):
                     "panels": page_panels
                 })
             
-            return Response({
-                "id": project.id,
-                "name": project.name,
-                "description": project.description,
-                "world_bible": project.world_bible,
-                "style_guide": project.style_guide,
-                "status": project.status,
-                "last_error": project.last_error,
-                "layout_style": project.layout_style,
-                "max_pages": project.max_pages,
-                "max_panels": project.max_panels,
+            data = _serialize_project_fields(project)
+            data.update({
                 "pages": pages_data,
                 "notes": [{
                     "id": n.id,
@@ -256,34 +289,83 @@ class ProjectDetailView(APIView):
                     "content": n.content,
                     "file_url": n.file_url,
                     "note_type": n.note_type
-                } for n in project.notes.all()],
-                "characters": [{
-                    "id": c.id,
-                    "name": c.name,
-                    "description": c.description,
-                    "metadata": c.metadata,
-                    "image_url": c.image_url,
-                    "reference_images": _serialize_ref_images(c)
-                } for c in project.characters.all()],
-                "sceneries": [{
-                    "id": s.id,
-                    "name": s.name,
-                    "description": s.description,
-                    "metadata": s.metadata,
-                    "image_url": s.image_url,
-                    "reference_images": _serialize_ref_images(s)
-                } for s in project.sceneries.all()]
+                } for n in notes],
+                "characters": [_serialize_owner(c) for c in characters],
+                "sceneries": [_serialize_owner(s) for s in sceneries]
             })
+            # El ETag se calcula con la revisión leída al inicio: si algo cambió
+            # mientras serializábamos, el siguiente sondeo lo detectará.
+            return _with_etag(Response(data), etag)
         except Project.DoesNotExist:
             return Response({"error": "Project not found"}, status=status.HTTP_404_NOT_FOUND)
 
+class ProjectChangesView(APIView):
+    """
+    Delta del snapshot: solo las entidades escritas después de la revisión `since`.
+    Las listas `live_*` permiten al cliente descartar entidades eliminadas.
+    """
+    def get(self, request, project_id):
+        try:
+            since = int(request.query_params.get('since', ''))
+        except ValueError:
+            return Response({"error": "'since' must be an integer revision"}, status=status.HTTP_400_BAD_REQUEST)
+
+        revision = current_revision(project_id)
+        if revision is None:
+            return Response({"error": "Project not found"}, status=status.HTTP_404_NOT_FOUND)
+        etag = snapshot_etag(project_id, revision, since=since)
+        if etag_matches(request, etag):
+            return _not_modified(etag)
+
+        project = Project.objects.get(id=project_id)
+        data = _serialize_project_fields(project)
+        data["since"] = since
+
+        live = {
+            "live_page_numbers": list(project.pages.values_list('page_number', flat=True)),
+            "live_panel_ids": list(Panel.objects.filter(project=project).values_list('id', flat=True)),
+            "live_character_ids": list(project.characters.values_list('id', flat=True)),
+            "live_scenery_ids": list(project.sceneries.values_list('id', flat=True)),
+        }
+        if since >= project.revision:
+            data.update({"pages": [], "panels": [], "characters": [], "sceneries": [], **live})
+            return _with_etag(Response(data), etag)
+
+        changed_pages = list(project.pages.filter(revision__gt=since).order_by('page_number'))
+        changed_panels = list(
+            Panel.objects.filter(project=project, revision__gt=since)
+            .select_related('page')
+            .order_by('page__page_number', 'order')
+        )
+        changed_characters = list(project.characters.filter(revision__gt=since).prefetch_related('reference_images'))
+        changed_sceneries = list(project.sceneries.filter(revision__gt=since).prefetch_related('reference_images'))
+        warm_signed_urls(chain(
+            (page.merged_image for page in changed_pages),
+            (p.image for p in changed_panels),
+            (p.reference_image for p in changed_panels),
+            _owner_files(changed_characters),
+            _owner_files(changed_sceneries),
+        ))
+        data.update({
+            "pages": [{
+                "page_number": page.page_number,
+                "merged_image_url": page.merged_image_url
+            } for page in changed_pages],
+            "panels": [_serialize_panel(p, p.page.page_number) for p in changed_panels],
+            "characters": [_serialize_owner(c) for c in changed_characters],
+            "sceneries": [_serialize_owner(s) for s in changed_sceneries],
+            **live,
+        })
+        return _with_etag(Response(data), etag)
+
 class AgentCallbackView(APIView):
     """Webhook para que el Agente notifique resultados"""
     def post(self, request, project_id):
         try:
             result = process_agent_result(project_id, request.data)
             
-            if result.get("status") == "success":
+            # duplicate / stale: ya aplicado o superado por una ejecución más reciente
+            if result.get("status") in ("success", "duplicate", "stale"):
                 return Response({"status": "received"}, status=status.HTTP_200_OK)
             else:
                 return Response(result, status=status.HTTP_400_BAD_REQUEST)
@@ -327,7 +409,8 @@ class CreateProjectView(APIView):
 
 class CharacterListView(APIView):
     def get(self, request, project_id):
-        characters = Character.objects.filter(project_id=project_id)
+        characters = list(Character.objects.filter(project_id=project_id).prefetch_related('reference_images'))
+        warm_signed_urls(_owner_files(characters))
         return Response([{
             "id": c.id,
             "name": c.name,
@@ -454,7 +537,8 @@ class CharacterCreateView(APIView):
 
 class SceneryListView(APIView):
     def get(self, request, project_id):
-        sceneries = Scenery.objects.filter(project_id=project_id)
+        sceneries = list(Scenery.objects.filter(project_id=project_id).prefetch_related('reference_images'))
+        warm_signed_urls(_owner_files(sceneries))
         return Response([{
             "id": s.id,
             "name": s.name,
@@ -601,7 +685,7 @@ class RegeneratePanelView(APIView):
     """Dispara la regeneración de la imagen de un panel con contexto mejorado"""
     def post(self, request, panel_id):
         try:
-            panel = Panel.objects.get(id=panel_id)
+            panel = Panel.objects.select_related('page__project').get(id=panel_id)
             project = panel.page.project
             
             instructions = request.data.get('instructions', '')
@@ -618,55 +702,12 @@ class RegeneratePanelView(APIView):
                 panel.panel_style = request.data['panel_style']
             panel.save()
             
-            payload = {
-                "action": "regenerate_panel",
-                "project_id": str(project.id),
-                "panel_id": panel.id,
-                "page_number": panel.page.page_number,
-                "prompt": panel.prompt,
-                "scene_description": panel.scene_description,
-                "balloons": panel.balloons,
-                "panel_style": panel.panel_style or '',
-                "instructions": instructions,
-                "current_image_url": panel.image.name if panel.image and use_current_as_base else None,
-                "reference_image_url": panel.reference_image.name if panel.reference_image else None,
-                "panels": [{
-                    "id": p.id,
-                    "page_number": p.page.page_number,
-                    "order_in_page": p.order,
-                    "prompt": p.prompt,
-                    "scene_description": p.scene_description,
-                    "image_url": p.image.name if p.image else "",
-                    "status": p.status,
-                    "balloons": p.balloons,
-                    "layout": p.layout,
-                    "character_refs": p.character_refs,
-                    "scenery_refs": p.scenery_refs
-                } for p in Panel.objects.filter(page__project=project).order_by('page__page_number', 'order')],
-                "global_context": {
-                    "style_guide": project.style_guide,
-                    "characters": [{
-                        "name": c.name,
-                        "description": c.description,
-                        "metadata": c.metadata,
-                        "image_url": c.image.name if c.image else "",
-                        "image_urls": _get_all_image_urls(c)
-                    } for c in project.characters.all()],
-                    "sceneries": [{
-                        "name": s.name,
-                        "description": s.description,
-                        "metadata": s.metadata,
-                        "image_url": request.build_absolute_uri(s.image.url) if s.image else "",
-                        "image_urls": _get_all_image_urls(s)
-                    } for s in project.sceneries.all()]
-                }
-            }
+            payload = build_regenerate_panel_payload(project, panel, instructions, use_current_as_base)
             
             project.status = "generating"
             project.save()
             
-            client = BedrockAgentClient()
-            threading.Thread(target=client.invoke, args=(payload, project.id)).start()
+            enqueue_agent_run(project, payload)
             
             return Response({"status": "queued", "panel_id": panel.id}, status=status.HTTP_202_ACCEPTED)
         except Exception as e:
@@ -681,49 +722,12 @@ class RegenerateMergedPagesView(APIView):
             page_number = request.data.get('page_number')
             
             agent_url = f"{settings.AGENT_SERVICE_URL}/regenerate-merge"
-            payload = {
-                "action": "regenerate_merge",
-                "project_id": str(project.id),
-                "instructions": instructions,
-                "page_number": page_number,
-                "world_model_summary": project.world_model_summary,
-                "panels": [{
-                    "id": p.id,
-                    "page_number": p.page.page_number,
-                    "order_in_page": p.order,
-                    "prompt": p.prompt,
-                    "scene_description": p.scene_description,
-                    "image_url": p.image.name if p.image else "",
-                    "status": p.status,
-                    "balloons": p.balloons,
-                    "layout": p.layout,
-                    "character_refs": p.character_refs,
-                    "scenery_refs": p.scenery_refs
-                } for p in Panel.objects.filter(page__project=project).order_by('page__page_number', 'order')],
-                "global_context": {
-                    "style_guide": project.style_guide,
-                    "characters": [{
-                        "name": c.name,
-                        "description": c.description,
-                        "metadata": c.metadata,
-                        "image_url": c.image.name if c.image else "",
-                        "image_urls": _get_all_image_urls(c)
-                    } for c in project.characters.all()],
-                    "sceneries": [{
-                        "name": s.name,
-                        "description": s.description,
-                        "metadata": s.metadata,
-                        "image_url": s.image.name if s.image else "",
-                        "image_urls": _get_all_image_urls(s)
-                    } for s in project.sceneries.all()]
-                }
-            }
+            payload = build_regenerate_merge_payload(project, instructions, page_number)
             
             project.status = "generating"
             project.save()
             
-            client = BedrockAgentClient()
-            threading.Thread(target=client.invoke, args=(payload, project.id)).start()
+            enqueue_agent_run(project, payload)
             
             return Response({"status": "queued", "project_id": str(project.id)}, status=status.HTTP_202_ACCEPTED)
         except Exception as e:
@@ -823,6 +827,47 @@ class DeletePanelView(APIView):
         except Panel.DoesNotExist:
             return Response({"error": "Panel not found"}, status=status.HTTP_404_NOT_FOUND)
 
+class PanelVersionListView(APIView):
+    """Historial de renders de un panel (el más reciente primero)"""
+    def get(self, request, panel_id):
+        try:
+            panel = Panel.objects.get(id=panel_id)
+        except Panel.DoesNotExist:
+            return Response({"error": "Panel not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        versions = list(panel.versions.all())
+        warm_signed_urls(v.image_key for v in versions)
+        return Response({
+            "panel_id": panel.id,
+            "current_version": panel.version,
+            "versions": [{
+                "version": v.version,
+                "image_url": v.image_url,
+                "prompt": v.prompt,
+                "params": v.params,
+                "duration_ms": v.duration_ms,
+                "created_at": v.created_at,
+                "is_current": v.version == panel.version
+            } for v in versions]
+        })
+
+class PanelVersionRestoreView(APIView):
+    """Vuelve a una versión anterior: solo mueve el puntero, la imagen no se copia"""
+    def post(self, request, panel_id, version):
+        try:
+            panel = Panel.objects.select_related('page').get(id=panel_id)
+            target = panel.versions.get(version=version)
+        except Panel.DoesNotExist:
+            return Response({"error": "Panel not found"}, status=status.HTTP_404_NOT_FOUND)
+        except PanelVersion.DoesNotExist:
+            return Response({"error": "Version not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        panel.image.name = target.image_key
+        panel.prompt = target.prompt or panel.prompt
+        panel.version = target.version
+        panel.save()
+        return Response(_serialize_panel(panel, panel.page.page_number), status=status.HTTP_200_OK)
+
 class PanelUploadReferenceImageView(APIView):
     """Sube una imagen de referencia para un panel específico"""
     def post(self, request, panel_id):
@@ -0,0 +1,110 @@
+"""
+Compact wire format for backend <-> agent messages.
+
+Messages (invoke payloads and SQS results) are plain dicts. On the wire they
+travel as an envelope that keeps ``action`` / ``project_id`` readable and
+carries the body as compact JSON, zlib-compressed with a preset dictionary of
+the field names both sides use, base64-encoded. When the encoded body is still
+too large (SQS caps messages at 256 KB) it is written to S3 and only the key
+is sent inline.
+
+The codec is duplicated in agent/core/wire.py and both copies must
+stay identical: changing the dictionary means a new WIRE_VERSION on both sides.
+Plain (non-enveloped) dicts are passed through by ``unpack`` so either side can
+be deployed first.
+"""
+import base64
+import json
+import zlib
+
+WIRE_VERSION = 1
+ENCODING = "zlib+json"
+
+# SQS admite 256 KB por mensaje; dejamos margen para el resto del sobre.
+DEFAULT_INLINE_LIMIT = 200_000
+
+# Preset dictionary: field names and values that repeat in every message.
+# zlib favours the entries closest to the end, so the most frequent go last.
+_DICTIONARIES = {
+    1: "".join([
+        '"merged_pages":', '"merged_image_url":', '"world_model_summary":',
+        '"world_bible":', '"style_guide":', '"description":', '"metadata":',
+        '"sources":', '"max_pages":', '"max_panels":', '"layout_style":',
+        '"plan_only":', '"instructions":', '"current_image_url":',
+        '"reference_image_url":', '"panel_style":', '"global_context":',
+        '"image_urls":', '"sceneries":', '"characters":', '"name":',
+        '"action":"regenerate_panel"', '"action":"regenerate_merge"',
+        '"status":"completed"', '"status":"pending"', '"result":',
+        '"project_id":', '"panel_id":', '"type":"dialogue"',
+        '"type":"narration"', '"character":', '"text":', '"position":',
+        '"w":', '"h":', '"x":', '"y":', '"layout":', '"scenery_refs":',
+        '"character_refs":', '"image_url":"generated/', '.png"',
+        '"status":', '"balloons":[', '"scene_description":', '"prompt":',
+        '"order_in_page":', '"page_number":', '"panels":[', '{"id":',
+    ]).encode("utf-8"),
+}
+
+
+def _dumps(message):
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def encode(message, version=WIRE_VERSION):
+    """dict -> compressed bytes."""
+    compressor = zlib.compressobj(level=6, zdict=_DICTIONARIES[version])
+    return compressor.compress(_dumps(message)) + compressor.flush()
+
+
+def decode(blob, version=WIRE_VERSION):
+    """compressed bytes -> dict."""
+    if version not in _DICTIONARIES:
+        raise ValueError(f"Unsupported wire version: {version}")
+    decompressor = zlib.decompressobj(zdict=_DICTIONARIES[version])
+    raw = decompressor.decompress(blob) + decompressor.flush()
+    return json.loads(raw.decode("utf-8"))
+
+
+def is_packed(message):
+    return isinstance(message, dict) and "wire" in message and ("data" in message or "ref" in message)
+
+
+def pack(message, offload=None, inline_limit=DEFAULT_INLINE_LIMIT):
+    """
+    Builds the wire envelope for ``message``.
+
+    ``offload(blob) -> key`` stores the compressed body out of band; it is only
+    called when the base64 body would exceed ``inline_limit``. Without it the
+    body is always sent inline.
+    """
+    blob = encode(message)
+    envelope = {
+        "wire": WIRE_VERSION,
+        "enc": ENCODING,
+        "action": message.get("action"),
+        "project_id": message.get("project_id"),
+    }
+    data = base64.b64encode(blob).decode("ascii")
+    if offload is not None and len(data) > inline_limit:
+        envelope["ref"] = offload(blob)
+    else:
+        envelope["data"] = data
+    return envelope
+
+
+def unpack(message, fetch=None):
+    """
+    Inverse of ``pack``. Non-enveloped dicts are returned unchanged.
+
+    ``fetch(key) -> bytes`` reads an offloaded body.
+    """
+    if not is_packed(message):
+        return message
+    if message.get("enc") != ENCODING:
+        raise ValueError(f"Unsupported wire encoding: {message.get('enc')}")
+    if "ref" in message:
+        if fetch is None:
+            raise ValueError("Offloaded wire message received but no fetch function was provided")
+        blob = fetch(message["ref"])
+    else:
+        blob = base64.b64decode(message["data"])
+    return decode(blob, message["wire"])
@@ -46,6 +46,7 @@ if AWS_STORAGE_BUCKET_NAME:
     }
     AWS_S3_SIGNATURE_VERSION = 's3v4'
     AWS_QUERYSTRING_AUTH = True  # Asegura que las URLs tengan firma temporal si es privado
+    AWS_QUERYSTRING_EXPIRE = int(os.getenv('AWS_QUERYSTRING_EXPIRE', '3600'))
 else:
     STORAGES = {
         "default": {
@@ -58,6 +59,9 @@ else:
     MEDIA_URL = '/media/'
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# URLs firmadas cacheadas en proceso (apps/projects/url_signing.py)
+SIGNED_URL_REFRESH_MARGIN = int(os.getenv('SIGNED_URL_REFRESH_MARGIN', '300'))
+
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -125,3 +129,18 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50MB
 
 AGENT_SERVICE_URL = os.getenv('AGENT_SERVICE_URL', 'http://agent:8001')
+
+# Formato compacto backend <-> agente (apps/projects/wire.py)
+AGENT_COMPACT_WIRE = os.getenv('AGENT_COMPACT_WIRE', 'True') == 'True'
+AGENT_WIRE_INLINE_LIMIT = int(os.getenv('AGENT_WIRE_INLINE_LIMIT', '200000'))
+
+# Cola de invocaciones al agente (apps/projects/dispatch.py)
+# inprocess: hilos acotados dentro de cada worker web | external: manage.py dispatch_agent_runs
+AGENT_DISPATCH_MODE = os.getenv('AGENT_DISPATCH_MODE', 'inprocess')
+AGENT_DISPATCH_WORKERS = int(os.getenv('AGENT_DISPATCH_WORKERS', '4'))
+# inprocess: cada cuántos segundos se revisa la cola aunque nadie haya encolado (runs huérfanos tras un reinicio)
+AGENT_DISPATCH_SWEEP_SECONDS = float(os.getenv('AGENT_DISPATCH_SWEEP_SECONDS', '30'))
+# Lease de un run 'dispatched' sin resultado; debe superar la invocación más larga (read_timeout del cliente: 400 s)
+AGENT_DISPATCH_LEASE_SECONDS = float(os.getenv('AGENT_DISPATCH_LEASE_SECONDS', '1800'))
+# Espera antes de enviar una regeneración; clics repetidos en el mismo panel/página se fusionan
+AGENT_REGENERATE_DEBOUNCE_SECONDS = float(os.getenv('AGENT_REGENERATE_DEBOUNCE_SECONDS', '1.5'))
@@ -1,19 +1,20 @@
 from django.contrib import admin
 from django.urls import path
 from apps.projects.views import (
-    GenerateComicView, AgentCallbackView, ProjectDetailView, 
+    GenerateComicView, AgentCallbackView, ProjectDetailView, ProjectChangesView,
     UpdatePanelView, RegeneratePanelView, RegenerateMergedPagesView,
     CreateProjectView, ProjectUpdateView, PanelUploadReferenceImageView,
     CharacterListView, CharacterCreateView, CharacterDetailView,
     SceneryListView, SceneryCreateView, SceneryDetailView,
     ProjectNoteView, ProjectNoteDetailView, PanelLayoutUpdateView,
-    DeletePanelView
+    DeletePanelView, PanelVersionListView, PanelVersionRestoreView
 )
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/projects/', CreateProjectView.as_view()),
     path('api/projects/<uuid:project_id>/', ProjectDetailView.as_view()),
+    path('api/projects/<uuid:project_id>/changes/', ProjectChangesView.as_view()),
     path('api/projects/<uuid:project_id>/update/', ProjectUpdateView.as_view()),
     path('api/projects/<uuid:project_id>/generate/', GenerateComicView.as_view()),
     path('api/projects/<uuid:project_id>/callback/', AgentCallbackView.as_view()),
@@ -30,5 +31,7 @@ urlpatterns = [
     path('api/panels/<int:panel_id>/update/', UpdatePanelView.as_view()),
     path('api/panels/<int:panel_id>/upload-reference/', PanelUploadReferenceImageView.as_view()),
     path('api/panels/<int:panel_id>/regenerate/', RegeneratePanelView.as_view()),
+    path('api/panels/<int:panel_id>/versions/', PanelVersionListView.as_view()),
+    path('api/panels/<int:panel_id>/versions/<int:version>/restore/', PanelVersionRestoreView.as_view()),
     path('api/panels/<int:panel_id>/', DeletePanelView.as_view()),
 ]
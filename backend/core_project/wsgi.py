@@ -2,3 +2,10 @@ import os
 from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core_project.settings')
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.AGENT_DISPATCH_MODE == 'inprocess':
+    # Cada worker web reclama las ejecuciones que quedaron en cola (p. ej. tras un reinicio)
+    from apps.projects.dispatch import dispatcher  # noqa: E402
+    dispatcher.start_sweeper()